@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""Diff two loadtest JSON results: python -m benchmarks.compare before.json after.json"""
+import argparse
+import json
+
+METRICS = ('rps', 'p50_ms', 'p95_ms', 'p99_ms')
+
+def pct(before, after):
+    if not before:
+        return ''
+    return f'{(after - before) / before * 100:+.1f}%'
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('before')
+    parser.add_argument('after')
+    args = parser.parse_args()
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    print(f"before {before.get('commit')}  after {after.get('commit')}")
+    print(f"{'rpc':<22}" + ''.join(f'  {m:>26}' for m in METRICS))
+    for name in sorted(set(before['rpcs']) | set(after['rpcs'])):
+        b, a = before['rpcs'].get(name), after['rpcs'].get(name)
+        if not b or not a:
+            print(f"{name:<22}  only in {'after' if a else 'before'}")
+            continue
+        cells = ''.join(f"  {f'{b[m]} -> {a[m]} {pct(b[m], a[m])}':>26}" for m in METRICS)
+        print(f'{name:<22}{cells}')
+    print(f"{'total rps':<22}{before['total_rps']} -> {after['total_rps']} {pct(before['total_rps'], after['total_rps'])}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""Wire bytes and latency of reading whole tables through ListBooks/ListMembers
+in MAX_PAGE_SIZE pages, with and without gRPC compression, over a simulated
+slow link.
+
+Each compression setting gets its own in-process server (the fake service
+layer, seeded with --rows books and members, configured as serve() does) behind
+a TCP proxy that limits server-to-client bandwidth and adds one-way delay, so
+the numbers include what compression saves in transfer time as well as what it
+costs in CPU on both ends.
+
+    python -m benchmarks.compression --rows 10000 100000 --link-mbps 20 --delay-ms 20
+"""
+import argparse
+import heapq
+import json
+import socket
+import threading
+import time
+from concurrent import futures
+from datetime import datetime, timezone
+
+import grpc
+import library_pb2, library_pb2_grpc
+from benchmarks import fakedb
+from server.interceptors import COMPRESSED_METHODS, CompressionInterceptor, compression_options
+from server.pagination import MAX_PAGE_SIZE
+
+class SlowLink:
+    """TCP proxy to target; bytes towards the client are delivered no faster
+    than mbps and delay_ms late, and counted in received."""
+
+    def __init__(self, target, mbps, delay_ms):
+        self.target = target
+        self.rate = mbps * 1e6 / 8
+        self.delay = delay_ms / 1000
+        self.received = 0
+        self._listener = socket.create_server(('127.0.0.1', 0))
+        self.address = f'127.0.0.1:{self._listener.getsockname()[1]}'
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            client, _ = self._listener.accept()
+            upstream = socket.create_connection(self.target)
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._pump, args=(client, upstream, False), daemon=True).start()
+            threading.Thread(target=self._pump, args=(upstream, client, True), daemon=True).start()
+
+    def _pump(self, source, sink, throttled):
+        queue, ready, free_at = [], threading.Condition(), 0.0
+
+        def deliver():
+            while True:
+                with ready:
+                    while not queue:
+                        ready.wait()
+                    due, _, data = heapq.heappop(queue)
+                wait = due - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                if data is None:
+                    break
+                try:
+                    sink.sendall(data)
+                except OSError:
+                    break
+            sink.close()
+
+        threading.Thread(target=deliver, daemon=True).start()
+        seq = 0
+        while True:
+            try:
+                data = source.recv(65536)
+            except OSError:
+                data = b''
+            now = time.monotonic()
+            if throttled and data:
+                self.received += len(data)
+                free_at = max(free_at, now) + len(data) / self.rate
+                due = free_at + self.delay
+            else:
+                due = now + self.delay
+            seq += 1
+            with ready:
+                heapq.heappush(queue, (due, seq, data or None))
+                ready.notify()
+            if not data:
+                break
+
+def seed(db, rows):
+    now = datetime.now(timezone.utc)
+    for i in range(1, rows + 1):
+        db.books[i] = dict(id=i, isbn=f'978{i:010d}', title=f'The Collected Works, Volume {i}', author=f'Author {i % 997}',
+                           publisher='Neighborhood Press', published_date=now, available=True, created_at=now, updated_at=now)
+        db.members[i] = dict(id=i, name=f'Member {i}', email=f'member{i}@example.com', phone=f'+1-555-{i:07d}',
+                             address=f'{i} Long Street Name, Apartment {i % 50}, Springfield, 12345', created_at=now, updated_at=now)
+
+def start_server(algorithm):
+    from server.app import LibraryServicer
+    interceptors, options = [], []
+    if algorithm != 'none':
+        interceptors.append(CompressionInterceptor(frozenset(COMPRESSED_METHODS)))
+        options = compression_options(algorithm)
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4), interceptors=interceptors, options=options)
+    library_pb2_grpc.add_LibraryServiceServicer_to_server(LibraryServicer(), server)
+    port = server.add_insecure_port('127.0.0.1:0')
+    server.start()
+    return server, port
+
+def measure(link, method, request, repeat):
+    with grpc.insecure_channel(link.address, options=[('grpc.max_receive_message_length', -1)]) as channel:
+        stub = library_pb2_grpc.LibraryServiceStub(channel)
+        call = getattr(stub, method)
+        call(request)  # connect and warm up
+        latencies, before = [], link.received
+        for _ in range(repeat):
+            started, message_bytes, request.page_token = time.perf_counter(), 0, ''
+            while True:
+                response = call(request)
+                message_bytes += response.ByteSize()
+                if not response.next_page_token:
+                    break
+                request.page_token = response.next_page_token
+            latencies.append(time.perf_counter() - started)
+        return {'message_bytes': message_bytes, 'wire_bytes': (link.received - before) // repeat,
+                'median_ms': round(sorted(latencies)[len(latencies) // 2] * 1000, 1)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--algorithms', nargs='+', default=['none', 'gzip', 'deflate'])
+    parser.add_argument('--link-mbps', type=float, default=20)
+    parser.add_argument('--delay-ms', type=float, default=20, help='one-way delay')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    db = fakedb.install()
+    results = {}
+    for rows in args.rows:
+        db.books.clear(); db.members.clear()
+        seed(db, rows)
+        for algorithm in args.algorithms:
+            server, port = start_server(algorithm)
+            link = SlowLink(('127.0.0.1', port), args.link_mbps, args.delay_ms)
+            try:
+                for method, request in (('ListBooks', library_pb2.ListBooksRequest(page_size=MAX_PAGE_SIZE)),
+                                        ('ListMembers', library_pb2.ListMembersRequest(page_size=MAX_PAGE_SIZE))):
+                    key = f'{method} rows={rows} {algorithm}'
+                    results[key] = measure(link, method, request, args.repeat)
+                    print(key, results[key])
+            finally:
+                server.stop(0)
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
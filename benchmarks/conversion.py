@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Row -> protobuf conversion throughput, no database or network involved.
+
+Compares the previous per-row conversion (RealDictCursor rows, keyword
+constructors, Timestamp.FromDatetime + CopyFrom, then a list passed to the
+response constructor) with server.convert building messages in place from
+tuple rows.
+
+    python -m benchmarks.conversion --rows 100000
+"""
+import argparse
+import time
+from datetime import datetime, timedelta, timezone
+
+from google.protobuf.timestamp_pb2 import Timestamp
+
+import server.convert as convert
+import library_pb2
+
+def legacy_book(row):
+    b = library_pb2.Book(id=row['id'], isbn=row.get('isbn') or '', title=row['title'], author=row.get('author') or '', publisher=row.get('publisher') or '')
+    if row.get('published_date'):
+        ts = Timestamp(); ts.FromDatetime(row['published_date']); b.published_date.CopyFrom(ts)
+    return b
+
+def legacy_member(row):
+    return library_pb2.Member(id=row['id'], name=row['name'], email=row.get('email') or '', phone=row.get('phone') or '', address=row.get('address') or '')
+
+def legacy_borrowing(row):
+    bor = library_pb2.Borrowing(id=row['id'], book_id=row['book_id'], member_id=row['member_id'], status=row['status'])
+    if row.get('borrowed_at'):
+        ts = Timestamp(); ts.FromDatetime(row['borrowed_at']); bor.borrowed_at.CopyFrom(ts)
+    if row.get('due_at'):
+        ts = Timestamp(); ts.FromDatetime(row['due_at']); bor.due_at.CopyFrom(ts)
+    if row.get('returned_at'):
+        ts = Timestamp(); ts.FromDatetime(row['returned_at']); bor.returned_at.CopyFrom(ts)
+    return bor
+
+def book_rows(n):
+    now = datetime.now(timezone.utc)
+    columns = ('id', 'isbn', 'title', 'author', 'publisher', 'published_date', 'created_at', 'updated_at')
+    rows = [(i, f'978{i:010d}', f'Title {i}', f'Author {i % 997}', 'Publisher' if i % 3 else None,
+             datetime(1950 + i % 70, 1 + i % 12, 1), now, now) for i in range(1, n + 1)]
+    return columns, rows
+
+def member_rows(n):
+    now = datetime.now(timezone.utc)
+    columns = ('id', 'name', 'email', 'phone', 'address', 'created_at', 'updated_at')
+    rows = [(i, f'Member {i}', f'member{i}@example.com', None, f'{i} Main St', now, now) for i in range(1, n + 1)]
+    return columns, rows
+
+def borrowing_rows(n):
+    now = datetime.now(timezone.utc)
+    columns = ('id', 'book_id', 'member_id', 'borrowed_at', 'due_at', 'returned_at', 'status')
+    rows = [(i, i, i % 1000 + 1, now, now + timedelta(days=14), now if i % 2 else None,
+             'RETURNED' if i % 2 else 'BORROWED') for i in range(1, n + 1)]
+    return columns, rows
+
+CASES = [
+    ('books', book_rows, legacy_book, convert.BOOK, library_pb2.ListBooksResponse, 'books'),
+    ('members', member_rows, legacy_member, convert.MEMBER, library_pb2.ListMembersResponse, 'members'),
+    ('borrowings', borrowing_rows, legacy_borrowing, convert.BORROWING, library_pb2.ListBorrowedByMemberResponse, 'borrowings'),
+]
+
+def _best(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f'{"entity":<12}{"legacy rows/s":>16}{"convert rows/s":>16}{"speedup":>10}')
+    for name, make_rows, legacy, converter, response, field in CASES:
+        columns, rows = make_rows(args.rows)
+        dict_rows = [dict(zip(columns, r)) for r in rows]
+
+        def run_legacy():
+            response(**{field: [legacy(r) for r in dict_rows]}).SerializeToString()
+
+        def run_convert():
+            resp = response()
+            converter.extend(getattr(resp, field), columns, rows)
+            resp.SerializeToString()
+
+        old, new = _best(run_legacy, args.repeat), _best(run_convert, args.repeat)
+        print(f'{name:<12}{args.rows / old:>16,.0f}{args.rows / new:>16,.0f}{old / new:>9.2f}x')
+
+if __name__ == '__main__':
+    main()
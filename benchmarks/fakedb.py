@@ -0,0 +1,280 @@
+"""In-memory stand-in for server.services.* used by the load test.
+
+install() swaps the service functions the servicer calls for dict-backed
+implementations with the same return shapes and error strings, so the gRPC,
+validation and conversion layers can be measured without Postgres.
+"""
+import itertools
+import threading
+import time
+from datetime import datetime, timezone
+
+import server.services.books as books_svc
+import server.services.members as members_svc
+import server.services.borrowings as borrows_svc
+import server.events as events
+from server.services.catalog import AVAILABILITY_SHARDS, AVAILABILITY_VERSIONS
+
+class FakeDB:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.books, self.members, self.borrowings = {}, {}, {}
+        self._ids = {name: itertools.count(1) for name in ('books', 'members', 'borrowings', 'events')}
+        self.events = []
+        self.versions = dict.fromkeys(('books', 'members') + AVAILABILITY_VERSIONS, 1)
+
+    def _io(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    @staticmethod
+    def _now():
+        return datetime.now(timezone.utc)
+
+    @staticmethod
+    def _table(rows, fields=None):
+        """(columns, tuple rows) as returned by the list/search/stream services."""
+        if fields is not None:
+            return tuple(fields), [tuple(r[f] for f in fields) for r in rows]
+        columns = tuple(rows[0]) if rows else ()
+        return columns, [tuple(r.values()) for r in rows]
+
+    def _page(self, name, page_size, after_id, if_version, fields=None, where=None, versions=None):
+        version = sum(self.versions[v] for v in versions or (name,))
+        if if_version and if_version == version:
+            return version, None, None
+        table = getattr(self, name)
+        rows = [table[k] for k in sorted(table) if k > after_id and (where is None or where(table[k]))]
+        return (version,) + self._table(rows[:page_size] if page_size else rows, fields)
+
+    # books
+    def create_book(self, data):
+        self._io()
+        with self.lock:
+            if data.get('isbn') and any(b['isbn'] == data['isbn'] for b in self.books.values()):
+                raise ValueError('ALREADY_EXISTS')
+            row = dict(id=next(self._ids['books']), isbn=data.get('isbn'), title=data['title'], author=data.get('author'),
+                       publisher=data.get('publisher'), published_date=data.get('published_date'), available=True,
+                       created_at=self._now(), updated_at=self._now())
+            self.books[row['id']] = row
+            self.versions['books'] += 1
+            return dict(row)
+
+    def update_book(self, data):
+        self._io()
+        with self.lock:
+            row = self.books.get(data['id'])
+            if not row:
+                return None
+            row.update(isbn=data.get('isbn'), title=data['title'], author=data.get('author'), publisher=data.get('publisher'), updated_at=self._now())
+            self.versions['books'] += 1
+            return dict(row)
+
+    def delete_book(self, book_id):
+        self._io()
+        with self.lock:
+            if not self.books.get(book_id, {}).get('available', True):
+                raise ValueError('CANNOT_DELETE_BORROWED')
+            self.versions['books'] += 1
+            return self.books.pop(book_id, None) is not None
+
+    def get_book(self, book_id):
+        self._io()
+        with self.lock:
+            return self.books.get(book_id)
+
+    def list_books(self, page_size=0, after_id=0, if_version=0, fields=None, available_only=False):
+        self._io()
+        with self.lock:
+            return self._page('books', page_size, after_id, if_version, fields,
+                              (lambda b: b['available']) if available_only else None,
+                              books_svc.version_tables(fields, available_only))
+
+    def stream_books(self, batch_size=1000):
+        yield self.list_books()[1:]
+
+    def search_books(self, query, limit, after=None):
+        # every match ranks 1.0, so pages follow id
+        self._io()
+        q, after_id = query.lower(), after[1] if after else 0
+        with self.lock:
+            rows = [dict(self.books[k], rank=1.0) for k in sorted(self.books) if k > after_id and
+                    (q in (self.books[k]['title'] or '').lower() or q in (self.books[k]['author'] or '').lower())]
+        return self._table(rows[:limit])
+
+    def import_books(self, batch):
+        imported, conflicts = 0, []
+        for index, data in batch:
+            try:
+                self.create_book(data)
+                imported += 1
+            except ValueError:
+                conflicts.append((index, data.get('isbn')))
+        return imported, conflicts
+
+    # members
+    def create_member(self, data):
+        self._io()
+        with self.lock:
+            if data.get('email') and any(m['email'] == data['email'] for m in self.members.values()):
+                raise ValueError('ALREADY_EXISTS')
+            row = dict(id=next(self._ids['members']), name=data['name'], email=data.get('email'), phone=data.get('phone'),
+                       address=data.get('address'), created_at=self._now(), updated_at=self._now())
+            self.members[row['id']] = row
+            self.versions['members'] += 1
+            return dict(row)
+
+    def update_member(self, data):
+        self._io()
+        with self.lock:
+            row = self.members.get(data['id'])
+            if not row:
+                return None
+            row.update(name=data['name'], email=data.get('email'), phone=data.get('phone'), address=data.get('address'), updated_at=self._now())
+            self.versions['members'] += 1
+            return dict(row)
+
+    def delete_member(self, member_id):
+        self._io()
+        with self.lock:
+            if any(b['member_id'] == member_id and b['status'] == 'BORROWED' for b in self.borrowings.values()):
+                raise ValueError('CANNOT_DELETE_MEMBER_WITH_BORROWINGS')
+            self.versions['members'] += 1
+            return self.members.pop(member_id, None) is not None
+
+    def get_member(self, member_id, fields=None):
+        # whole rows, as from the entity cache
+        self._io()
+        with self.lock:
+            return self.members.get(member_id)
+
+    def list_members(self, page_size=0, after_id=0, if_version=0, fields=None):
+        self._io()
+        with self.lock:
+            return self._page('members', page_size, after_id, if_version, fields)
+
+    def stream_members(self, batch_size=1000):
+        yield self.list_members()[1:]
+
+    def get_member_detail(self, member_id, history_limit, before_id=0):
+        self._io()
+        with self.lock:
+            member = self.members.get(member_id)
+            if not member:
+                return None
+            loans = [dict(b, title=self.books.get(b['book_id'], {}).get('title'), author=None, isbn=None)
+                     for b in self.borrowings.values() if b['member_id'] == member_id]
+        now = self._now()
+        active = sorted((l for l in loans if l['status'] == 'BORROWED'), key=lambda l: (l['due_at'] is None, l['due_at'] or now, l['id']))
+        history = sorted((l for l in loans if l['status'] != 'BORROWED' and (not before_id or l['id'] < before_id)), key=lambda l: -l['id'])
+        return dict(member, active_count=len(active), overdue_count=sum(1 for l in active if l['due_at'] and l['due_at'] < now),
+                    lifetime_count=len(loans), active=active, history=history[:history_limit])
+
+    def import_members(self, batch):
+        imported, conflicts = 0, []
+        for index, data in batch:
+            try:
+                self.create_member(data)
+                imported += 1
+            except ValueError:
+                conflicts.append((index, data.get('email')))
+        return imported, conflicts
+
+    # borrowings
+    def borrow_book(self, book_id, member_id, due_at=None):
+        self._io()
+        with self.lock:
+            if book_id not in self.books:
+                return None, 'BOOK_NOT_FOUND'
+            if member_id not in self.members:
+                return None, 'MEMBER_NOT_FOUND'
+            if not self.books[book_id]['available']:
+                return None, 'ALREADY_BORROWED'
+            row = dict(id=next(self._ids['borrowings']), book_id=book_id, member_id=member_id, borrowed_at=self._now(),
+                       due_at=due_at, returned_at=None, status='BORROWED')
+            self.borrowings[row['id']] = row
+            self._set_available(book_id, False)
+            self._record(row)
+            return dict(row), None
+
+    def return_book(self, borrowing_id):
+        self._io()
+        with self.lock:
+            row = self.borrowings.get(borrowing_id)
+            if not row:
+                return None, 'NOT_FOUND'
+            if row['status'] != 'BORROWED':
+                return None, 'ALREADY_RETURNED'
+            row.update(status='RETURNED', returned_at=self._now())
+            self._set_available(row['book_id'], True)
+            self._record(row)
+            return dict(row), None
+
+    def borrow_books(self, member_id, book_ids, due_at=None):
+        if member_id not in self.members:
+            return None, 'MEMBER_NOT_FOUND'
+        results = []
+        for book_id in book_ids:
+            row, err = self.borrow_book(book_id, member_id, due_at)
+            results.append((book_id, 'NOT_FOUND' if err == 'BOOK_NOT_FOUND' else err or 'OK', row))
+        return results, None
+
+    def return_books(self, borrowing_ids):
+        results = []
+        for borrowing_id in borrowing_ids:
+            row, err = self.return_book(borrowing_id)
+            results.append((borrowing_id, err or 'OK', row))
+        return results
+
+    def list_borrowed_by_member(self, member_id, fields=None):
+        self._io()
+        with self.lock:
+            rows = [b for b in self.borrowings.values() if b['member_id'] == member_id]
+            return self._table(sorted(rows, key=lambda b: b['borrowed_at'], reverse=True), fields)
+
+    def list_overdue(self, as_of, member_id=0, after=None, limit=0, batch_size=500):
+        self._io()
+        with self.lock:
+            rows = sorted((b for b in self.borrowings.values() if b['status'] == 'BORROWED' and b['due_at'] and b['due_at'] < as_of
+                           and (not member_id or b['member_id'] == member_id)
+                           and (not after or (b['due_at'], b['id']) > after)), key=lambda b: (b['due_at'], b['id']))
+        rows = rows[:limit] if limit else rows
+        for i in range(0, len(rows), batch_size):
+            yield self._table(rows[i:i + batch_size])
+
+    def _set_available(self, book_id, available):
+        # books.available as the borrowings trigger maintains it
+        if book_id in self.books:
+            self.books[book_id]['available'] = available
+            self.versions[AVAILABILITY_VERSIONS[book_id % AVAILABILITY_SHARDS]] += 1
+
+    def _record(self, row):
+        event = dict(id=next(self._ids['events']), type=row['status'], occurred_at=self._now(), borrowing=dict(row))
+        self.events.append(event)
+        events.feed.publish(event)
+
+    def events_after(self, after_id, member_id=0, book_id=0, limit=events.REPLAY_BATCH_SIZE):
+        self._io()
+        with self.lock:
+            matched = [e for e in self.events if e['id'] > after_id and
+                       (not member_id or e['borrowing']['member_id'] == member_id) and
+                       (not book_id or e['borrowing']['book_id'] == book_id)]
+        return matched[:limit]
+
+SERVICES = {
+    books_svc: ('create_book', 'update_book', 'delete_book', 'get_book', 'list_books', 'stream_books', 'search_books', 'import_books'),
+    members_svc: ('create_member', 'update_member', 'delete_member', 'get_member', 'get_member_detail', 'list_members', 'stream_members',
+                  'import_members'),
+    borrows_svc: ('borrow_book', 'return_book', 'list_borrowed_by_member', 'list_overdue',
+                  'borrow_books', 'return_books'),
+    events: ('events_after',),
+}
+
+def install(latency=0.0):
+    """Point the service modules at a fresh FakeDB and return it."""
+    db = FakeDB(latency)
+    for module, names in SERVICES.items():
+        for name in names:
+            setattr(module, name, getattr(db, name))
+    return db
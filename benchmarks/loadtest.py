@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""Load test for LibraryService.
+
+Drives every RPC in library.proto from N client threads with a weighted
+request mix and reports throughput and p50/p95/p99 latency per RPC. The
+server runs in-process on an ephemeral port, backed either by the in-memory
+fake service layer (benchmarks.fakedb) or by Postgres at DATABASE_URL; use
+--target to load an already running server instead.
+
+    python -m benchmarks.loadtest --backend fake --concurrency 16 --duration 30 --out results/fake.json
+    python -m benchmarks.loadtest --backend postgres --mix GetMember=50,BorrowBook=25,ReturnBook=25
+    python -m benchmarks.compare results/before.json results/after.json
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+import uuid
+from concurrent import futures
+from datetime import datetime, timedelta, timezone
+
+import grpc
+import library_pb2, library_pb2_grpc
+
+# 80% reads / 20% borrow+return
+DEFAULT_MIX = {
+    'GetMember': 30, 'ListBooks': 14, 'ListBorrowedByMember': 14, 'SearchBooks': 10, 'ListMembers': 8,
+    'StreamBooks': 2, 'StreamMembers': 2, 'BorrowBook': 10, 'ReturnBook': 10,
+}
+
+class State:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.book_ids, self.member_ids = [], []
+        self.active = collections.deque()
+
+    def pick(self, rng, ids):
+        with self.lock:
+            return rng.choice(ids) if ids else 0
+
+    def add(self, ids, value):
+        with self.lock:
+            ids.append(value)
+
+    def take(self, ids):
+        with self.lock:
+            return ids.pop() if len(ids) > 1 else 0
+
+def _tag():
+    return uuid.uuid4().hex[:12]
+
+def _book(tag):
+    return library_pb2.Book(title=f'Load test {tag}', author='Bench', isbn=f'lt-{tag}', publisher='Bench')
+
+def _member(tag):
+    return library_pb2.Member(name=f'Load test {tag}', email=f'lt-{tag}@example.com', phone='555-0100', address='1 Bench Way')
+
+def op_create_book(stub, state, rng):
+    state.add(state.book_ids, stub.CreateBook(library_pb2.CreateBookRequest(book=_book(_tag()))).book.id)
+
+def op_update_book(stub, state, rng):
+    book = _book(_tag()); book.id = state.pick(rng, state.book_ids)
+    stub.UpdateBook(library_pb2.UpdateBookRequest(book=book))
+
+def op_delete_book(stub, state, rng):
+    stub.DeleteBook(library_pb2.DeleteBookRequest(book_id=state.take(state.book_ids)))
+
+def op_create_member(stub, state, rng):
+    state.add(state.member_ids, stub.CreateMember(library_pb2.CreateMemberRequest(member=_member(_tag()))).member.id)
+
+def op_update_member(stub, state, rng):
+    member = _member(_tag()); member.id = state.pick(rng, state.member_ids)
+    stub.UpdateMember(library_pb2.UpdateMemberRequest(member=member))
+
+def op_delete_member(stub, state, rng):
+    stub.DeleteMember(library_pb2.DeleteMemberRequest(member_id=state.take(state.member_ids)))
+
+def op_get_member(stub, state, rng):
+    stub.GetMember(library_pb2.GetMemberRequest(id=state.pick(rng, state.member_ids)))
+
+def op_get_member_detail(stub, state, rng):
+    stub.GetMemberDetail(library_pb2.GetMemberDetailRequest(member_id=state.pick(rng, state.member_ids)))
+
+def op_borrow_book(stub, state, rng):
+    # due dates straddle now so ListOverdue has something to find
+    request = library_pb2.BorrowBookRequest(book_id=state.pick(rng, state.book_ids), member_id=state.pick(rng, state.member_ids))
+    request.due_at.FromDatetime(datetime.now(timezone.utc) + timedelta(days=rng.uniform(-14, 14)))
+    resp = stub.BorrowBook(request)
+    with state.lock:
+        state.active.append(resp.borrowing.id)
+
+def op_return_book(stub, state, rng):
+    with state.lock:
+        borrowing_id = state.active.popleft() if state.active else 0
+    stub.ReturnBook(library_pb2.ReturnBookRequest(borrowing_id=borrowing_id))
+
+def op_borrow_books(stub, state, rng):
+    book_ids = [state.pick(rng, state.book_ids) for _ in range(5)]
+    resp = stub.BorrowBooks(library_pb2.BorrowBooksRequest(member_id=state.pick(rng, state.member_ids), book_ids=book_ids))
+    with state.lock:
+        state.active.extend(r.borrowing.id for r in resp.results if r.status == 'OK')
+
+def op_return_books(stub, state, rng):
+    with state.lock:
+        borrowing_ids = [state.active.popleft() for _ in range(min(5, len(state.active)))]
+    stub.ReturnBooks(library_pb2.ReturnBooksRequest(borrowing_ids=borrowing_ids))
+
+def op_list_borrowed(stub, state, rng):
+    stub.ListBorrowedByMember(library_pb2.ListBorrowedByMemberRequest(member_id=state.pick(rng, state.member_ids)))
+
+def op_list_books(stub, state, rng):
+    stub.ListBooks(library_pb2.ListBooksRequest(page_size=50))
+
+def op_list_members(stub, state, rng):
+    stub.ListMembers(library_pb2.ListMembersRequest(page_size=50))
+
+def op_stream_books(stub, state, rng):
+    for _ in stub.StreamBooks(library_pb2.StreamBooksRequest()):
+        pass
+
+def op_stream_members(stub, state, rng):
+    for _ in stub.StreamMembers(library_pb2.StreamMembersRequest()):
+        pass
+
+def op_search_books(stub, state, rng):
+    stub.SearchBooks(library_pb2.SearchBooksRequest(query=rng.choice(['load', 'test', 'bench']), page_size=20))
+
+def op_import_books(stub, state, rng):
+    stub.ImportBooks(iter([_book(_tag()) for _ in range(100)]))
+
+def op_import_members(stub, state, rng):
+    stub.ImportMembers(iter([_member(_tag()) for _ in range(100)]))
+
+def op_list_overdue(stub, state, rng):
+    for _ in stub.ListOverdue(library_pb2.ListOverdueRequest(page_size=100)):
+        pass
+
+def op_watch_borrowings(stub, state, rng):
+    # replay a member's recorded events, then hang up; a member with no history
+    # waits out the deadline, which counts as a normal end
+    call = stub.WatchBorrowings(library_pb2.WatchBorrowingsRequest(member_id=state.pick(rng, state.member_ids), after_event_id=1), timeout=0.5)
+    try:
+        for i, _ in enumerate(call):
+            if i == 9:
+                call.cancel()
+                break
+    except grpc.RpcError as e:
+        if e.code() not in (grpc.StatusCode.DEADLINE_EXCEEDED, grpc.StatusCode.CANCELLED):
+            raise
+
+OPERATIONS = {
+    'CreateBook': op_create_book, 'UpdateBook': op_update_book, 'DeleteBook': op_delete_book,
+    'CreateMember': op_create_member, 'UpdateMember': op_update_member, 'DeleteMember': op_delete_member,
+    'GetMember': op_get_member, 'BorrowBook': op_borrow_book, 'ReturnBook': op_return_book,
+    'ListBorrowedByMember': op_list_borrowed, 'ListBooks': op_list_books, 'ListMembers': op_list_members,
+    'StreamBooks': op_stream_books, 'StreamMembers': op_stream_members, 'SearchBooks': op_search_books,
+    'ImportBooks': op_import_books, 'ImportMembers': op_import_members, 'WatchBorrowings': op_watch_borrowings,
+    'ListOverdue': op_list_overdue, 'BorrowBooks': op_borrow_books, 'ReturnBooks': op_return_books, 'GetMemberDetail': op_get_member_detail,
+}
+
+def parse_mix(spec):
+    if not spec:
+        return dict(DEFAULT_MIX)
+    if spec == 'all':
+        return {name: 1 for name in OPERATIONS}
+    mix = {}
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        if name not in OPERATIONS:
+            raise SystemExit(f'unknown RPC in --mix: {name}')
+        mix[name] = float(weight or 1)
+    return mix
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))] if sorted_values else None
+
+def summarize(samples, elapsed):
+    report = {}
+    for name, entries in sorted(samples.items()):
+        latencies = sorted(t for t, _ in entries)
+        codes = collections.Counter(code for _, code in entries)
+        report[name] = {
+            'count': len(entries),
+            'rps': round(len(entries) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+            'codes': dict(codes),
+        }
+    return report
+
+def seed(stub, state, books, members):
+    for _ in range(members):
+        op_create_member(stub, state, None)
+    for _ in range(books):
+        op_create_book(stub, state, None)
+
+def run(stub, state, mix, concurrency, duration, rng_seed):
+    names, weights = zip(*mix.items())
+    samples = collections.defaultdict(list)
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def worker(i):
+        rng = random.Random(rng_seed + i)
+        local = collections.defaultdict(list)
+        while time.monotonic() < stop_at:
+            name = rng.choices(names, weights)[0]
+            t0 = time.perf_counter()
+            try:
+                OPERATIONS[name](stub, state, rng)
+                code = 'OK'
+            except grpc.RpcError as e:
+                code = e.code().name
+            local[name].append((time.perf_counter() - t0, code))
+        with lock:
+            for name, entries in local.items():
+                samples[name].extend(entries)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    started = time.monotonic()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return samples, time.monotonic() - started
+
+def start_server(backend, fake_latency):
+    if backend == 'fake':
+        from benchmarks import fakedb
+        fakedb.install(fake_latency)
+    else:
+        from server.db import init_pool
+        from server.app import GRPC_MAX_WORKERS
+        init_pool(minconn=1, maxconn=int(os.environ.get('DB_MAXCONN', GRPC_MAX_WORKERS)))
+    from server.app import LibraryServicer, GRPC_MAX_WORKERS
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=GRPC_MAX_WORKERS))
+    library_pb2_grpc.add_LibraryServiceServicer_to_server(LibraryServicer(), server)
+    port = server.add_insecure_port('127.0.0.1:0')
+    server.start()
+    return server, f'127.0.0.1:{port}'
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', choices=['fake', 'postgres'], default='fake')
+    parser.add_argument('--target', help='host:port of a running server (skips the in-process server)')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--mix', help="'all' or RPC=weight pairs, e.g. GetMember=80,BorrowBook=10,ReturnBook=10")
+    parser.add_argument('--seed-books', type=int, default=500)
+    parser.add_argument('--seed-members', type=int, default=200)
+    parser.add_argument('--fake-latency-ms', type=float, default=0, help='simulated DB latency per fake call')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', help='write JSON results to this path')
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    server = None
+    address = args.target
+    if not address:
+        server, address = start_server(args.backend, args.fake_latency_ms / 1000)
+    stub = library_pb2_grpc.LibraryServiceStub(grpc.insecure_channel(address))
+    try:
+        state = State()
+        seed(stub, state, args.seed_books, args.seed_members)
+        samples, elapsed = run(stub, state, mix, args.concurrency, args.duration, args.seed)
+    finally:
+        if server:
+            server.stop(0)
+
+    report = summarize(samples, elapsed)
+    total = sum(r['count'] for r in report.values())
+    print(f"{'rpc':<22}{'count':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}  codes")
+    for name, r in report.items():
+        print(f"{name:<22}{r['count']:>8}{r['rps']:>10}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}  {r['codes']}")
+    print(f'total {total} requests in {elapsed:.1f}s ({total / elapsed:.1f} rps)')
+
+    if args.out:
+        result = {
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'config': {**vars(args), 'mix': mix, 'target': address if args.target else None},
+            'elapsed_s': round(elapsed, 3),
+            'total_rps': round(total / elapsed, 1),
+            'rpcs': report,
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, 'w') as f:
+            json.dump(result, f, indent=2)
+
+if __name__ == '__main__':
+    main()
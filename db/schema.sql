@@ -1,5 +1,7 @@
 -- PostgreSQL schema for Neighborhood Library
 
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
 CREATE TABLE IF NOT EXISTS books (
     id SERIAL PRIMARY KEY,
     isbn VARCHAR(32) UNIQUE,
@@ -11,6 +13,21 @@ CREATE TABLE IF NOT EXISTS books (
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT now()
 );
 
+-- Full-text search document for SearchBooks; 'simple' keeps tokens unstemmed so
+-- prefix queries (tolk:*) behave predictably.
+ALTER TABLE books ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+    setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce(isbn, '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce(author, '')), 'B') ||
+    setweight(to_tsvector('simple', coalesce(publisher, '')), 'C')
+) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_books_search_vector ON books USING GIN (search_vector);
+CREATE INDEX IF NOT EXISTS idx_books_title_trgm ON books USING GIN (title gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_books_author_trgm ON books USING GIN (author gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_books_publisher_trgm ON books USING GIN (publisher gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_books_isbn_prefix ON books (isbn varchar_pattern_ops);
+
 CREATE TABLE IF NOT EXISTS members (
     id SERIAL PRIMARY KEY,
     name TEXT NOT NULL,
@@ -33,3 +50,148 @@ CREATE TABLE IF NOT EXISTS borrowings (
 
 CREATE INDEX IF NOT EXISTS idx_borrowings_bookid_status ON borrowings(book_id, status);
 CREATE INDEX IF NOT EXISTS idx_borrowings_memberid_status ON borrowings(member_id, status);
+-- At most one active loan per book; borrow_book relies on this for ON CONFLICT.
+CREATE UNIQUE INDEX IF NOT EXISTS uq_borrowings_active_book ON borrowings(book_id) WHERE status = 'BORROWED';
+-- ListOverdue: partial indexes cover active loans only, so they stay small as
+-- returned loans accumulate. The second serves the member filter.
+CREATE INDEX IF NOT EXISTS idx_borrowings_overdue ON borrowings(due_at, id) WHERE status = 'BORROWED';
+CREATE INDEX IF NOT EXISTS idx_borrowings_member_overdue ON borrowings(member_id, due_at, id) WHERE status = 'BORROWED';
+
+-- Per-table change counters for conditional list reads (ListBooks/ListMembers
+-- if_version). Bumped once per writing statement, in the writer's transaction,
+-- so a version is never visible before the rows it describes.
+CREATE TABLE IF NOT EXISTS catalog_versions (
+    table_name TEXT PRIMARY KEY,
+    version BIGINT NOT NULL
+);
+INSERT INTO catalog_versions(table_name, version) VALUES ('books', 1), ('members', 1) ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_catalog_version() RETURNS trigger AS $$
+BEGIN
+    UPDATE catalog_versions SET version = version + 1 WHERE table_name = TG_TABLE_NAME;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS books_catalog_version ON books;
+CREATE TRIGGER books_catalog_version AFTER INSERT OR DELETE OR TRUNCATE ON books
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version();
+DROP TRIGGER IF EXISTS books_catalog_version_update ON books;
+CREATE TRIGGER books_catalog_version_update AFTER UPDATE OF isbn, title, author, publisher, published_date ON books
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version();
+DROP TRIGGER IF EXISTS members_catalog_version ON members;
+CREATE TRIGGER members_catalog_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON members
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version();
+
+-- Borrow/return change feed for WatchBorrowings. Each status change is recorded
+-- (so clients can resume from an event id) and announced with NOTIFY on commit.
+CREATE TABLE IF NOT EXISTS borrowing_events (
+    id BIGSERIAL PRIMARY KEY,
+    borrowing_id INTEGER NOT NULL,
+    book_id INTEGER NOT NULL,
+    member_id INTEGER NOT NULL,
+    type VARCHAR(16) NOT NULL,
+    occurred_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    borrowing JSONB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_borrowing_events_member ON borrowing_events(member_id, id);
+CREATE INDEX IF NOT EXISTS idx_borrowing_events_book ON borrowing_events(book_id, id);
+-- retention: the feed listener deletes events older than WATCH_EVENT_RETENTION_HOURS
+CREATE INDEX IF NOT EXISTS idx_borrowing_events_occurred ON borrowing_events(occurred_at);
+
+CREATE OR REPLACE FUNCTION record_borrowing_event() RETURNS trigger AS $$
+DECLARE
+    ev borrowing_events;
+BEGIN
+    INSERT INTO borrowing_events(borrowing_id, book_id, member_id, type, borrowing)
+    VALUES (NEW.id, NEW.book_id, NEW.member_id, NEW.status, to_jsonb(NEW))
+    RETURNING * INTO ev;
+    PERFORM pg_notify('borrowing_events', json_build_object(
+        'id', ev.id, 'type', ev.type, 'occurred_at', ev.occurred_at, 'borrowing', ev.borrowing)::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS borrowings_record_insert ON borrowings;
+CREATE TRIGGER borrowings_record_insert AFTER INSERT ON borrowings
+    FOR EACH ROW EXECUTE FUNCTION record_borrowing_event();
+DROP TRIGGER IF EXISTS borrowings_record_status ON borrowings;
+CREATE TRIGGER borrowings_record_status AFTER UPDATE OF status ON borrowings
+    FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status) EXECUTE FUNCTION record_borrowing_event();
+
+-- Book availability for ListBooks available_only. Kept in step with the active
+-- loan (uq_borrowings_active_book) by statement-level triggers on borrowings,
+-- so single, batch and cascaded loan changes all update it in the same
+-- transaction, once per statement. The partial index holds available books
+-- only, so an available_only page is a range scan of page_size entries.
+ALTER TABLE books ADD COLUMN IF NOT EXISTS available BOOLEAN NOT NULL DEFAULT true;
+UPDATE books SET available = false
+WHERE available AND id IN (SELECT book_id FROM borrowings WHERE status = 'BORROWED');
+CREATE INDEX IF NOT EXISTS idx_books_available ON books(id) WHERE available;
+
+-- Changes to books.available are counted apart from the catalog version, so
+-- loans neither lock the 'books' row nor change the version of listings that
+-- do not read availability. The counter is split into 16 rows by book id
+-- (books_availability_0..15, summed by server/services/catalog.py), so loans
+-- on different books rarely wait on the same row. A statement locks its rows
+-- in name order, so batches cannot deadlock on them.
+INSERT INTO catalog_versions(table_name, version)
+SELECT 'books_availability_' || n, 1 FROM generate_series(0, 15) AS n
+ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_availability_version() RETURNS trigger AS $$
+DECLARE
+    shards TEXT[];
+BEGIN
+    -- column-list (UPDATE OF) triggers cannot have transition tables, so this
+    -- runs for every books UPDATE and picks out the rows whose flag changed
+    SELECT array_agg(DISTINCT 'books_availability_' || (n.id % 16)) INTO shards
+    FROM new_books n JOIN old_books o USING (id) WHERE n.available <> o.available;
+    IF shards IS NULL THEN
+        RETURN NULL;
+    END IF;
+    PERFORM 1 FROM catalog_versions WHERE table_name = ANY(shards) ORDER BY table_name FOR UPDATE;
+    UPDATE catalog_versions SET version = version + 1 WHERE table_name = ANY(shards);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS books_availability_version ON books;
+CREATE TRIGGER books_availability_version AFTER UPDATE ON books
+    REFERENCING OLD TABLE AS old_books NEW TABLE AS new_books
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_availability_version();
+
+CREATE OR REPLACE FUNCTION sync_book_availability() RETURNS trigger AS $$
+BEGIN
+    -- The transition tables exist only for the events that define them. The
+    -- EXISTS guards skip the UPDATE, and with it the availability version
+    -- bump, for statements that change no active loan (a refused borrow).
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        IF EXISTS (SELECT 1 FROM old_loans WHERE status = 'BORROWED') THEN
+            UPDATE books SET available = true
+            WHERE NOT available AND id IN (SELECT book_id FROM old_loans WHERE status = 'BORROWED')
+              AND NOT EXISTS (SELECT 1 FROM borrowings l WHERE l.book_id = books.id AND l.status = 'BORROWED');
+        END IF;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        IF EXISTS (SELECT 1 FROM new_loans WHERE status = 'BORROWED') THEN
+            UPDATE books SET available = false
+            WHERE available AND id IN (SELECT book_id FROM new_loans WHERE status = 'BORROWED');
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS borrowings_availability_insert ON borrowings;
+CREATE TRIGGER borrowings_availability_insert AFTER INSERT ON borrowings
+    REFERENCING NEW TABLE AS new_loans
+    FOR EACH STATEMENT EXECUTE FUNCTION sync_book_availability();
+DROP TRIGGER IF EXISTS borrowings_availability_update ON borrowings;
+CREATE TRIGGER borrowings_availability_update AFTER UPDATE ON borrowings
+    REFERENCING OLD TABLE AS old_loans NEW TABLE AS new_loans
+    FOR EACH STATEMENT EXECUTE FUNCTION sync_book_availability();
+DROP TRIGGER IF EXISTS borrowings_availability_delete ON borrowings;
+CREATE TRIGGER borrowings_availability_delete AFTER DELETE ON borrowings
+    REFERENCING OLD TABLE AS old_loans
+    FOR EACH STATEMENT EXECUTE FUNCTION sync_book_availability();
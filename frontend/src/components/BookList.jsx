@@ -5,10 +5,12 @@ import '../styles.css'
 
 export default function BookList() {
   const [books, setBooks] = useState([])
+  const [nextToken, setNextToken] = useState('')
   const [error, setError] = useState('')
   const [loading, setLoading] = useState(false)
   const [editingBook, setEditingBook] = useState(null)
   const [editForm, setEditForm] = useState({ title: '', author: '', isbn: '' })
+  const [query, setQuery] = useState('')
 
   useEffect(() => { fetchBooks() }, [])
 
@@ -17,13 +19,41 @@ export default function BookList() {
     setLoading(true)
     try {
       const res = await api.get('/books')
-      setBooks(res.data)
+      setBooks(res.data.books)
+      setNextToken(res.data.next_page_token || '')
     } catch (e) {
       console.error(e)
       setError('Failed to fetch books')
     } finally { setLoading(false) }
   }
 
+  async function loadMoreBooks() {
+    try {
+      const res = await api.get('/books', { params: { page_token: nextToken } })
+      setBooks(b => b.concat(res.data.books))
+      setNextToken(res.data.next_page_token || '')
+    } catch (e) {
+      console.error(e)
+      setError('Failed to fetch books')
+    }
+  }
+
+  async function searchBooks(e) {
+    e.preventDefault()
+    const q = query.trim()
+    if (!q) { fetchBooks(); return }
+    setError('')
+    setLoading(true)
+    try {
+      const res = await api.get('/books/search', { params: { q, page_size: 50 } })
+      setBooks(res.data.books)
+      setNextToken('')
+    } catch (e) {
+      console.error(e)
+      setError(e?.response?.data?.error || 'Search failed')
+    } finally { setLoading(false) }
+  }
+
   async function deleteBook(id) {
     if (!window.confirm('Are you sure you want to delete this book?')) return
     try {
@@ -59,13 +89,17 @@ export default function BookList() {
         <h2>Books</h2>
         <button onClick={fetchBooks}>Refresh</button>
       </div>
+      <form onSubmit={searchBooks}>
+        <input placeholder="Search title, author or ISBN" value={query} onChange={e => setQuery(e.target.value)} />
+        <button type="submit" style={{ marginLeft: 8 }}>Search</button>
+      </form>
       {error && <Message type="error">{error}</Message>}
       {loading && <div>Loading books...</div>}
       {!loading && books.length === 0 && <div>No books found.</div>}
       {!loading && books.length > 0 && <table>
-        <thead><tr><th>ID</th><th>Title</th><th>Author</th><th>ISBN</th><th>Actions</th></tr></thead>
+        <thead><tr><th>ID</th><th>Title</th><th>Author</th><th>ISBN</th><th>Status</th><th>Actions</th></tr></thead>
         <tbody>
-          {books.map(b => <tr key={b.id}><td>{b.id}</td><td>{b.title}</td><td>{b.author}</td><td>{b.isbn}</td>
+          {books.map(b => <tr key={b.id}><td>{b.id}</td><td>{b.title}</td><td>{b.author}</td><td>{b.isbn}</td><td>{b.available ? 'Available' : 'On loan'}</td>
             <td>
               <button onClick={() => openEdit(b)}>Edit</button>
               <button onClick={() => deleteBook(b.id)} style={{ color: 'red', marginLeft: 8 }}>Delete</button>
@@ -73,6 +107,7 @@ export default function BookList() {
           </tr>)}
         </tbody>
       </table>}
+      {!loading && nextToken && <button onClick={loadMoreBooks}>Load more</button>}
 
       {editingBook && (
         <div className="modal-backdrop">
@@ -13,10 +13,10 @@ export default function BorrowBook() {
 
   useEffect(() => { fetchBooks(); fetchMembers() }, [])
   async function fetchBooks() {
-    try { const res = await api.get('/books'); setBooks(res.data) } catch (e) { console.error(e); setError('Failed to fetch books') }
+    try { const res = await api.get('/books', { params: { fields: 'id,title', available: true, page_size: 1000 } }); setBooks(res.data.books) } catch (e) { console.error(e); setError('Failed to fetch books') }
   }
   async function fetchMembers() {
-    try { const res = await api.get('/members'); setMembers(res.data) } catch (e) { console.error(e); setError('Failed to fetch members') }
+    try { const res = await api.get('/members', { params: { fields: 'id,name', page_size: 1000 } }); setMembers(res.data.members) } catch (e) { console.error(e); setError('Failed to fetch members') }
   }
   async function submit(e) {
     e.preventDefault()
@@ -3,32 +3,39 @@ import api from '../services/api' // Use centralized api service
 import Message from './Message'
 
 export default function MemberDetail({ memberId, onBack }) {
-  const [member, setMember] = useState(null)
-  const [borrowings, setBorrowings] = useState([])
+  const [detail, setDetail] = useState(null)
+  const [history, setHistory] = useState([])
+  const [nextToken, setNextToken] = useState('')
   const [loading, setLoading] = useState(true)
   const [error, setError] = useState('')
 
   useEffect(() => { if (memberId) load() }, [memberId])
 
+  // One request: member, active loans with book titles, first history page and counts.
   async function load() {
     setLoading(true); setError('')
     try {
-      const res = await api.get('/members/' + memberId)
-      setMember(res.data)
-
-      try {
-        const br = await api.get(`/members/${memberId}/borrowed`)
-        setBorrowings(br.data)
-      } catch (e) {
-        console.error("Failed to fetch history", e)
-        setBorrowings([])
-      }
+      const res = await api.get(`/members/${memberId}/detail`)
+      setDetail(res.data)
+      setHistory(res.data.history || [])
+      setNextToken(res.data.next_history_page_token || '')
     } catch (err) {
       console.error(err)
       setError('Failed to load member details')
     } finally { setLoading(false) }
   }
 
+  async function loadMoreHistory() {
+    try {
+      const res = await api.get(`/members/${memberId}/detail`, { params: { history_page_token: nextToken } })
+      setHistory(h => h.concat(res.data.history || []))
+      setNextToken(res.data.next_history_page_token || '')
+    } catch (err) {
+      console.error(err)
+      setError('Failed to load borrowing history')
+    }
+  }
+
   async function returnBook(borrowingId) {
     if (!window.confirm('Return this book?')) return
     try {
@@ -42,7 +49,8 @@ export default function MemberDetail({ memberId, onBack }) {
 
   if (loading) return <div>Loading...</div>
   if (error) return <Message type="error">{error}</Message>
-  if (!member) return <div>Member not found</div>
+  if (!detail || !detail.member) return <div>Member not found</div>
+  const member = detail.member
 
   function fmt(d) {
     if (!d) return ''
@@ -58,22 +66,37 @@ export default function MemberDetail({ memberId, onBack }) {
       <div><strong>Phone:</strong> {member.phone || '—'}</div>
       <div><strong>Address:</strong> {member.address || '—'}</div>
 
+      <div><strong>Loans:</strong> {detail.active_count} active, {detail.overdue_count} overdue, {detail.lifetime_count} total</div>
+
+      <h3>Current Loans</h3>
+      {(detail.active || []).length === 0 ? <div>No active loans.</div> : (
+        <table>
+          <thead><tr><th>ID</th><th>Book</th><th>Borrowed At</th><th>Due At</th><th>Action</th></tr></thead>
+          <tbody>
+            {detail.active.map(l => (
+              <tr key={l.borrowing.id}>
+                <td>{l.borrowing.id}</td><td>{l.book.title} (id:{l.book.id})</td><td>{fmt(l.borrowing.borrowed_at)}</td><td>{fmt(l.borrowing.due_at)}</td>
+                <td><button onClick={() => returnBook(l.borrowing.id)}>Return</button></td>
+              </tr>
+            ))}
+          </tbody>
+        </table>
+      )}
+
       <h3>Borrowing History</h3>
-      {borrowings.length === 0 ? <div>No borrowings found.</div> : (
+      {history.length === 0 ? <div>No borrowings found.</div> : (
         <table>
-          <thead><tr><th>ID</th><th>Book ID</th><th>Status</th><th>Borrowed At</th><th>Returned At</th><th>Action</th></tr></thead>
+          <thead><tr><th>ID</th><th>Book</th><th>Status</th><th>Borrowed At</th><th>Returned At</th></tr></thead>
           <tbody>
-            {borrowings.map(b => (
-              <tr key={b.id}>
-                <td>{b.id}</td><td>{b.book_id}</td><td>{b.status}</td><td>{fmt(b.borrowed_at)}</td><td>{fmt(b.returned_at)}</td>
-                <td>
-                  {b.status === 'BORROWED' && <button onClick={() => returnBook(b.id)}>Return</button>}
-                </td>
+            {history.map(l => (
+              <tr key={l.borrowing.id}>
+                <td>{l.borrowing.id}</td><td>{l.book.title} (id:{l.book.id})</td><td>{l.borrowing.status}</td><td>{fmt(l.borrowing.borrowed_at)}</td><td>{fmt(l.borrowing.returned_at)}</td>
               </tr>
             ))}
           </tbody>
         </table>
       )}
+      {nextToken && <button onClick={loadMoreHistory}>Load more</button>}
     </div>
   )
 }
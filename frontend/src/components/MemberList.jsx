@@ -5,6 +5,7 @@ import Message from './Message'
 // Displays a list of members and basic contact info
 export default function MemberList({ onCreate, onSelect }) {
   const [members, setMembers] = useState([])
+  const [nextToken, setNextToken] = useState('')
   const [loading, setLoading] = useState(true)
   const [error, setError] = useState('')
 
@@ -18,7 +19,8 @@ export default function MemberList({ onCreate, onSelect }) {
     setError('')
     try {
       const res = await api.get('/members')
-      setMembers(res.data)
+      setMembers(res.data.members)
+      setNextToken(res.data.next_page_token || '')
     } catch (e) {
       console.error('Failed to fetch members', e)
       setMembers([])
@@ -28,6 +30,17 @@ export default function MemberList({ onCreate, onSelect }) {
     }
   }
 
+  async function loadMoreMembers() {
+    try {
+      const res = await api.get('/members', { params: { page_token: nextToken } })
+      setMembers(m => m.concat(res.data.members))
+      setNextToken(res.data.next_page_token || '')
+    } catch (e) {
+      console.error('Failed to fetch members', e)
+      setError('Failed to load members')
+    }
+  }
+
   async function deleteMember(id, e) {
     e.stopPropagation() // prevent row click
     if (!window.confirm('Are you sure you want to delete this member?')) return
@@ -93,6 +106,7 @@ export default function MemberList({ onCreate, onSelect }) {
           )
         )
       )}
+      {!loading && !error && nextToken && <button onClick={loadMoreMembers}>Load more</button>}
 
       {editingMember && (
         <div className="modal-backdrop" onClick={() => setEditingMember(null)}>
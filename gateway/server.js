@@ -1,13 +1,90 @@
 const express = require('express');
 const bodyParser = require('body-parser');
+const zlib = require('zlib');
 const { client, grpc } = require('./api_client');
 const app = express();
 const cors = require('cors');
 app.use(cors());
 app.use(bodyParser.json());
 
+// JSON bodies of at least COMPRESS_MIN_BYTES are sent gzip- or
+// deflate-encoded, whichever the browser's Accept-Encoding prefers. Compression
+// runs off the event loop. (The gRPC hop to the server is compressed by the
+// server for clients that accept it, which grpc-js does by default.)
+const COMPRESS_MIN_BYTES = Number(process.env.COMPRESS_MIN_BYTES || 4096);
+const ENCODERS = { gzip: zlib.gzip, deflate: zlib.deflate };
+app.use((req, res, next) => {
+  res.json = (body) => {
+    const text = JSON.stringify(body);
+    res.vary('Accept-Encoding');
+    res.type('json');
+    const encoding = Buffer.byteLength(text) >= COMPRESS_MIN_BYTES && req.acceptsEncodings('gzip', 'deflate');
+    if (!encoding) return res.send(text);
+    ENCODERS[encoding](text, (err, encoded) => {
+      if (err) return res.send(text);
+      res.set('Content-Encoding', encoding);
+      res.send(encoded);
+    });
+    return res;
+  };
+  next();
+});
+
+// ?fields=id,title,author becomes the RPC's read_mask: only those fields (and
+// id) are read and returned.
+function readMask(req) {
+  const fields = (req.query && req.query.fields) || '';
+  return { paths: fields.split(',').map((f) => f.trim()).filter(Boolean) };
+}
+
+function sendError(res, err) {
+  const status = (err.code === grpc.status.INVALID_ARGUMENT) ? 400 : 500;
+  res.status(status).json({ error: err.details || err.message });
+}
+
+// List endpoints answer with an ETag carrying the server's table version; a
+// matching If-None-Match is forwarded as if_version so unchanged lists cost a
+// 304 instead of a full re-download. Lists are paged: ?page_size= (server
+// default 100, at most 1000) and ?page_token= from the previous page's
+// next_page_token, which is empty on the last page.
+function conditionalList(method, table, field, filters = () => ({})) {
+  return (req, res) => {
+    const q = req.query || {};
+    const match = (req.get('If-None-Match') || '').match(new RegExp(`"${table}-(\\d+)"`));
+    client[method]({
+      ...filters(req),
+      page_size: Number(q.page_size) || 0,
+      page_token: q.page_token || '',
+      if_version: match ? match[1] : 0,
+      read_mask: readMask(req),
+    }, (err, response) => {
+      if (err) return sendError(res, err);
+      res.set('ETag', `"${table}-${String(response.version)}"`);
+      res.set('Cache-Control', 'no-cache');
+      if (response.not_modified) return res.status(304).end();
+      res.json({ [field]: response[field], next_page_token: response.next_page_token });
+    });
+  };
+}
+
+// ?available=true lists only books that are not on loan.
+function bookFilters(req) {
+  const available = (req.query && req.query.available) || '';
+  return { available_only: ['1', 'true'].includes(available.toLowerCase()) };
+}
+
 // Books
-app.get('/books', (req, res) => client.ListBooks({}, (err, response) => err ? res.status(500).json(err) : res.json(response.books)));
+app.get('/books', conditionalList('ListBooks', 'books', 'books', bookFilters));
+app.get('/books/search', (req, res) => {
+  const q = req.query || {};
+  client.SearchBooks({ query: q.q || '', page_size: Number(q.page_size) || 0, page_token: q.page_token || '' }, (err, response) => {
+    if (err) {
+      const status = (err.code === grpc.status.INVALID_ARGUMENT) ? 400 : 500;
+      return res.status(status).json({ error: err.details || err.message });
+    }
+    res.json({ books: response.books, next_page_token: response.next_page_token });
+  });
+});
 app.post('/books', (req, res) => client.CreateBook({ book: req.body }, (err, response) => {
   if (err) {
     const status = (err.code === grpc.status.ALREADY_EXISTS) ? 409 : 500;
@@ -39,8 +116,8 @@ app.delete('/books/:id', (req, res) => {
 });
 
 // Members
-app.get('/members', (req, res) => client.ListMembers({}, (err, response) => err ? res.status(500).json(err) : res.json(response.members)));
-app.get('/members/:id', (req, res) => client.GetMember({ id: Number(req.params.id) }, (err, response) => err ? res.status(500).json(err) : res.json(response.member)));
+app.get('/members', conditionalList('ListMembers', 'members', 'members'));
+app.get('/members/:id', (req, res) => client.GetMember({ id: Number(req.params.id), read_mask: readMask(req) }, (err, response) => err ? sendError(res, err) : res.json(response.member)));
 app.post('/members', (req, res) => client.CreateMember({ member: req.body }, (err, response) => {
   if (err) {
     const status = (err.code === grpc.status.ALREADY_EXISTS) ? 409 : 500;
@@ -71,8 +148,18 @@ app.delete('/members/:id', (req, res) => {
     }
   });
 });
+app.get('/members/:id/detail', (req, res) => {
+  const q = req.query || {};
+  client.GetMemberDetail({ member_id: Number(req.params.id), history_page_size: Number(q.history_page_size) || 0, history_page_token: q.history_page_token || '' }, (err, response) => {
+    if (err) {
+      const status = (err.code === grpc.status.NOT_FOUND) ? 404 : (err.code === grpc.status.INVALID_ARGUMENT ? 400 : 500);
+      return res.status(status).json({ error: err.details || err.message });
+    }
+    res.json(response);
+  });
+});
 app.get('/members/:id/borrowed', (req, res) => {
-  client.ListBorrowedByMember({ member_id: Number(req.params.id) }, (err, response) => err ? res.status(500).json(err) : res.json(response.borrowings));
+  client.ListBorrowedByMember({ member_id: Number(req.params.id), read_mask: readMask(req) }, (err, response) => err ? sendError(res, err) : res.json(response.borrowings));
 });
 
 // Borrow/Return
@@ -86,5 +173,36 @@ app.post('/borrow', (req, res) => {
 app.post('/return', (req, res) => {
   client.ReturnBook({ borrowing_id: req.body.borrowing_id }, (err, response) => err ? res.status(400).json({ error: err.details }) : res.json(response.borrowing));
 });
+// Batch checkout/return: one gRPC call per scanned stack, per-item statuses in request order.
+app.post('/borrow/batch', (req, res) => {
+  const b = req.body || {};
+  client.BorrowBooks({ member_id: b.member_id, book_ids: b.book_ids || [] }, (err, response) => {
+    if (err) return res.status(err.code === grpc.status.NOT_FOUND ? 404 : 400).json({ error: err.details || err.message });
+    res.json(response.results);
+  });
+});
+app.post('/return/batch', (req, res) => {
+  client.ReturnBooks({ borrowing_ids: (req.body || {}).borrowing_ids || [] }, (err, response) => err ? res.status(400).json({ error: err.details || err.message }) : res.json(response.results));
+});
+
+// Borrow/return events as Server-Sent Events. EventSource reconnects with
+// Last-Event-ID, which resumes the feed without a re-list.
+app.get('/borrowings/events', (req, res) => {
+  const q = req.query || {};
+  const call = client.WatchBorrowings({
+    member_id: Number(q.member_id) || 0,
+    book_id: Number(q.book_id) || 0,
+    after_event_id: req.get('Last-Event-ID') || q.after_event_id || 0,
+  });
+  res.set({ 'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache', Connection: 'keep-alive' });
+  res.flushHeaders();
+  call.on('data', (event) => res.write(`id: ${String(event.id)}\nevent: ${event.type}\ndata: ${JSON.stringify(event)}\n\n`));
+  call.on('error', (err) => {
+    if (err.code !== grpc.status.CANCELLED) res.write(`event: error\ndata: ${JSON.stringify({ error: err.details || err.message })}\n\n`);
+    res.end();
+  });
+  call.on('end', () => res.end());
+  req.on('close', () => call.cancel());
+});
 
 app.listen(8080, () => console.log('Gateway listening on 8080'));
@@ -0,0 +1,377 @@
+"""Opt-in asyncio server (GRPC_ASYNC=1).
+
+Hot RPCs run as coroutines on the psycopg3 async pool, so the number of
+in-flight requests is bounded by DB_MAXCONN instead of a thread count. RPCs
+without an async port (bulk imports) keep their synchronous implementation and
+run on the migration thread pool against the regular psycopg2 pool.
+"""
+import asyncio
+import os
+from concurrent import futures
+from datetime import datetime, timezone
+import grpc
+import psycopg.errors
+import psycopg_pool
+from grpc_health.v1 import health as grpc_health, health_pb2_grpc
+from server.app import (LibraryServicer, logger, DATABASE_URL, GRPC_MAX_QUEUE, LIBRARY_SERVICE, LIST_DEFAULT_PAGE_SIZE,
+                        MEMBER_HISTORY_PAGE_SIZE, SEARCH_DEFAULT_PAGE_SIZE, SERVER_OPTIONS, _publish_stats, _serving_status,
+                        _start_health_app, _timestamp_or_none)
+from server.db import init_pool as init_sync_pool, PoolTimeout
+from server.interceptors import compressed_methods, compression_options, method_limits
+from server.pagination import (clamp_page_size, decode_due_token, decode_page_token, decode_rank_token, encode_due_token,
+                               next_page_token, next_rank_token)
+import server.aio.db as aio_db
+from server.aio.interceptors import AsyncAdmissionInterceptor, AsyncCompressionInterceptor, AsyncMetricsInterceptor
+import server.aio.books as books_svc
+import server.aio.members as members_svc
+import server.aio.borrowings as borrows_svc
+import server.cache as entity_cache
+import server.convert as convert
+import server.events as events
+import server.health as health_monitor
+import server.validators as validators
+import library_pb2, library_pb2_grpc
+
+class AsyncLibraryServicer(LibraryServicer):
+    overload_errors = (PoolTimeout, psycopg_pool.PoolTimeout)
+    deadline_errors = LibraryServicer.deadline_errors + (psycopg.errors.QueryCanceled,)
+
+    async def CreateBook(self, request, context):
+        try:
+            data = { 'title': request.book.title, 'author': request.book.author, 'isbn': request.book.isbn, 'publisher': request.book.publisher }
+            val = validators.BookCreate(**data)
+            row = await books_svc.create_book(val.dict())
+            return library_pb2.CreateBookResponse(book=self._row_to_book(row))
+        except ValueError as e:
+            if str(e) == 'ALREADY_EXISTS':
+                context.set_code(grpc.StatusCode.ALREADY_EXISTS); context.set_details('Book already exists (ISBN check)'); return library_pb2.CreateBookResponse()
+            logger.exception('CreateBook failed')
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.CreateBookResponse()
+        except Exception as e:
+            logger.exception('CreateBook failed')
+            self._fail(context, e, grpc.StatusCode.INVALID_ARGUMENT); return library_pb2.CreateBookResponse()
+
+    async def UpdateBook(self, request, context):
+        try:
+            data = { 'id': request.book.id, 'title': request.book.title, 'author': request.book.author, 'isbn': request.book.isbn, 'publisher': request.book.publisher }
+            val = validators.BookUpdate(**data)
+            row = await books_svc.update_book(val.dict())
+            if not row:
+                context.set_code(grpc.StatusCode.NOT_FOUND); context.set_details('Book not found'); return library_pb2.UpdateBookResponse()
+            return library_pb2.UpdateBookResponse(book=self._row_to_book(row))
+        except ValueError as e:
+            if str(e) == 'ALREADY_EXISTS':
+                context.set_code(grpc.StatusCode.ALREADY_EXISTS); context.set_details('Book with this ISBN already exists'); return library_pb2.UpdateBookResponse()
+            logger.exception('UpdateBook failed'); context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.UpdateBookResponse()
+        except Exception as e:
+            logger.exception('UpdateBook failed')
+            self._fail(context, e, grpc.StatusCode.INVALID_ARGUMENT); return library_pb2.UpdateBookResponse()
+
+    async def DeleteBook(self, request, context):
+        try:
+            deleted = await books_svc.delete_book(request.book_id)
+            if not deleted:
+                context.set_code(grpc.StatusCode.NOT_FOUND); context.set_details('Book not found'); return library_pb2.DeleteBookResponse(success=False, message='Not found')
+            return library_pb2.DeleteBookResponse(success=True, message='Deleted')
+        except Exception as e:
+            if str(e) == 'CANNOT_DELETE_BORROWED':
+                context.set_code(grpc.StatusCode.FAILED_PRECONDITION)
+                context.set_details('Cannot delete book that is currently borrowed')
+                return library_pb2.DeleteBookResponse(success=False, message='Book is borrowed')
+            logger.exception('DeleteBook failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL); return library_pb2.DeleteBookResponse(success=False, message=str(e))
+
+    async def CreateMember(self, request, context):
+        try:
+            data = {'name': request.member.name, 'email': request.member.email, 'phone': request.member.phone, 'address': request.member.address}
+            val = validators.MemberCreate(**data)
+            row = await members_svc.create_member(val.dict())
+            return library_pb2.CreateMemberResponse(member=self._row_to_member(row))
+        except ValueError as e:
+            if str(e) == 'ALREADY_EXISTS':
+                context.set_code(grpc.StatusCode.ALREADY_EXISTS); context.set_details('Member already exists (Email/Phone check)'); return library_pb2.CreateMemberResponse()
+            logger.exception('CreateMember failed'); context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.CreateMemberResponse()
+        except Exception as e:
+            logger.exception('CreateMember failed')
+            self._fail(context, e, grpc.StatusCode.INVALID_ARGUMENT); return library_pb2.CreateMemberResponse()
+
+    async def UpdateMember(self, request, context):
+        try:
+            data = {'id': request.member.id, 'name': request.member.name, 'email': request.member.email, 'phone': request.member.phone, 'address': request.member.address}
+            val = validators.MemberUpdate(**data)
+            row = await members_svc.update_member(val.dict())
+            if not row:
+                context.set_code(grpc.StatusCode.NOT_FOUND); context.set_details('Member not found'); return library_pb2.UpdateMemberResponse()
+            return library_pb2.UpdateMemberResponse(member=self._row_to_member(row))
+        except ValueError as e:
+            if str(e) == 'ALREADY_EXISTS':
+                context.set_code(grpc.StatusCode.ALREADY_EXISTS); context.set_details('Member email/phone already exists'); return library_pb2.UpdateMemberResponse()
+            logger.exception('UpdateMember failed'); context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.UpdateMemberResponse()
+        except Exception as e:
+            logger.exception('UpdateMember failed')
+            self._fail(context, e, grpc.StatusCode.INVALID_ARGUMENT); return library_pb2.UpdateMemberResponse()
+
+    async def DeleteMember(self, request, context):
+        try:
+            deleted = await members_svc.delete_member(request.member_id)
+            if not deleted:
+                context.set_code(grpc.StatusCode.NOT_FOUND); context.set_details('Member not found'); return library_pb2.DeleteMemberResponse(success=False)
+            return library_pb2.DeleteMemberResponse(success=True)
+        except Exception as e:
+            if str(e) == 'CANNOT_DELETE_MEMBER_WITH_BORROWINGS':
+                context.set_code(grpc.StatusCode.FAILED_PRECONDITION)
+                context.set_details('Cannot delete member with active borrowings')
+                return library_pb2.DeleteMemberResponse(success=False)
+            logger.exception('DeleteMember failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL); return library_pb2.DeleteMemberResponse(success=False)
+
+    async def BorrowBook(self, request, context):
+        try:
+            val = validators.BorrowRequest(book_id=request.book_id, member_id=request.member_id, due_at=_timestamp_or_none(request, 'due_at'))
+            row, err = await borrows_svc.borrow_book(val.book_id, val.member_id, val.due_at)
+            if err:
+                if err == 'BOOK_NOT_FOUND': context.set_code(grpc.StatusCode.NOT_FOUND); context.set_details('Book not found'); return library_pb2.BorrowBookResponse()
+                if err == 'MEMBER_NOT_FOUND': context.set_code(grpc.StatusCode.NOT_FOUND); context.set_details('Member not found'); return library_pb2.BorrowBookResponse()
+                if err == 'ALREADY_BORROWED': context.set_code(grpc.StatusCode.FAILED_PRECONDITION); context.set_details('Book already borrowed'); return library_pb2.BorrowBookResponse()
+            return library_pb2.BorrowBookResponse(borrowing=self._row_to_borrowing(row))
+        except Exception as e:
+            logger.exception('BorrowBook failed')
+            self._fail(context, e, grpc.StatusCode.INVALID_ARGUMENT); return library_pb2.BorrowBookResponse()
+
+    async def ReturnBook(self, request, context):
+        try:
+            val = validators.ReturnRequest(borrowing_id=request.borrowing_id)
+            row, err = await borrows_svc.return_book(val.borrowing_id)
+            if err:
+                if err == 'NOT_FOUND': context.set_code(grpc.StatusCode.NOT_FOUND); context.set_details('Borrowing not found'); return library_pb2.ReturnBookResponse()
+                if err == 'ALREADY_RETURNED': context.set_code(grpc.StatusCode.FAILED_PRECONDITION); context.set_details('Already returned'); return library_pb2.ReturnBookResponse()
+            return library_pb2.ReturnBookResponse(borrowing=self._row_to_borrowing(row))
+        except Exception as e:
+            logger.exception('ReturnBook failed')
+            self._fail(context, e, grpc.StatusCode.INVALID_ARGUMENT); return library_pb2.ReturnBookResponse()
+
+    async def BorrowBooks(self, request, context):
+        try:
+            if len(request.book_ids) > borrows_svc.MAX_BATCH_ITEMS:
+                context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(f'At most {borrows_svc.MAX_BATCH_ITEMS} books per batch'); return library_pb2.BorrowBooksResponse()
+            results, err = await borrows_svc.borrow_books(request.member_id, request.book_ids, _timestamp_or_none(request, 'due_at'))
+            if err == 'MEMBER_NOT_FOUND':
+                context.set_code(grpc.StatusCode.NOT_FOUND); context.set_details('Member not found'); return library_pb2.BorrowBooksResponse()
+            return self._batch_response(library_pb2.BorrowBooksResponse, results)
+        except Exception as e:
+            logger.exception('BorrowBooks failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL); return library_pb2.BorrowBooksResponse()
+
+    async def ReturnBooks(self, request, context):
+        try:
+            if len(request.borrowing_ids) > borrows_svc.MAX_BATCH_ITEMS:
+                context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(f'At most {borrows_svc.MAX_BATCH_ITEMS} borrowings per batch'); return library_pb2.ReturnBooksResponse()
+            return self._batch_response(library_pb2.ReturnBooksResponse, await borrows_svc.return_books(request.borrowing_ids))
+        except Exception as e:
+            logger.exception('ReturnBooks failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL); return library_pb2.ReturnBooksResponse()
+
+    async def ListBorrowedByMember(self, request, context):
+        try:
+            columns, rows = await borrows_svc.list_borrowed_by_member(request.member_id, convert.BORROWING.fields(request.read_mask))
+            resp = library_pb2.ListBorrowedByMemberResponse()
+            convert.BORROWING.extend(resp.borrowings, columns, rows)
+            return resp
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.ListBorrowedByMemberResponse()
+        except Exception as e:
+            logger.exception('ListBorrowedByMember failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL); return library_pb2.ListBorrowedByMemberResponse()
+
+    async def ListBooks(self, request, context):
+        try:
+            page_size = clamp_page_size(request.page_size) or LIST_DEFAULT_PAGE_SIZE
+            version, columns, rows = await books_svc.list_books(page_size, decode_page_token(request.page_token), request.if_version,
+                                                               convert.BOOK.fields(request.read_mask), request.available_only)
+            if rows is None:
+                return library_pb2.ListBooksResponse(version=version, not_modified=True)
+            resp = library_pb2.ListBooksResponse(next_page_token=next_page_token(columns, rows, page_size), version=version)
+            convert.BOOK.extend(resp.books, columns, rows)
+            return resp
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.ListBooksResponse()
+        except Exception as e:
+            logger.exception('ListBooks failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL); return library_pb2.ListBooksResponse()
+
+    async def ListMembers(self, request, context):
+        try:
+            page_size = clamp_page_size(request.page_size) or LIST_DEFAULT_PAGE_SIZE
+            version, columns, rows = await members_svc.list_members(page_size, decode_page_token(request.page_token), request.if_version,
+                                                                   convert.MEMBER.fields(request.read_mask))
+            if rows is None:
+                return library_pb2.ListMembersResponse(version=version, not_modified=True)
+            resp = library_pb2.ListMembersResponse(next_page_token=next_page_token(columns, rows, page_size), version=version)
+            convert.MEMBER.extend(resp.members, columns, rows)
+            return resp
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.ListMembersResponse()
+        except Exception as e:
+            logger.exception('ListMembers failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL); return library_pb2.ListMembersResponse()
+
+    async def SearchBooks(self, request, context):
+        try:
+            page_size = clamp_page_size(request.page_size) or SEARCH_DEFAULT_PAGE_SIZE
+            columns, rows = await books_svc.search_books(request.query, page_size, decode_rank_token(request.page_token))
+            resp = library_pb2.SearchBooksResponse(next_page_token=next_rank_token(columns, rows, page_size))
+            convert.BOOK.extend(resp.books, columns, rows)
+            return resp
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.SearchBooksResponse()
+        except Exception as e:
+            logger.exception('SearchBooks failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL); return library_pb2.SearchBooksResponse()
+
+    async def StreamBooks(self, request, context):
+        try:
+            async for columns, rows in books_svc.stream_books():
+                for book in convert.BOOK.messages(columns, rows):
+                    yield book
+        except Exception as e:
+            logger.exception('StreamBooks failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL)
+
+    async def StreamMembers(self, request, context):
+        try:
+            async for columns, rows in members_svc.stream_members():
+                for member in convert.MEMBER.messages(columns, rows):
+                    yield member
+        except Exception as e:
+            logger.exception('StreamMembers failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL)
+
+    async def ListOverdue(self, request, context):
+        try:
+            page_size = clamp_page_size(request.page_size)
+            after = decode_due_token(request.page_token)
+            as_of = _timestamp_or_none(request, 'as_of') or datetime.now(timezone.utc)
+            # one chunk is held back so the page token can ride on the final one
+            pending, sent = None, 0
+            async for columns, rows in borrows_svc.list_overdue(as_of, request.member_id, after, page_size):
+                if pending is not None:
+                    yield pending
+                pending = library_pb2.ListOverdueResponse()
+                convert.BORROWING.extend(pending.borrowings, columns, rows)
+                sent += len(rows)
+                last = rows[-1]
+                last_key = (last[columns.index('due_at')], last[columns.index('id')])
+            if pending is None:
+                return
+            if page_size and sent == page_size:
+                pending.next_page_token = encode_due_token(*last_key)
+            yield pending
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e))
+        except Exception as e:
+            logger.exception('ListOverdue failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL)
+
+    async def WatchBorrowings(self, request, context):
+        sub = events.feed.subscribe(events.AsyncSubscription(asyncio.get_running_loop(), request.member_id, request.book_id))
+        try:
+            # subscribed before replaying, so nothing committed in between is lost;
+            # events that are both replayed and delivered live are sent once
+            replayed = events.ReplayedIds()
+            after_id = events.replay_start(request.after_event_id)
+            while request.after_event_id:
+                batch = await borrows_svc.events_after(after_id, request.member_id, request.book_id)
+                for event in batch:
+                    replayed.add(event['id'])
+                    yield convert.borrowing_event(event)
+                if len(batch) < events.REPLAY_BATCH_SIZE:
+                    break
+                after_id = batch[-1]['id']
+            while True:
+                event = await sub.aget()
+                if sub.closed:
+                    context.set_code(grpc.StatusCode.UNAVAILABLE); context.set_details(f'Subscription closed ({sub.closed}); resume with after_event_id'); return
+                if event is None or event['id'] in replayed:
+                    continue
+                yield convert.borrowing_event(event)
+        except Exception as e:
+            logger.exception('WatchBorrowings failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL)
+        finally:
+            events.feed.unsubscribe(sub)
+
+    async def GetMemberDetail(self, request, context):
+        try:
+            history_limit = clamp_page_size(request.history_page_size) or MEMBER_HISTORY_PAGE_SIZE
+            row = await members_svc.get_member_detail(request.member_id, history_limit, decode_page_token(request.history_page_token))
+            if not row:
+                context.set_code(grpc.StatusCode.NOT_FOUND); context.set_details('Member not found'); return library_pb2.GetMemberDetailResponse()
+            return self._member_detail_response(row, history_limit)
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.GetMemberDetailResponse()
+        except Exception as e:
+            logger.exception('GetMemberDetail failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL); return library_pb2.GetMemberDetailResponse()
+
+    async def GetMember(self, request, context):
+        try:
+            fields = convert.MEMBER.fields(request.read_mask)
+            r = await members_svc.get_member(request.id, fields)
+            if not r:
+                context.set_code(grpc.StatusCode.NOT_FOUND); context.set_details('Member not found'); return library_pb2.GetMemberResponse()
+            return library_pb2.GetMemberResponse(member=convert.MEMBER.from_dict(r, fields))
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.GetMemberResponse()
+        except Exception as e:
+            logger.exception('GetMember failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL); return library_pb2.GetMemberResponse()
+
+async def serve():
+    # small psycopg2 pool for the health endpoint and RPCs without an async port;
+    # opened first so the async pool can share its replica monitor
+    init_sync_pool(minconn=1, maxconn=int(os.environ.get('DB_SYNC_MAXCONN', 2)))
+    maxconn = int(os.environ.get('DB_MAXCONN', 20))
+    await aio_db.init_pool(DATABASE_URL, minconn=int(os.environ.get('DB_MINCONN', 1)), maxconn=maxconn)
+    if entity_cache.SHARED_INVALIDATION:
+        entity_cache.start_invalidation_listener(DATABASE_URL)
+    events.feed.start(DATABASE_URL)
+    # in-flight RPCs are bounded by the pool rather than threads: admit one per
+    # connection plus the queue, and give bulk calls at most half the pool
+    interceptors = [AsyncMetricsInterceptor(), AsyncAdmissionInterceptor(method_limits(max(1, maxconn // 2)))]
+    options = SERVER_OPTIONS
+    if compressed_methods():
+        interceptors.append(AsyncCompressionInterceptor(compressed_methods()))
+        options = options + compression_options()
+    server = grpc.aio.server(migration_thread_pool=futures.ThreadPoolExecutor(max_workers=int(os.environ.get('DB_SYNC_MAXCONN', 2))),
+                             interceptors=interceptors, options=options, maximum_concurrent_rpcs=maxconn + GRPC_MAX_QUEUE)
+    library_pb2_grpc.add_LibraryServiceServicer_to_server(AsyncLibraryServicer(), server)
+    health_servicer = grpc_health.aio.HealthServicer()
+    health_pb2_grpc.add_HealthServicer_to_server(health_servicer, server)
+    loop = asyncio.get_running_loop()
+
+    async def publish(ready):
+        for service in ('', LIBRARY_SERVICE):
+            await health_servicer.set(service, _serving_status(ready))
+
+    await publish(False)
+    # no executor to saturate here: requests wait on the async pool instead
+    health_monitor.start(DATABASE_URL, pools=('db_async',),
+                         on_change=lambda ready: asyncio.run_coroutine_threadsafe(publish(ready), loop),
+                         publish=_publish_stats())
+    port = os.environ.get('GRPC_PORT', '50051')
+    server.add_insecure_port(f'[::]:{port}')
+    _start_health_app()
+    await server.start()
+    logger.info('gRPC aio server started', extra={'port': port})
+    try:
+        await server.wait_for_termination()
+    finally:
+        await health_servicer.enter_graceful_shutdown()
+        await server.stop(0)
+        await aio_db.close_pool()
+
+def main():
+    asyncio.run(serve())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""asyncio counterparts of server.services.books for the grpc.aio server."""
+from psycopg import IntegrityError
+from psycopg.rows import dict_row
+from server.aio.db import get_conn
+from server.aio.group_commit import AsyncWriteBatcher
+from server.db import column_names, mark_written
+from server.services.catalog import VERSION_SQL
+from server.logger import get_logger
+from server.services.books import (AVAILABLE, BOOK_COLUMNS, BY_ID, CREATE, DELETE, LIST_SQL, SEARCH, STREAM_BATCH_SIZE, STREAM_SQL,
+                                   UPDATE, _search_params, version_tables)
+import server.cache as cache
+
+logger = get_logger('books_service')
+
+CREATE_BATCHER = AsyncWriteBatcher('create_book')
+
+async def _insert_book(cur, data):
+    await cur.execute(CREATE.sql, (data.get('isbn'), data['title'], data.get('author'), data.get('publisher'), data.get('published_date')))
+    return await cur.fetchone()
+
+async def create_book(data):
+    try:
+        row = await CREATE_BATCHER.run(_insert_book, data, key=data.get('isbn') or '')
+    except IntegrityError:
+        logger.warning('create_book_duplicate', extra={'isbn': data.get('isbn')})
+        raise ValueError('ALREADY_EXISTS')
+    except Exception:
+        logger.exception('create_book_failed')
+        raise
+    mark_written('books')
+    logger.info('book_created', extra={'book_id': row['id']})
+    return row
+
+async def update_book(data):
+    async with get_conn() as conn:
+        try:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(UPDATE.sql, (data.get('isbn'), data['title'], data.get('author'), data.get('publisher'), data.get('published_date'), data['id']))
+                row = await cur.fetchone()
+                if row:
+                    await cache.anotify_invalidation(cur, 'books', row['id'])
+            if row:
+                await conn.commit()
+                mark_written('books', f"book:{row['id']}")
+                cache.books.invalidate(row['id'])
+                logger.info('book_updated', extra={'book_id': row['id']})
+                return row
+            await conn.rollback()
+            return None
+        except IntegrityError:
+            await conn.rollback()
+            logger.warning('update_book_duplicate', extra={'isbn': data.get('isbn')})
+            raise ValueError('ALREADY_EXISTS')
+        except Exception:
+            await conn.rollback()
+            logger.exception('update_book_failed')
+            raise
+
+async def delete_book(book_id):
+    async with get_conn() as conn:
+        try:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(AVAILABLE.sql, (book_id,))
+                book = await cur.fetchone()
+                if book and not book['available']:
+                    raise ValueError('CANNOT_DELETE_BORROWED')
+                await cur.execute(DELETE.sql, (book_id,))
+                row = await cur.fetchone()
+                if row:
+                    await cache.anotify_invalidation(cur, 'books', book_id)
+            if row:
+                await conn.commit()
+                mark_written('books', f'book:{book_id}')
+                cache.books.invalidate(book_id)
+                logger.info('book_deleted', extra={'book_id': book_id})
+                return True
+            await conn.rollback()
+            return False
+        except ValueError:
+            await conn.rollback()
+            raise
+        except Exception:
+            await conn.rollback()
+            logger.exception('delete_book_failed')
+            raise
+
+async def _fetch_book(book_id):
+    async with get_conn(readonly=True, scopes=(f'book:{book_id}',)) as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute(BY_ID.sql, (book_id,))
+            return await cur.fetchone()
+
+async def get_book(book_id):
+    return await cache.books.aload(book_id, lambda: _fetch_book(book_id))
+
+async def list_books(page_size=0, after_id=0, if_version=0, fields=None, available_only=False):
+    columns = BOOK_COLUMNS if fields is None else ', '.join(fields)
+    async with get_conn(readonly=True, scopes=('books',)) as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(VERSION_SQL, (list(version_tables(fields, available_only)),))
+            version = (await cur.fetchone())[0] or 0
+            if if_version and if_version == version:
+                return version, None, None
+            _, template = LIST_SQL[bool(page_size), available_only]
+            await cur.execute(template.format(columns=columns), (after_id, page_size) if page_size else None)
+            return version, column_names(cur), await cur.fetchall()
+
+async def stream_books(batch_size=STREAM_BATCH_SIZE):
+    async with get_conn(readonly=True, scopes=('books',)) as conn:
+        try:
+            async with conn.cursor(name='stream_books') as cur:
+                await cur.execute(STREAM_SQL)
+                while True:
+                    rows = await cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield column_names(cur), rows
+        finally:
+            await conn.rollback()
+
+async def search_books(query, limit, after=None):
+    async with get_conn(readonly=True, scopes=('books',)) as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(SEARCH.sql, _search_params(query, limit, after))
+            return column_names(cur), await cur.fetchall()
@@ -0,0 +1,140 @@
+"""asyncio counterparts of server.services.borrowings for the grpc.aio server."""
+from psycopg.errors import ForeignKeyViolation
+from psycopg.rows import dict_row
+from server.aio.db import get_conn
+from server.aio.group_commit import AsyncWriteBatcher
+import server.cache as cache
+from server.db import column_names, mark_written
+from server.logger import get_logger
+from server.services.borrowings import (BORROW_SQL, BORROW_BATCH_SQL, BORROWED_BY_MEMBER_SQL, BORROWING_BY_ID, MAX_BATCH_ITEMS,
+                                       OVERDUE_BATCH_SIZE, RETURN_BATCH_SQL, RETURN_SQL, _availability_changed, _batch_results,
+                                       _borrow_result, _missing, _overdue_query)
+from server.events import REPLAY_BATCH_SIZE, REPLAY_SQL, parse_event, replay_params
+
+logger = get_logger('borrowings_service')
+
+BORROW_BATCHER = AsyncWriteBatcher('borrow_book')
+
+async def _borrow(cur, book_id, member_id, due_at):
+    await cur.execute(BORROW_SQL, {'book_id': book_id, 'member_id': member_id, 'due_at': due_at})
+    row, err = _borrow_result(await cur.fetchone())
+    if row:
+        await cache.anotify_invalidation(cur, 'books', book_id)
+    return row, err
+
+async def borrow_book(book_id, member_id, due_at=None):
+    try:
+        row, err = await BORROW_BATCHER.run(_borrow, book_id, member_id, due_at, key=book_id)
+    except ForeignKeyViolation as e:
+        return None, _missing(e)
+    except Exception:
+        logger.exception('borrow_book_failed')
+        raise
+    if err:
+        return None, err
+    mark_written(f'loans:{member_id}')
+    _availability_changed([book_id])
+    logger.info('book_borrowed', extra={'book_id': book_id, 'member_id': member_id})
+    return row, None
+
+async def return_book(borrowing_id):
+    async with get_conn() as conn:
+        try:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(BORROWING_BY_ID.sql, (borrowing_id,))
+                row = await cur.fetchone()
+                if not row:
+                    return None, 'NOT_FOUND'
+                if row['status'] != 'BORROWED':
+                    return None, 'ALREADY_RETURNED'
+                await cur.execute(RETURN_SQL, (borrowing_id,))
+                updated = await cur.fetchone()
+                if not updated:
+                    await conn.rollback()
+                    return None, 'ALREADY_RETURNED'
+                await cache.anotify_invalidation(cur, 'books', updated['book_id'])
+            await conn.commit()
+            mark_written(f"loans:{updated['member_id']}")
+            _availability_changed([updated['book_id']])
+            logger.info('book_returned', extra={'borrowing_id': borrowing_id})
+            return updated, None
+        except Exception:
+            await conn.rollback()
+            logger.exception('return_book_failed')
+            raise
+
+async def borrow_books(member_id, book_ids, due_at=None):
+    async with get_conn() as conn:
+        for attempt in (1, 2):
+            try:
+                async with conn.cursor(row_factory=dict_row) as cur:
+                    await cur.execute(BORROW_BATCH_SQL, {'member_id': member_id, 'book_ids': list(book_ids), 'due_at': due_at})
+                    rows = await cur.fetchall()
+                    if not rows[0]['member_found']:
+                        await conn.rollback()
+                        return None, 'MEMBER_NOT_FOUND'
+                    results = _batch_results(rows if book_ids else [], 'ALREADY_BORROWED')
+                    borrowed = [row['book_id'] for _, _, row in results if row]
+                    await cache.anotify_invalidation(cur, 'books', *borrowed)
+                await conn.commit()
+                mark_written(f'loans:{member_id}')
+                _availability_changed(borrowed)
+                logger.info('books_borrowed', extra={'member_id': member_id, 'requested': len(book_ids),
+                                                     'borrowed': sum(1 for _, status, _ in results if status == 'OK')})
+                return results, None
+            except ForeignKeyViolation:
+                await conn.rollback()
+                if attempt == 2:
+                    raise
+            except Exception:
+                await conn.rollback()
+                logger.exception('borrow_books_failed')
+                raise
+
+async def return_books(borrowing_ids):
+    async with get_conn() as conn:
+        try:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(RETURN_BATCH_SQL, {'borrowing_ids': list(borrowing_ids)})
+                results = _batch_results(await cur.fetchall(), 'ALREADY_RETURNED')
+                returned = [row['book_id'] for _, _, row in results if row]
+                await cache.anotify_invalidation(cur, 'books', *returned)
+            await conn.commit()
+            mark_written(*{f"loans:{row['member_id']}" for _, _, row in results if row})
+            _availability_changed(returned)
+            logger.info('books_returned', extra={'requested': len(borrowing_ids),
+                                                 'returned': sum(1 for _, status, _ in results if status == 'OK')})
+            return results
+        except Exception:
+            await conn.rollback()
+            logger.exception('return_books_failed')
+            raise
+
+async def list_borrowed_by_member(member_id, fields=None):
+    columns = '*' if fields is None else ', '.join(fields)
+    async with get_conn(readonly=True, scopes=(f'loans:{member_id}',)) as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(BORROWED_BY_MEMBER_SQL.format(columns=columns), (member_id,))
+            return column_names(cur), await cur.fetchall()
+
+async def list_overdue(as_of, member_id=0, after=None, limit=0, batch_size=OVERDUE_BATCH_SIZE):
+    params = {'as_of': as_of, 'member_id': member_id, 'limit': limit}
+    if after:
+        params['after_due'], params['after_id'] = after
+    async with get_conn(readonly=True) as conn:
+        try:
+            async with conn.cursor(name='list_overdue') as cur:
+                await cur.execute(_overdue_query(member_id, after, limit), params)
+                while True:
+                    rows = await cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield column_names(cur), rows
+        finally:
+            await conn.rollback()
+
+async def events_after(after_id, member_id=0, book_id=0, limit=REPLAY_BATCH_SIZE):
+    async with get_conn() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute(REPLAY_SQL, replay_params(after_id, member_id, book_id, limit))
+            return [parse_event(row) for row in await cur.fetchall()]
@@ -0,0 +1,154 @@
+import weakref
+from contextlib import asynccontextmanager
+from time import monotonic, perf_counter
+from psycopg import AsyncConnection, AsyncCursor, AsyncServerCursor, OperationalError
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+from server.db import ACQUIRE_TIMEOUT, CHECK_IDLE, MAX_LIFETIME, choose_replica, replica_set
+from server.deadlines import current as current_call, statement_timeout, timeout_to_set
+from server.metrics import DB_READS, DB_TIME, POOLS
+import server.statements as statements
+
+_pool = None
+_read_pools = {}
+_returned = weakref.WeakKeyDictionary()
+# connection -> its session statement_timeout in ms, as in server.db
+_statement_timeouts = weakref.WeakKeyDictionary()
+
+_POOL_WAIT, _QUERY, _COMMIT = (DB_TIME.labels(phase) for phase in ('pool_wait', 'query', 'commit'))
+
+class _TimedCursorMixin:
+    async def execute(self, *args, **kwargs):
+        started = perf_counter()
+        try:
+            return await super().execute(*args, **kwargs)
+        finally:
+            _QUERY.observe(perf_counter() - started)
+
+    async def executemany(self, *args, **kwargs):
+        started = perf_counter()
+        try:
+            return await super().executemany(*args, **kwargs)
+        finally:
+            _QUERY.observe(perf_counter() - started)
+
+class TimedAsyncCursor(_TimedCursorMixin, AsyncCursor):
+    pass
+
+class TimedAsyncServerCursor(_TimedCursorMixin, AsyncServerCursor):
+    pass
+
+class InstrumentedAsyncConnection(AsyncConnection):
+    """Records query and commit time in library_db_seconds like
+    server.db.InstrumentedConnection, for client and named cursors alike."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = TimedAsyncCursor
+        self.server_cursor_factory = TimedAsyncServerCursor
+
+    async def commit(self):
+        started = perf_counter()
+        try:
+            return await super().commit()
+        finally:
+            _COMMIT.observe(perf_counter() - started)
+
+async def _check(conn):
+    # same policy as the psycopg2 pool: only ping connections that sat idle
+    if monotonic() - _returned.get(conn, 0) >= CHECK_IDLE:
+        await AsyncConnectionPool.check_connection(conn)
+
+async def _stamp(conn):
+    _returned[conn] = monotonic()
+
+async def init_pool(dsn, minconn=1, maxconn=20):
+    """Open the asyncio pool. In-flight RPCs in aio mode are bounded by maxconn
+    (callers wait for a free connection) rather than by a thread count.
+    psycopg_pool already queues waiters FIFO; it shares the acquire timeout,
+    idle check and lifetime settings of the psycopg2 pool and raises
+    psycopg_pool.PoolTimeout. psycopg3 prepares statements itself; with
+    DB_PREPARE on it does so on first execution rather than the fifth.
+
+    Replicas are those of server.db.init_pool, which must run first: its
+    monitor thread supplies the lag that read routing goes by."""
+    global _pool
+    _pool = await _open_pool(dsn, minconn, maxconn)
+    POOLS['db_async'] = lambda: pool_stats(_pool)
+    replicas = replica_set()
+    for replica in (replicas.replicas if replicas else ()):
+        pool = _read_pools[replica.name] = await _open_pool(replica.dsn, 0, maxconn)
+        POOLS[f'db_async_{replica.name}'] = lambda pool=pool, replica=replica: dict(pool_stats(pool), lag_seconds=replica.lag)
+    return _pool
+
+async def _open_pool(dsn, minconn, maxconn):
+    pool = AsyncConnectionPool(dsn, min_size=minconn, max_size=maxconn, open=False, timeout=ACQUIRE_TIMEOUT,
+                               connection_class=InstrumentedAsyncConnection, max_lifetime=MAX_LIFETIME, check=_check, reset=_stamp,
+                               kwargs={'prepare_threshold': 0 if statements.ENABLED else None})
+    await pool.open()
+    return pool
+
+def pool_stats(pool):
+    """psycopg_pool statistics in the shape of server.db.ConnectionPool.stats()."""
+    s = pool.get_stats()
+    size, idle = s.get('pool_size', 0), s.get('pool_available', 0)
+    return {'maxconn': s.get('pool_max', 0), 'size': size, 'in_use': size - idle, 'idle': idle,
+            'waiting': s.get('requests_waiting', 0), 'acquired': s.get('requests_num', 0) - s.get('requests_errors', 0),
+            'timeouts': s.get('requests_errors', 0), 'created': s.get('connections_num', 0),
+            'recycled': s.get('connections_lost', 0), 'check_failed': s.get('returns_bad', 0),
+            'wait_seconds_total': s.get('requests_wait_ms', 0) / 1000}
+
+def _busy(replica):
+    s = _read_pools[replica.name].get_stats()
+    return s.get('pool_size', 0) - s.get('pool_available', 0)
+
+async def close_pool():
+    for pool in _read_pools.values():
+        await pool.close()
+    if _pool is not None:
+        await _pool.close()
+
+async def _apply_statement_timeout(conn, remaining):
+    ms = timeout_to_set(_statement_timeouts.get(conn), statement_timeout(remaining))
+    if ms is None:
+        return
+    await conn.set_autocommit(True)
+    try:
+        await conn.execute(f'SET statement_timeout = {int(ms)}')
+    finally:
+        await conn.set_autocommit(False)
+    _statement_timeouts[conn] = ms
+
+def _acquire_timeout(call):
+    remaining = call.check() if call is not None else None
+    return None if remaining is None else min(ACQUIRE_TIMEOUT, remaining)
+
+async def _acquire(readonly, scopes, call):
+    # as server.db._acquire: a replica whose pool cannot hand out a connection
+    # is marked down and the read goes to the primary
+    replica = choose_replica(scopes, busy=_busy) if readonly and _read_pools else None
+    if replica is not None:
+        pool = _read_pools[replica.name]
+        try:
+            return pool, await pool.getconn(timeout=_acquire_timeout(call))
+        except (PoolTimeout, OperationalError):
+            replica.down()
+            DB_READS.labels('primary').inc()
+    return _pool, await _pool.getconn(timeout=_acquire_timeout(call))
+
+@asynccontextmanager
+async def get_conn(readonly=False, scopes=()):
+    # Services commit/rollback explicitly; on exit the connection context
+    # commits a clean read-only transaction or rolls back after an exception
+    # (psycopg does not close pooled connections there). Read routing and
+    # deadline handling follow server.db.get_conn; a query in flight when the
+    # RPC is cancelled is cancelled by psycopg along with the task.
+    call = current_call()
+    started = perf_counter()
+    pool, conn = await _acquire(readonly, scopes, call)
+    _POOL_WAIT.observe(perf_counter() - started)
+    try:
+        async with conn:
+            await _apply_statement_timeout(conn, call.check() if call is not None else None)
+            yield conn
+    finally:
+        await pool.putconn(conn)
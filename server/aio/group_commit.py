@@ -0,0 +1,98 @@
+"""asyncio counterpart of server.group_commit for the grpc.aio server.
+
+The batch is collected and flushed by its own task rather than by the first
+caller, so a cancelled RPC cannot strand the callers that joined its batch.
+"""
+import asyncio
+from psycopg.rows import dict_row
+from server.aio.db import get_conn
+import server.deadlines as deadlines
+from server.group_commit import MAX_BATCH, WINDOWS
+from server.metrics import GROUP_COMMIT_BATCH
+
+class AsyncWriteBatcher:
+    def __init__(self, name, window=None, max_batch=MAX_BATCH):
+        self.name = name
+        self.window = WINDOWS.get(name, 0) if window is None else window
+        self.max_batch = max_batch
+        self._pending = []
+        self._full = None
+        self._collectors = set()
+        self._batch_size = GROUP_COMMIT_BATCH.labels(name)
+
+    async def run(self, work, *args, key=None):
+        """Run await work(cur, *args) in a committed transaction and return its
+        result. cur is a dict_row cursor; work must not commit or roll back."""
+        if self.window <= 0:
+            return await self._run_alone(work, args)
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((work, args, key, future))
+        if len(self._pending) == 1:
+            self._full = asyncio.Event()
+            # the loop only holds a weak reference to the task
+            task = asyncio.ensure_future(self._collect())
+            self._collectors.add(task)
+            task.add_done_callback(self._collectors.discard)
+        elif len(self._pending) >= self.max_batch:
+            self._full.set()
+        return await future
+
+    async def _run_alone(self, work, args):
+        async with get_conn() as conn:
+            try:
+                async with conn.cursor(row_factory=dict_row) as cur:
+                    result = await work(cur, *args)
+                await conn.commit()
+                return result
+            except Exception:
+                await conn.rollback()
+                raise
+
+    async def _collect(self):
+        try:
+            await asyncio.wait_for(self._full.wait(), self.window)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            for _, _, _, future in self._pending:
+                future.cancel()
+            self._pending = []
+            raise
+        batch, self._pending = self._pending, []
+        with deadlines.scope(None):
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        self._batch_size.observe(len(batch))
+        results, failure, committed = {}, None, False
+        try:
+            async with get_conn() as conn:
+                async with conn.cursor(row_factory=dict_row) as cur:
+                    for work, args, key, future in sorted(batch, key=lambda item: (item[2] is None, item[2])):
+                        await cur.execute('SAVEPOINT group_commit')
+                        try:
+                            results[future] = (await work(cur, *args), None)
+                        except Exception as e:
+                            await cur.execute('ROLLBACK TO SAVEPOINT group_commit')
+                            results[future] = (None, e)
+                        else:
+                            await cur.execute('RELEASE SAVEPOINT group_commit')
+                await conn.commit()
+                committed = True
+        except Exception as e:
+            # connection lost or commit failed: nothing in the batch was written
+            failure = e
+        finally:
+            # also runs when the flush is cancelled, so no caller waits forever
+            for _, _, _, future in batch:
+                if future.done():
+                    continue
+                result, error = results.get(future, (None, None))
+                if error is not None:
+                    future.set_exception(error)
+                elif committed:
+                    future.set_result(result)
+                elif failure is not None:
+                    future.set_exception(failure)
+                else:
+                    future.cancel()
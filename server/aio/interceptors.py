@@ -0,0 +1,118 @@
+"""asyncio counterparts of server.interceptors.MetricsInterceptor,
+AdmissionInterceptor and CompressionInterceptor."""
+import inspect
+import grpc
+import server.deadlines as deadlines
+from server.interceptors import AdmissionInterceptor, CompressionInterceptor, MetricsInterceptor, wrap_handler
+
+def _is_async(behavior):
+    # RPCs without an async port stay synchronous, so grpc keeps running
+    # them on the migration thread pool
+    return inspect.iscoroutinefunction(behavior) or inspect.isasyncgenfunction(behavior)
+
+class AsyncMetricsInterceptor(MetricsInterceptor, grpc.aio.ServerInterceptor):
+    """Same metrics as MetricsInterceptor, for async and migrated RPCs alike."""
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None:
+            return None
+        method = handler_call_details.method.rsplit('/', 1)[-1]
+        return wrap_handler(handler, lambda behavior, streaming: self._wrap(method, behavior, streaming))
+
+    def _wrap(self, method, behavior, response_streaming):
+        if not _is_async(behavior):
+            return super()._wrap(method, behavior, response_streaming)
+        start, finish = self._observers(method)
+        if inspect.isasyncgenfunction(behavior):
+            async def observed(request, context):
+                started, failed = start(), True
+                try:
+                    async for response in behavior(request, context):
+                        yield response
+                    failed = False
+                finally:
+                    finish(context, started, failed)
+        else:
+            async def observed(request, context):
+                started, failed = start(), True
+                try:
+                    response = await behavior(request, context)
+                    failed = False
+                    return response
+                finally:
+                    finish(context, started, failed)
+        return observed
+
+class AsyncAdmissionInterceptor(AdmissionInterceptor, grpc.aio.ServerInterceptor):
+    """Same limits and deadline scope as AdmissionInterceptor. Cancelling the
+    RPC cancels its task, and psycopg cancels the query the task is awaiting,
+    so the Call only needs to end for the deadline checks in get_conn."""
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None:
+            return None
+        method = handler_call_details.method.rsplit('/', 1)[-1]
+        return wrap_handler(handler, lambda behavior, streaming: self._wrap(method, behavior, streaming))
+
+    def _wrap(self, method, behavior, response_streaming):
+        if not _is_async(behavior):
+            return super()._wrap(method, behavior, response_streaming)
+        slots = self._slots.get(method)
+
+        async def admit(context):
+            if slots is not None and not slots.acquire(blocking=False):
+                await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, f'too many concurrent {method} calls')
+            call = deadlines.Call(context.time_remaining())
+            context.add_done_callback(lambda _: call.end())
+            return call
+
+        def release():
+            if slots is not None:
+                slots.release()
+
+        if inspect.isasyncgenfunction(behavior):
+            async def admitted(request, context):
+                call = await admit(context)
+                try:
+                    with deadlines.scope(call):
+                        async for response in behavior(request, context):
+                            yield response
+                finally:
+                    release()
+        else:
+            async def admitted(request, context):
+                call = await admit(context)
+                try:
+                    with deadlines.scope(call):
+                        return await behavior(request, context)
+                finally:
+                    release()
+        return admitted
+
+class AsyncCompressionInterceptor(CompressionInterceptor, grpc.aio.ServerInterceptor):
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None:
+            return None
+        compress = handler_call_details.method.rsplit('/', 1)[-1] in self.methods
+        return wrap_handler(handler, lambda behavior, streaming: self._wrap(compress, behavior, streaming))
+
+    def _wrap(self, compress, behavior, response_streaming):
+        if not _is_async(behavior):
+            return super()._wrap(compress, behavior, response_streaming)
+        min_bytes = self.min_bytes
+        if inspect.isasyncgenfunction(behavior):
+            async def compressed(request, context):
+                async for response in behavior(request, context):
+                    if not compress or response.ByteSize() < min_bytes:
+                        context.disable_next_message_compression()
+                    yield response
+        else:
+            async def compressed(request, context):
+                response = await behavior(request, context)
+                if not compress or response is None or response.ByteSize() < min_bytes:
+                    context.disable_next_message_compression()
+                return response
+        return compressed
@@ -0,0 +1,129 @@
+"""asyncio counterparts of server.services.members for the grpc.aio server."""
+from psycopg import IntegrityError
+from psycopg.rows import dict_row
+from server.aio.db import get_conn
+from server.aio.group_commit import AsyncWriteBatcher
+from server.db import column_names, mark_written
+from server.services.catalog import VERSION_SQL
+from server.logger import get_logger
+from server.services.members import (ACTIVE_LOAN, ALL_SQL, BY_ID_SQL, CREATE, DELETE, MEMBER_DETAIL_SQL, PAGE_SQL, UPDATE,
+                                     member_detail_params, STREAM_BATCH_SIZE, STREAM_SQL)
+import server.cache as cache
+
+logger = get_logger('members_service')
+
+CREATE_BATCHER = AsyncWriteBatcher('create_member')
+
+async def _insert_member(cur, data):
+    await cur.execute(CREATE.sql, (data['name'], data.get('email'), data.get('phone'), data.get('address')))
+    return await cur.fetchone()
+
+async def create_member(data):
+    try:
+        row = await CREATE_BATCHER.run(_insert_member, data, key=data.get('email') or '')
+    except IntegrityError:
+        logger.warning('create_member_duplicate', extra={'email': data.get('email')})
+        raise ValueError('ALREADY_EXISTS')
+    except Exception:
+        logger.exception('create_member_failed')
+        raise
+    mark_written('members')
+    logger.info('member_created', extra={'member_id': row['id']})
+    return row
+
+async def update_member(data):
+    async with get_conn() as conn:
+        try:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(UPDATE.sql, (data['name'], data.get('email'), data.get('phone'), data.get('address'), data['id']))
+                row = await cur.fetchone()
+                if row:
+                    await cache.anotify_invalidation(cur, 'members', row['id'])
+            if row:
+                await conn.commit()
+                mark_written('members', f"member:{row['id']}")
+                cache.members.invalidate(row['id'])
+                logger.info('member_updated', extra={'member_id': row['id']})
+                return row
+            await conn.rollback()
+            return None
+        except IntegrityError:
+            await conn.rollback()
+            logger.warning('update_member_duplicate', extra={'email': data.get('email'), 'member_id': data['id']})
+            raise ValueError('ALREADY_EXISTS')
+        except Exception:
+            await conn.rollback()
+            logger.exception('update_member_failed')
+            raise
+
+async def delete_member(member_id):
+    async with get_conn() as conn:
+        try:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(ACTIVE_LOAN.sql, (member_id,))
+                if await cur.fetchone():
+                    raise ValueError('CANNOT_DELETE_MEMBER_WITH_BORROWINGS')
+                await cur.execute(DELETE.sql, (member_id,))
+                row = await cur.fetchone()
+                if row:
+                    await cache.anotify_invalidation(cur, 'members', member_id)
+            if row:
+                await conn.commit()
+                mark_written('members', f'member:{member_id}')
+                cache.members.invalidate(member_id)
+                logger.info('member_deleted', extra={'member_id': member_id})
+                return True
+            await conn.rollback()
+            return False
+        except ValueError:
+            await conn.rollback()
+            raise
+        except Exception:
+            await conn.rollback()
+            logger.exception('delete_member_failed')
+            raise
+
+async def _fetch_member(member_id, fields=None):
+    async with get_conn(readonly=True, scopes=(f'member:{member_id}',)) as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute(BY_ID_SQL.format(columns='*' if fields is None else ', '.join(fields)), (member_id,))
+            return await cur.fetchone()
+
+async def get_member(member_id, fields=None):
+    # as in server.services.members: cached rows are whole
+    if fields is None or cache.members.maxsize:
+        return await cache.members.aload(member_id, lambda: _fetch_member(member_id))
+    return await _fetch_member(member_id, fields)
+
+async def get_member_detail(member_id, history_limit, before_id=0):
+    async with get_conn(readonly=True, scopes=(f'member:{member_id}', f'loans:{member_id}')) as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute(MEMBER_DETAIL_SQL, member_detail_params(member_id, history_limit, before_id))
+            return await cur.fetchone()
+
+async def list_members(page_size=0, after_id=0, if_version=0, fields=None):
+    columns = '*' if fields is None else ', '.join(fields)
+    async with get_conn(readonly=True, scopes=('members',)) as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(VERSION_SQL, (['members'],))
+            version = (await cur.fetchone())[0] or 0
+            if if_version and if_version == version:
+                return version, None, None
+            if page_size:
+                await cur.execute(PAGE_SQL.format(columns=columns), (after_id, page_size))
+            else:
+                await cur.execute(ALL_SQL.format(columns=columns))
+            return version, column_names(cur), await cur.fetchall()
+
+async def stream_members(batch_size=STREAM_BATCH_SIZE):
+    async with get_conn(readonly=True, scopes=('members',)) as conn:
+        try:
+            async with conn.cursor(name='stream_members') as cur:
+                await cur.execute(STREAM_SQL)
+                while True:
+                    rows = await cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield column_names(cur), rows
+        finally:
+            await conn.rollback()
@@ -1,54 +1,88 @@
 #!/usr/bin/env python3
 import os, time
-from concurrent import futures
+from datetime import datetime, timezone
 import grpc
-from google.protobuf.timestamp_pb2 import Timestamp
+import psycopg2.errors
 from threading import Thread
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify
+from grpc_health.v1 import health as grpc_health, health_pb2, health_pb2_grpc
 from server.logger import get_logger
-from server.db import init_pool, get_conn
+from server.config import ASYNC_MODE, DATABASE_URL, GRPC_MAX_QUEUE, GRPC_MAX_WORKERS, SERVER_WORKERS, WORKER_ID
+from server.db import init_pool, PoolTimeout
+from server.deadlines import DeadlineExceeded
 import server.services.books as books_svc
 import server.services.members as members_svc
 import server.services.borrowings as borrows_svc
 import server.validators as validators
+import server.cache as entity_cache
+import server.metrics as metrics
+import server.convert as convert
+import server.events as events
+import server.health as health_monitor
+from server.interceptors import (AdmissionInterceptor, CompressionInterceptor, MetricsInterceptor, compressed_methods,
+                                 compression_options, method_limits)
+from server.pagination import (clamp_page_size, decode_page_token, encode_page_token, next_page_token, decode_rank_token, next_rank_token,
+                               decode_due_token, encode_due_token)
 import library_pb2, library_pb2_grpc
 logger = get_logger('server')
 
-DATABASE_URL = os.environ.get('DATABASE_URL', 'postgresql://postgres:postgres@db:5432/library')
+# ListBooks/ListMembers page when page_size is 0; whole tables go through StreamBooks/StreamMembers
+LIST_DEFAULT_PAGE_SIZE = 100
+SEARCH_DEFAULT_PAGE_SIZE = 20
+MEMBER_HISTORY_PAGE_SIZE = 20
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 5000))
+IMPORT_MAX_ERRORS = 1000
+WATCH_MAX_SUBSCRIBERS = int(os.environ.get('WATCH_MAX_SUBSCRIBERS', 4))
+# SO_REUSEPORT lets every prefork worker bind the gRPC port; grpc enables it on
+# Linux by default, this keeps it on if that default ever changes
+SERVER_OPTIONS = [('grpc.so_reuseport', 1)]
 
 health_app = Flask(__name__)
 
 @health_app.route('/health')
 def health():
-    try:
-        with get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute('SELECT 1')
-                cur.fetchone()
-        return jsonify({'status':'ok'})
-    except Exception as e:
-        logger.exception('health check failed')
-        return jsonify({'status':'down', 'error': str(e)}), 500
+    # liveness: answered from the monitor's last probe, never from the pool
+    state = health_monitor.monitor().state
+    return jsonify(state), 200 if state['status'] == 'ok' else 503
+
+@health_app.route('/ready')
+def ready():
+    state = health_monitor.monitor().state
+    return jsonify(state), 200 if state['ready'] else 503
+
+@health_app.route('/cache')
+def cache_stats():
+    return jsonify(entity_cache.stats())
+
+@health_app.route('/metrics')
+def prometheus_metrics():
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+def _timestamp_or_none(message, field):
+    return getattr(message, field).ToDatetime(tzinfo=timezone.utc) if message.HasField(field) else None
 
 class LibraryServicer(library_pb2_grpc.LibraryServiceServicer):
+    # errors meaning the server is saturated rather than the request being bad
+    overload_errors = (PoolTimeout,)
+    # the call's deadline passed before or while its query ran
+    deadline_errors = (DeadlineExceeded, psycopg2.errors.QueryCanceled)
+
+    def _fail(self, context, e, code):
+        if isinstance(e, self.overload_errors):
+            code = grpc.StatusCode.RESOURCE_EXHAUSTED
+        elif isinstance(e, self.deadline_errors):
+            code = grpc.StatusCode.DEADLINE_EXCEEDED
+        context.set_code(code); context.set_details(str(e))
+
     def _row_to_book(self, row):
-        b = library_pb2.Book(id=row['id'], isbn=row.get('isbn') or '', title=row['title'], author=row.get('author') or '', publisher=row.get('publisher') or '')
-        if row.get('published_date'):
-            ts = Timestamp(); ts.FromDatetime(row['published_date']); b.published_date.CopyFrom(ts)
-        return b
+        return convert.BOOK.from_dict(row)
 
     def _row_to_member(self, row):
-        return library_pb2.Member(id=row['id'], name=row['name'], email=row.get('email') or '', phone=row.get('phone') or '', address=row.get('address') or '')
+        return convert.MEMBER.from_dict(row)
 
     def _row_to_borrowing(self, row):
-        bor = library_pb2.Borrowing(id=row['id'], book_id=row['book_id'], member_id=row['member_id'], status=row['status'])
-        if row.get('borrowed_at'):
-            ts = Timestamp(); ts.FromDatetime(row['borrowed_at']); bor.borrowed_at.CopyFrom(ts)
-        if row.get('due_at'):
-            ts = Timestamp(); ts.FromDatetime(row['due_at']); bor.due_at.CopyFrom(ts)
-        if row.get('returned_at'):
-            ts = Timestamp(); ts.FromDatetime(row['returned_at']); bor.returned_at.CopyFrom(ts)
-        return bor
+        return convert.BORROWING.from_dict(row)
 
     def CreateBook(self, request, context):
         try:
@@ -63,7 +97,7 @@ class LibraryServicer(library_pb2_grpc.LibraryServiceServicer):
             context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.CreateBookResponse()
         except Exception as e:
             logger.exception('CreateBook failed')
-            context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.CreateBookResponse()
+            self._fail(context, e, grpc.StatusCode.INVALID_ARGUMENT); return library_pb2.CreateBookResponse()
 
     def UpdateBook(self, request, context):
         try:
@@ -79,7 +113,7 @@ class LibraryServicer(library_pb2_grpc.LibraryServiceServicer):
             logger.exception('UpdateBook failed'); context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.UpdateBookResponse()
         except Exception as e:
             logger.exception('UpdateBook failed')
-            context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.UpdateBookResponse()
+            self._fail(context, e, grpc.StatusCode.INVALID_ARGUMENT); return library_pb2.UpdateBookResponse()
 
     def DeleteBook(self, request, context):
         try:
@@ -94,7 +128,7 @@ class LibraryServicer(library_pb2_grpc.LibraryServiceServicer):
                 context.set_details('Cannot delete book that is currently borrowed')
                 return library_pb2.DeleteBookResponse(success=False, message='Book is borrowed')
             logger.exception('DeleteBook failed')
-            context.set_code(grpc.StatusCode.INTERNAL); context.set_details(str(e)); return library_pb2.DeleteBookResponse(success=False, message=str(e))
+            self._fail(context, e, grpc.StatusCode.INTERNAL); return library_pb2.DeleteBookResponse(success=False, message=str(e))
 
     def CreateMember(self, request, context):
         try:
@@ -108,7 +142,7 @@ class LibraryServicer(library_pb2_grpc.LibraryServiceServicer):
             logger.exception('CreateMember failed'); context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.CreateMemberResponse()
         except Exception as e:
             logger.exception('CreateMember failed')
-            context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.CreateMemberResponse()
+            self._fail(context, e, grpc.StatusCode.INVALID_ARGUMENT); return library_pb2.CreateMemberResponse()
 
     def UpdateMember(self, request, context):
         try:
@@ -124,7 +158,7 @@ class LibraryServicer(library_pb2_grpc.LibraryServiceServicer):
             logger.exception('UpdateMember failed'); context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.UpdateMemberResponse()
         except Exception as e:
             logger.exception('UpdateMember failed')
-            context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.UpdateMemberResponse()
+            self._fail(context, e, grpc.StatusCode.INVALID_ARGUMENT); return library_pb2.UpdateMemberResponse()
 
     def DeleteMember(self, request, context):
         try:
@@ -139,11 +173,11 @@ class LibraryServicer(library_pb2_grpc.LibraryServiceServicer):
                 context.set_details('Cannot delete member with active borrowings')
                 return library_pb2.DeleteMemberResponse(success=False)
             logger.exception('DeleteMember failed')
-            context.set_code(grpc.StatusCode.INTERNAL); context.set_details(str(e)); return library_pb2.DeleteMemberResponse(success=False)
+            self._fail(context, e, grpc.StatusCode.INTERNAL); return library_pb2.DeleteMemberResponse(success=False)
 
     def BorrowBook(self, request, context):
         try:
-            val = validators.BorrowRequest(book_id=request.book_id, member_id=request.member_id)
+            val = validators.BorrowRequest(book_id=request.book_id, member_id=request.member_id, due_at=_timestamp_or_none(request, 'due_at'))
             row, err = borrows_svc.borrow_book(val.book_id, val.member_id, val.due_at)
             if err:
                 if err == 'BOOK_NOT_FOUND': context.set_code(grpc.StatusCode.NOT_FOUND); context.set_details('Book not found'); return library_pb2.BorrowBookResponse()
@@ -152,7 +186,7 @@ class LibraryServicer(library_pb2_grpc.LibraryServiceServicer):
             return library_pb2.BorrowBookResponse(borrowing=self._row_to_borrowing(row))
         except Exception as e:
             logger.exception('BorrowBook failed')
-            context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.BorrowBookResponse()
+            self._fail(context, e, grpc.StatusCode.INVALID_ARGUMENT); return library_pb2.BorrowBookResponse()
 
     def ReturnBook(self, request, context):
         try:
@@ -164,61 +198,324 @@ class LibraryServicer(library_pb2_grpc.LibraryServiceServicer):
             return library_pb2.ReturnBookResponse(borrowing=self._row_to_borrowing(row))
         except Exception as e:
             logger.exception('ReturnBook failed')
-            context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.ReturnBookResponse()
+            self._fail(context, e, grpc.StatusCode.INVALID_ARGUMENT); return library_pb2.ReturnBookResponse()
+
+    def _batch_response(self, response_class, results):
+        resp = response_class()
+        for item_id, status, row in results:
+            item = resp.results.add(id=item_id, status=status)
+            if row is not None:
+                convert.BORROWING.fill_dict(item.borrowing, row)
+        return resp
+
+    def BorrowBooks(self, request, context):
+        try:
+            if len(request.book_ids) > borrows_svc.MAX_BATCH_ITEMS:
+                context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(f'At most {borrows_svc.MAX_BATCH_ITEMS} books per batch'); return library_pb2.BorrowBooksResponse()
+            results, err = borrows_svc.borrow_books(request.member_id, request.book_ids, _timestamp_or_none(request, 'due_at'))
+            if err == 'MEMBER_NOT_FOUND':
+                context.set_code(grpc.StatusCode.NOT_FOUND); context.set_details('Member not found'); return library_pb2.BorrowBooksResponse()
+            return self._batch_response(library_pb2.BorrowBooksResponse, results)
+        except Exception as e:
+            logger.exception('BorrowBooks failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL); return library_pb2.BorrowBooksResponse()
+
+    def ReturnBooks(self, request, context):
+        try:
+            if len(request.borrowing_ids) > borrows_svc.MAX_BATCH_ITEMS:
+                context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(f'At most {borrows_svc.MAX_BATCH_ITEMS} borrowings per batch'); return library_pb2.ReturnBooksResponse()
+            return self._batch_response(library_pb2.ReturnBooksResponse, borrows_svc.return_books(request.borrowing_ids))
+        except Exception as e:
+            logger.exception('ReturnBooks failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL); return library_pb2.ReturnBooksResponse()
 
     def ListBorrowedByMember(self, request, context):
         try:
-            rows = borrows_svc.list_borrowed_by_member(request.member_id)
-            borrows = [self._row_to_borrowing(r) for r in rows]
-            return library_pb2.ListBorrowedByMemberResponse(borrowings=borrows)
+            columns, rows = borrows_svc.list_borrowed_by_member(request.member_id, convert.BORROWING.fields(request.read_mask))
+            resp = library_pb2.ListBorrowedByMemberResponse()
+            convert.BORROWING.extend(resp.borrowings, columns, rows)
+            return resp
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.ListBorrowedByMemberResponse()
         except Exception as e:
             logger.exception('ListBorrowedByMember failed')
-            context.set_code(grpc.StatusCode.INTERNAL); context.set_details(str(e)); return library_pb2.ListBorrowedByMemberResponse()
+            self._fail(context, e, grpc.StatusCode.INTERNAL); return library_pb2.ListBorrowedByMemberResponse()
 
     def ListBooks(self, request, context):
         try:
-            rows = books_svc.list_books()
-            books = [self._row_to_book(r) for r in rows]
-            return library_pb2.ListBooksResponse(books=books)
+            page_size = clamp_page_size(request.page_size) or LIST_DEFAULT_PAGE_SIZE
+            version, columns, rows = books_svc.list_books(page_size, decode_page_token(request.page_token), request.if_version,
+                                                         convert.BOOK.fields(request.read_mask), request.available_only)
+            if rows is None:
+                return library_pb2.ListBooksResponse(version=version, not_modified=True)
+            resp = library_pb2.ListBooksResponse(next_page_token=next_page_token(columns, rows, page_size), version=version)
+            convert.BOOK.extend(resp.books, columns, rows)
+            return resp
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.ListBooksResponse()
         except Exception as e:
             logger.exception('ListBooks failed')
-            context.set_code(grpc.StatusCode.INTERNAL); context.set_details(str(e)); return library_pb2.ListBooksResponse()
+            self._fail(context, e, grpc.StatusCode.INTERNAL); return library_pb2.ListBooksResponse()
 
     def ListMembers(self, request, context):
         try:
-            rows = members_svc.list_members()
-            members = [library_pb2.Member(id=r['id'], name=r['name'], email=r.get('email') or '', phone=r.get('phone') or '', address=r.get('address') or '') for r in rows]
-            return library_pb2.ListMembersResponse(members=members)
+            page_size = clamp_page_size(request.page_size) or LIST_DEFAULT_PAGE_SIZE
+            version, columns, rows = members_svc.list_members(page_size, decode_page_token(request.page_token), request.if_version,
+                                                             convert.MEMBER.fields(request.read_mask))
+            if rows is None:
+                return library_pb2.ListMembersResponse(version=version, not_modified=True)
+            resp = library_pb2.ListMembersResponse(next_page_token=next_page_token(columns, rows, page_size), version=version)
+            convert.MEMBER.extend(resp.members, columns, rows)
+            return resp
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.ListMembersResponse()
         except Exception as e:
             logger.exception('ListMembers failed')
-            context.set_code(grpc.StatusCode.INTERNAL); context.set_details(str(e)); return library_pb2.ListMembersResponse()
+            self._fail(context, e, grpc.StatusCode.INTERNAL); return library_pb2.ListMembersResponse()
+
+    def SearchBooks(self, request, context):
+        try:
+            page_size = clamp_page_size(request.page_size) or SEARCH_DEFAULT_PAGE_SIZE
+            columns, rows = books_svc.search_books(request.query, page_size, decode_rank_token(request.page_token))
+            resp = library_pb2.SearchBooksResponse(next_page_token=next_rank_token(columns, rows, page_size))
+            convert.BOOK.extend(resp.books, columns, rows)
+            return resp
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.SearchBooksResponse()
+        except Exception as e:
+            logger.exception('SearchBooks failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL); return library_pb2.SearchBooksResponse()
+
+    def StreamBooks(self, request, context):
+        try:
+            for columns, rows in books_svc.stream_books():
+                yield from convert.BOOK.messages(columns, rows)
+        except Exception as e:
+            logger.exception('StreamBooks failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL)
+
+    def StreamMembers(self, request, context):
+        try:
+            for columns, rows in members_svc.stream_members():
+                yield from convert.MEMBER.messages(columns, rows)
+        except Exception as e:
+            logger.exception('StreamMembers failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL)
+
+    def ListOverdue(self, request, context):
+        try:
+            page_size = clamp_page_size(request.page_size)
+            after = decode_due_token(request.page_token)
+            as_of = _timestamp_or_none(request, 'as_of') or datetime.now(timezone.utc)
+            # one chunk is held back so the page token can ride on the final one
+            pending, sent = None, 0
+            for columns, rows in borrows_svc.list_overdue(as_of, request.member_id, after, page_size):
+                if pending is not None:
+                    yield pending
+                pending = library_pb2.ListOverdueResponse()
+                convert.BORROWING.extend(pending.borrowings, columns, rows)
+                sent += len(rows)
+                last = rows[-1]
+                last_key = (last[columns.index('due_at')], last[columns.index('id')])
+            if pending is None:
+                return
+            if page_size and sent == page_size:
+                pending.next_page_token = encode_due_token(*last_key)
+            yield pending
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e))
+        except Exception as e:
+            logger.exception('ListOverdue failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL)
+
+    def _watch_replay(self, request, replayed):
+        """Recorded events from REPLAY_OVERLAP ids before after_event_id, in batches."""
+        after_id = events.replay_start(request.after_event_id)
+        while True:
+            batch = events.events_after(after_id, request.member_id, request.book_id)
+            for event in batch:
+                replayed.add(event['id'])
+                yield convert.borrowing_event(event)
+            if len(batch) < events.REPLAY_BATCH_SIZE:
+                return
+            after_id = batch[-1]['id']
+
+    def WatchBorrowings(self, request, context):
+        # Each watcher holds a worker thread for its lifetime, so they are capped
+        # below the pool size; the asyncio server has no such limit.
+        sub = events.feed.subscribe(events.Subscription(request.member_id, request.book_id), limit=WATCH_MAX_SUBSCRIBERS)
+        if sub is None:
+            context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED); context.set_details('Too many WatchBorrowings subscribers'); return
+        try:
+            # subscribed before replaying, so nothing committed in between is lost;
+            # events that are both replayed and delivered live are sent once
+            replayed = events.ReplayedIds()
+            if request.after_event_id:
+                yield from self._watch_replay(request, replayed)
+            while context.is_active():
+                event = sub.get(timeout=1)
+                if sub.closed:
+                    context.set_code(grpc.StatusCode.UNAVAILABLE); context.set_details(f'Subscription closed ({sub.closed}); resume with after_event_id'); return
+                if event is None or event['id'] in replayed:
+                    continue
+                yield convert.borrowing_event(event)
+        except Exception as e:
+            logger.exception('WatchBorrowings failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL)
+        finally:
+            events.feed.unsubscribe(sub)
 
     def GetMember(self, request, context):
         try:
-            r = members_svc.get_member(request.id)
+            fields = convert.MEMBER.fields(request.read_mask)
+            r = members_svc.get_member(request.id, fields)
             if not r:
                 context.set_code(grpc.StatusCode.NOT_FOUND); context.set_details('Member not found'); return library_pb2.GetMemberResponse()
-            m = library_pb2.Member(id=r['id'], name=r['name'], email=r.get('email') or '', phone=r.get('phone') or '', address=r.get('address') or '')
-            return library_pb2.GetMemberResponse(member=m)
+            return library_pb2.GetMemberResponse(member=convert.MEMBER.from_dict(r, fields))
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.GetMemberResponse()
         except Exception as e:
             logger.exception('GetMember failed')
-            context.set_code(grpc.StatusCode.INTERNAL); context.set_details(str(e)); return library_pb2.GetMemberResponse()
+            self._fail(context, e, grpc.StatusCode.INTERNAL); return library_pb2.GetMemberResponse()
+
+    def _member_detail_response(self, row, history_limit):
+        resp = library_pb2.GetMemberDetailResponse(active_count=row['active_count'], overdue_count=row['overdue_count'],
+                                                   lifetime_count=row['lifetime_count'])
+        convert.MEMBER.fill_dict(resp.member, row)
+        for loan in row['active']:
+            convert.fill_member_loan(resp.active.add(), loan)
+        for loan in row['history']:
+            convert.fill_member_loan(resp.history.add(), loan)
+        if len(row['history']) == history_limit:
+            resp.next_history_page_token = encode_page_token(row['history'][-1]['id'])
+        return resp
+
+    def GetMemberDetail(self, request, context):
+        try:
+            history_limit = clamp_page_size(request.history_page_size) or MEMBER_HISTORY_PAGE_SIZE
+            row = members_svc.get_member_detail(request.member_id, history_limit, decode_page_token(request.history_page_token))
+            if not row:
+                context.set_code(grpc.StatusCode.NOT_FOUND); context.set_details('Member not found'); return library_pb2.GetMemberDetailResponse()
+            return self._member_detail_response(row, history_limit)
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT); context.set_details(str(e)); return library_pb2.GetMemberDetailResponse()
+        except Exception as e:
+            logger.exception('GetMemberDetail failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL); return library_pb2.GetMemberDetailResponse()
+
+    def _import(self, request_iterator, to_data, validator, import_batch, key, conflict_details):
+        summary = library_pb2.ImportSummary()
+        def add_error(index, key_value, code, message):
+            summary.failed += 1
+            if len(summary.errors) < IMPORT_MAX_ERRORS:
+                summary.errors.add(index=index, key=key_value or '', code=code, message=message)
+        def flush(batch):
+            try:
+                imported, conflicts = import_batch(batch)
+            except Exception as e:
+                logger.exception('import batch failed')
+                for index, data in batch:
+                    add_error(index, data.get(key), 'INTERNAL', str(e))
+                return
+            summary.imported += imported
+            for index, key_value in conflicts:
+                add_error(index, key_value, 'ALREADY_EXISTS', conflict_details)
+        batch = []
+        for index, msg in enumerate(request_iterator):
+            summary.received += 1
+            data = to_data(msg)
+            try:
+                batch.append((index, validator(**data).dict()))
+            except Exception as e:
+                add_error(index, data.get(key), 'INVALID_ARGUMENT', str(e))
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                flush(batch); batch = []
+        if batch:
+            flush(batch)
+        return summary
+
+    def ImportBooks(self, request_iterator, context):
+        try:
+            return self._import(request_iterator,
+                                lambda b: {'title': b.title, 'author': b.author, 'isbn': b.isbn, 'publisher': b.publisher},
+                                validators.BookCreate, books_svc.import_books, 'isbn', 'Book already exists (ISBN check)')
+        except Exception as e:
+            logger.exception('ImportBooks failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL); return library_pb2.ImportSummary()
+
+    def ImportMembers(self, request_iterator, context):
+        try:
+            return self._import(request_iterator,
+                                lambda m: {'name': m.name, 'email': m.email, 'phone': m.phone, 'address': m.address},
+                                validators.MemberCreate, members_svc.import_members, 'email', 'Member already exists (Email check)')
+        except Exception as e:
+            logger.exception('ImportMembers failed')
+            self._fail(context, e, grpc.StatusCode.INTERNAL); return library_pb2.ImportSummary()
+
+LIBRARY_SERVICE = library_pb2.DESCRIPTOR.services_by_name['LibraryService'].full_name
+
+def _serving_status(ready):
+    return health_pb2.HealthCheckResponse.SERVING if ready else health_pb2.HealthCheckResponse.NOT_SERVING
+
+def _publish_stats():
+    """Under the prefork supervisor, share this worker's stats and health after
+    every health check; the supervisor serves the combined /health and /metrics."""
+    if WORKER_ID is None:
+        return None
+    directory = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    return lambda state: metrics.write_snapshot(directory, WORKER_ID, state)
+
+def _start_health_app():
+    if WORKER_ID is None:
+        Thread(target=lambda: health_app.run(host='0.0.0.0', port=8081), daemon=True).start()
 
 def serve():
-    init_pool(minconn=int(os.environ.get('DB_MINCONN',1)), maxconn=int(os.environ.get('DB_MAXCONN',5)))
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+    # one connection per executor worker, so handlers only queue for the pool
+    # when DB_MAXCONN is deliberately set below the worker count
+    init_pool(minconn=int(os.environ.get('DB_MINCONN',1)), maxconn=int(os.environ.get('DB_MAXCONN', GRPC_MAX_WORKERS)))
+    if entity_cache.SHARED_INVALIDATION:
+        entity_cache.start_invalidation_listener(DATABASE_URL)
+    events.feed.start(DATABASE_URL)
+    executor = health_monitor.QueueCountingExecutor(max_workers=GRPC_MAX_WORKERS)
+    # bulk calls get at most half the workers, so point reads and writes always have some
+    interceptors = [MetricsInterceptor(), AdmissionInterceptor(method_limits(max(1, GRPC_MAX_WORKERS // 2)))]
+    options = SERVER_OPTIONS
+    if compressed_methods():
+        interceptors.append(CompressionInterceptor(compressed_methods()))
+        options = options + compression_options()
+    server = grpc.server(executor, interceptors=interceptors, options=options,
+                         maximum_concurrent_rpcs=GRPC_MAX_WORKERS + GRPC_MAX_QUEUE)
     library_pb2_grpc.add_LibraryServiceServicer_to_server(LibraryServicer(), server)
+    health_servicer = grpc_health.HealthServicer()
+    health_pb2_grpc.add_HealthServicer_to_server(health_servicer, server)
+
+    def publish(ready):
+        for service in ('', LIBRARY_SERVICE):
+            health_servicer.set(service, _serving_status(ready))
+
+    publish(False)
+    # queued RPCs: submitted to the executor but not yet picked up by a worker;
+    # readiness drops at half the admission queue, before calls are rejected
+    health_monitor.start(DATABASE_URL, pools=('db',), queued=executor.queued,
+                         max_queued=GRPC_MAX_QUEUE // 2, on_change=publish, publish=_publish_stats())
     port = os.environ.get('GRPC_PORT', '50051')
     server.add_insecure_port(f'[::]:{port}')
-    t = Thread(target=lambda: health_app.run(host='0.0.0.0', port=8081), daemon=True)
-    t.start()
+    _start_health_app()
     server.start()
     logger.info('gRPC server started', extra={'port':port})
     try:
         while True:
             time.sleep(86400)
     except KeyboardInterrupt:
+        health_servicer.enter_graceful_shutdown()
         server.stop(0)
 
 if __name__ == '__main__':
-    serve()
+    if SERVER_WORKERS > 1 and WORKER_ID is None:
+        from server.prefork import main
+        main()
+    elif ASYNC_MODE:
+        from server.aio.app import main
+        main()
+    else:
+        serve()
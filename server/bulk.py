@@ -0,0 +1,30 @@
+import io
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+def copy_buffer(rows):
+    """Encode rows (sequences of values) as a COPY ... FROM STDIN text-format buffer."""
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(_copy_value(v) for v in row))
+        buf.write('\n')
+    buf.seek(0)
+    return buf
+
+def split_duplicates(batch, key):
+    """Split (index, data) pairs into rows to load and (index, key) pairs whose
+    key repeats an earlier row in the same batch. Rows without a key are kept."""
+    seen, keep, dups = set(), [], []
+    for index, data in batch:
+        k = data.get(key)
+        if k and k in seen:
+            dups.append((index, k))
+            continue
+        if k:
+            seen.add(k)
+        keep.append((index, data))
+    return keep, dups
@@ -0,0 +1,164 @@
+import os
+import select
+import threading
+import time
+from collections import OrderedDict
+import psycopg2
+from server.logger import get_logger
+
+logger = get_logger('entity_cache')
+
+NOTIFY_CHANNEL = 'entity_cache'
+CACHE_SIZE = int(os.environ.get('ENTITY_CACHE_SIZE', 10000))
+CACHE_TTL = float(os.environ.get('ENTITY_CACHE_TTL', 60))
+# When set, writers NOTIFY other replicas so they drop their copies too.
+SHARED_INVALIDATION = os.environ.get('ENTITY_CACHE_NOTIFY', '').lower() in ('1', 'true', 'yes')
+
+class EntityCache:
+    """Thread-safe LRU cache with a per-entry TTL, keyed by entity id.
+
+    Cached values are shared between callers and must be treated as read-only.
+    A maxsize of 0 disables caching.
+    """
+
+    def __init__(self, name, maxsize=CACHE_SIZE, ttl=CACHE_TTL, clock=time.monotonic):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generation = 0
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires <= self._clock():
+                del self._entries[key]
+                self.misses += 1
+                self.evictions += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, generation=None):
+        if not self.maxsize:
+            return
+        with self._lock:
+            # an invalidation raced with the load that produced this value
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = (value, self._clock() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def load(self, key, loader):
+        """Return the cached value for key, calling loader() on a miss.
+        None results are not cached."""
+        value = self.get(key)
+        if value is not None:
+            return value
+        generation = self._generation
+        value = loader()
+        if value is not None:
+            self.put(key, value, generation)
+        return value
+
+    async def aload(self, key, loader):
+        """load() for coroutine loaders used by the asyncio server."""
+        value = self.get(key)
+        if value is not None:
+            return value
+        generation = self._generation
+        value = await loader()
+        if value is not None:
+            self.put(key, value, generation)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
+
+books = EntityCache('books')
+members = EntityCache('members')
+CACHES = {'books': books, 'members': members}
+
+def _notify_statement(entity, keys):
+    return 'SELECT pg_notify(%s, %s || key) FROM unnest(%s::text[]) AS key', (NOTIFY_CHANNEL, f'{entity}:', [str(k) for k in keys])
+
+def notify_invalidation(cur, entity, *keys):
+    """Queue a cross-replica invalidation of keys inside the caller's
+    transaction; it is delivered on commit and discarded on rollback."""
+    if SHARED_INVALIDATION and keys:
+        cur.execute(*_notify_statement(entity, keys))
+
+async def anotify_invalidation(cur, entity, *keys):
+    if SHARED_INVALIDATION and keys:
+        await cur.execute(*_notify_statement(entity, keys))
+
+def stats():
+    return {name: cache.stats() for name, cache in CACHES.items()}
+
+def _apply_notification(payload):
+    entity, _, key = payload.partition(':')
+    cache = CACHES.get(entity)
+    if cache is None:
+        logger.warning('cache_notify_unknown_entity', extra={'payload': payload})
+        return
+    try:
+        cache.invalidate(int(key))
+    except ValueError:
+        cache.clear()
+
+def _listen(dsn):
+    backoff = 1
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(dsn)
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f'LISTEN {NOTIFY_CHANNEL}')
+            # anything written while we were not listening may be stale
+            for cache in CACHES.values():
+                cache.clear()
+            logger.info('cache_listener_started')
+            backoff = 1
+            while True:
+                if select.select([conn], [], [], 30) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    _apply_notification(conn.notifies.pop(0).payload)
+        except Exception:
+            logger.exception('cache_listener_failed')
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+        finally:
+            if conn is not None:
+                conn.close()
+
+def start_invalidation_listener(dsn):
+    t = threading.Thread(target=_listen, args=(dsn,), name='cache-invalidation', daemon=True)
+    t.start()
+    return t
@@ -0,0 +1,15 @@
+"""Process-level server settings read from the environment.
+
+Kept free of imports from the rest of the server so the pre-fork supervisor
+can read them without loading the servicer.
+"""
+import os
+
+DATABASE_URL = os.environ.get('DATABASE_URL', 'postgresql://postgres:postgres@db:5432/library')
+GRPC_MAX_WORKERS = int(os.environ.get('GRPC_MAX_WORKERS', 10))
+# RPCs admitted beyond the running ones; grpc rejects the rest with RESOURCE_EXHAUSTED
+GRPC_MAX_QUEUE = int(os.environ.get('GRPC_MAX_QUEUE', GRPC_MAX_WORKERS))
+ASYNC_MODE = os.environ.get('GRPC_ASYNC', '').lower() in ('1', 'true', 'yes')
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', 1))
+# set by server.prefork in the processes it starts
+WORKER_ID = os.environ.get('SERVER_WORKER_ID')
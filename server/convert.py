@@ -0,0 +1,123 @@
+"""Row -> protobuf conversion shared by every RPC.
+
+List queries use plain tuple cursors; column positions are resolved once per
+result set, messages are built in place inside the repeated field and
+timestamps are written straight into the embedded Timestamp.
+"""
+from datetime import date, datetime, timezone
+import library_pb2
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_EPOCH_DATE = _EPOCH.date()
+
+def set_timestamp(ts, value):
+    if type(value) is date:
+        ts.seconds = (value - _EPOCH_DATE).days * 86400
+        return
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    delta = value - _EPOCH
+    ts.seconds = delta.days * 86400 + delta.seconds
+    ts.nanos = delta.microseconds * 1000
+
+def parse_json_timestamps(row, fields):
+    """json/jsonb results carry timestamps as ISO strings; convert them in place."""
+    for field in fields:
+        value = row.get(field)
+        if isinstance(value, str):
+            row[field] = datetime.fromisoformat(value)
+    return row
+
+class MessageConverter:
+    def __init__(self, message_class, scalar_fields, timestamp_fields):
+        self.message_class = message_class
+        self.scalar_fields = scalar_fields
+        self.timestamp_fields = timestamp_fields
+        self._layouts = {}
+
+    def layout(self, columns):
+        """(field, position) pairs for the fields present in this column list."""
+        key = tuple(columns)
+        layout = self._layouts.get(key)
+        if layout is None:
+            pos = {name: i for i, name in enumerate(key)}
+            layout = self._layouts[key] = (
+                tuple((f, pos[f]) for f in self.scalar_fields if f in pos),
+                tuple((f, pos[f]) for f in self.timestamp_fields if f in pos),
+            )
+        return layout
+
+    def _fill(self, msg, row, scalars, timestamps):
+        for field, i in scalars:
+            value = row[i]
+            if value is not None:
+                setattr(msg, field, value)
+        for field, i in timestamps:
+            value = row[i]
+            if value is not None:
+                set_timestamp(getattr(msg, field), value)
+        return msg
+
+    def extend(self, repeated, columns, rows):
+        """Append one message per tuple row to a repeated message field."""
+        scalars, timestamps = self.layout(columns)
+        add, fill = repeated.add, self._fill
+        for row in rows:
+            fill(add(), row, scalars, timestamps)
+
+    def messages(self, columns, rows):
+        scalars, timestamps = self.layout(columns)
+        cls, fill = self.message_class, self._fill
+        for row in rows:
+            yield fill(cls(), row, scalars, timestamps)
+
+    def fields(self, read_mask):
+        """Message fields named by a FieldMask, in declaration order and always
+        with id, or None (every field) for an empty mask. These double as the
+        column names to select."""
+        paths = set(read_mask.paths)
+        if not paths:
+            return None
+        unknown = paths.difference(self.scalar_fields, self.timestamp_fields)
+        if unknown:
+            raise ValueError(f"unknown read_mask field(s): {', '.join(sorted(unknown))}")
+        return tuple(f.name for f in self.message_class.DESCRIPTOR.fields if f.name == 'id' or f.name in paths)
+
+    def from_dict(self, row, fields=None):
+        """Convert a single RealDictCursor row (create/update/get paths),
+        filling only fields when given."""
+        return self.fill_dict(self.message_class(), row, fields)
+
+    def fill_dict(self, msg, row, fields=None):
+        scalars, timestamps = self.scalar_fields, self.timestamp_fields
+        if fields is not None:
+            scalars = [f for f in scalars if f in fields]
+            timestamps = [f for f in timestamps if f in fields]
+        for field in scalars:
+            value = row.get(field)
+            if value is not None:
+                setattr(msg, field, value)
+        for field in timestamps:
+            value = row.get(field)
+            if value is not None:
+                set_timestamp(getattr(msg, field), value)
+        return msg
+
+BOOK = MessageConverter(library_pb2.Book, ('id', 'isbn', 'title', 'author', 'publisher', 'available'), ('published_date',))
+MEMBER = MessageConverter(library_pb2.Member, ('id', 'name', 'email', 'phone', 'address'), ())
+BORROWING_TIMESTAMPS = ('borrowed_at', 'due_at', 'returned_at')
+BORROWING = MessageConverter(library_pb2.Borrowing, ('id', 'book_id', 'member_id', 'status'), BORROWING_TIMESTAMPS)
+
+BOOK_SUMMARY = MessageConverter(library_pb2.BookSummary, ('title', 'author', 'isbn'), ())
+
+def fill_member_loan(msg, loan):
+    """Fill a MemberLoan from a GetMemberDetail json row (borrowing + book columns)."""
+    BORROWING.fill_dict(msg.borrowing, parse_json_timestamps(loan, BORROWING_TIMESTAMPS))
+    msg.book.id = loan['book_id']
+    BOOK_SUMMARY.fill_dict(msg.book, loan)
+
+def borrowing_event(event):
+    msg = library_pb2.BorrowingEvent(id=event['id'], type=event['type'])
+    set_timestamp(msg.occurred_at, event['occurred_at'])
+    BORROWING.fill_dict(msg.borrowing, event['borrowing'])
+    return msg
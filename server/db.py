@@ -0,0 +1,461 @@
+import os
+import random
+import threading
+from collections import deque
+from contextlib import contextmanager
+from time import monotonic, perf_counter, sleep
+import psycopg2
+import psycopg2.extensions
+from server.deadlines import current as current_call, statement_timeout, timeout_to_set
+from server.logger import get_logger
+from server.metrics import DB_READS, DB_TIME, POOLS, REPLICA_LAG
+
+logger = get_logger('db')
+
+DATABASE_URL = os.environ.get('DATABASE_URL', 'postgresql://postgres:postgres@db:5432/library')
+# seconds a caller waits for a free connection before PoolTimeout
+ACQUIRE_TIMEOUT = float(os.environ.get('DB_ACQUIRE_TIMEOUT', 5))
+# connections are closed on return once this old (minus up to 10% jitter)
+MAX_LIFETIME = float(os.environ.get('DB_MAX_LIFETIME', 1800))
+# connections idle for longer than this are pinged before being handed out
+CHECK_IDLE = float(os.environ.get('DB_CHECK_IDLE', 30))
+# comma-separated read replicas; without any, reads use the primary pool
+DATABASE_READ_URLS = [url.strip() for url in os.environ.get('DATABASE_READ_URLS', '').split(',') if url.strip()]
+# replicas further behind than this (seconds) get no reads
+MAX_REPLICA_LAG = float(os.environ.get('DB_MAX_REPLICA_LAG', 1))
+REPLICA_CHECK_INTERVAL = float(os.environ.get('DB_REPLICA_CHECK_INTERVAL', 1))
+
+_pool = None
+_replicas = None
+_POOL_WAIT, _QUERY, _COMMIT = (DB_TIME.labels(phase) for phase in ('pool_wait', 'query', 'commit'))
+
+class _TimedCursorMixin:
+    def execute(self, query, vars=None):
+        started = perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            _QUERY.observe(perf_counter() - started)
+
+    def executemany(self, query, vars_list):
+        started = perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            _QUERY.observe(perf_counter() - started)
+
+    def copy_expert(self, sql, file, size=8192):
+        started = perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            _QUERY.observe(perf_counter() - started)
+
+_timed_cursor_classes = {}
+
+def _timed(cursor_class):
+    timed = _timed_cursor_classes.get(cursor_class)
+    if timed is None:
+        timed = _timed_cursor_classes[cursor_class] = type(f'Timed{cursor_class.__name__}', (_TimedCursorMixin, cursor_class), {})
+    return timed
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    """Connection that records query and commit time for every cursor the
+    services open, whatever cursor_factory they ask for, and remembers which
+    server.statements it has prepared and its statement_timeout (ms, None
+    until first set)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+        self.statement_timeout = None
+
+    def cursor(self, *args, **kwargs):
+        kwargs['cursor_factory'] = _timed(kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        started = perf_counter()
+        try:
+            return super().commit()
+        finally:
+            _COMMIT.observe(perf_counter() - started)
+
+def column_names(cur):
+    return tuple(d[0] for d in cur.description)
+
+class PoolTimeout(Exception):
+    """No connection became free within the acquire timeout."""
+
+class _Waiter:
+    __slots__ = ('event', 'conn')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.conn = None
+
+class ConnectionPool:
+    """Thread-safe psycopg2 pool with a FIFO wait queue.
+
+    When all maxconn connections are out, callers queue in arrival order and
+    each returned connection is handed straight to the oldest waiter, so a
+    burst of new requests cannot starve one that has been waiting; a caller
+    still waiting after `timeout` seconds gets PoolTimeout. Connections idle
+    for longer than check_idle are pinged before reuse, and connections past
+    max_lifetime are closed on return and reopened on demand.
+    """
+
+    def __init__(self, minconn, maxconn, dsn, timeout=ACQUIRE_TIMEOUT, max_lifetime=MAX_LIFETIME,
+                 check_idle=CHECK_IDLE, connection_factory=InstrumentedConnection, connect=psycopg2.connect):
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.check_idle = check_idle
+        self._connect = lambda: connect(dsn, connection_factory=connection_factory)
+        self._lock = threading.Lock()
+        self._idle = deque()
+        self._waiters = deque()
+        self._expires = {}
+        self._returned = {}
+        # open connections plus slots reserved by callers still connecting
+        self._size = 0
+        self._counts = dict.fromkeys(('acquired', 'timeouts', 'created', 'recycled', 'check_failed'), 0)
+        self._wait_total = self._wait_max = 0.0
+        for _ in range(minconn):
+            self._size += 1
+            self._idle.append(self._open())
+
+    def _open(self):
+        conn = self._connect()
+        self._expires[conn] = monotonic() + self.max_lifetime * (1 - random.random() * 0.1)
+        self._returned[conn] = monotonic()
+        with self._lock:
+            self._counts['created'] += 1
+        return conn
+
+    def _close(self, conn, reason=None):
+        self._expires.pop(conn, None)
+        self._returned.pop(conn, None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+        if reason:
+            with self._lock:
+                self._counts[reason] += 1
+
+    def _free_slot(self):
+        # hand the slot to the oldest waiter, who opens a fresh connection
+        with self._lock:
+            if self._waiters:
+                self._waiters.popleft().event.set()
+            else:
+                self._size -= 1
+
+    def _reserve(self, timeout):
+        """An idle connection, or None when the caller owns a slot to open one."""
+        with self._lock:
+            if not self._waiters:
+                if self._idle:
+                    return self._idle.pop()
+                if self._size < self.maxconn:
+                    self._size += 1
+                    return None
+            waiter = _Waiter()
+            self._waiters.append(waiter)
+        waiter.event.wait(timeout)
+        with self._lock:
+            if waiter.event.is_set():
+                return waiter.conn
+            self._waiters.remove(waiter)
+            self._counts['timeouts'] += 1
+        raise PoolTimeout(f'no database connection free after {timeout:g}s ({self.maxconn} in use)')
+
+    def _usable(self, conn):
+        if conn.closed:
+            return False
+        now = monotonic()
+        if now >= self._expires.get(conn, now):
+            self._close(conn, 'recycled')
+            return False
+        if now - self._returned.get(conn, now) < self.check_idle:
+            return True
+        try:
+            # bypass InstrumentedConnection so pings don't count as query time
+            with psycopg2.extensions.connection.cursor(conn) as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            self._close(conn, 'check_failed')
+            return False
+
+    def getconn(self, timeout=None):
+        started = perf_counter()
+        conn = self._reserve(self.timeout if timeout is None else timeout)
+        try:
+            if conn is not None and not self._usable(conn):
+                conn = None
+            if conn is None:
+                conn = self._open()
+        except Exception:
+            self._free_slot()
+            raise
+        waited = perf_counter() - started
+        with self._lock:
+            self._counts['acquired'] += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return conn
+
+    def putconn(self, conn, close=False):
+        """Return a connection, rolling back any transaction left open."""
+        if not close and not conn.closed:
+            try:
+                status = conn.get_transaction_status()
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    close = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                close = True
+        if close or conn.closed:
+            self._close(conn)
+            self._free_slot()
+            return
+        if monotonic() >= self._expires.get(conn, 0):
+            self._close(conn, 'recycled')
+            self._free_slot()
+            return
+        self._returned[conn] = monotonic()
+        with self._lock:
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter.conn = conn
+                waiter.event.set()
+            else:
+                self._idle.append(conn)
+
+    def busy(self):
+        return self._size - len(self._idle)
+
+    def closeall(self):
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+            self._size -= len(idle)
+        for conn in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self._lock:
+            idle, size, waiting = len(self._idle), self._size, len(self._waiters)
+            stats = dict(self._counts)
+            wait_total, wait_max = self._wait_total, self._wait_max
+        stats.update(maxconn=self.maxconn, size=size, in_use=size - idle, idle=idle, waiting=waiting,
+                     wait_seconds_total=round(wait_total, 6), wait_seconds_max=round(wait_max, 6))
+        return stats
+
+# Replay lag in seconds: 0 once the replica has replayed everything the primary
+# had written when the check started, NULL if it has never replayed anything.
+REPLICA_LAG_SQL = """
+    SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_replay_lsn() >= %s::pg_lsn THEN 0
+                ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END
+"""
+
+class Replica:
+    def __init__(self, name, dsn, pool):
+        self.name = name
+        self.dsn = dsn
+        self.pool = pool
+        # None until measured, and while unreachable
+        self.lag = None
+        self._conn = None
+
+    def measure(self, primary_lsn):
+        try:
+            if self._conn is None or self._conn.closed:
+                self._conn = psycopg2.connect(self.dsn, connect_timeout=2)
+                self._conn.autocommit = True
+            with self._conn.cursor() as cur:
+                cur.execute(REPLICA_LAG_SQL, (primary_lsn,))
+                lag = cur.fetchone()[0]
+            self.lag = None if lag is None else float(lag)
+        except psycopg2.Error:
+            self.down()
+        REPLICA_LAG.labels(self.name).set(float('nan') if self.lag is None else self.lag)
+
+    def down(self):
+        if self.lag is not None:
+            logger.warning('replica_unavailable', extra={'replica': self.name})
+        self.lag = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+class ReplicaSet:
+    """Read replicas and their measured lag.
+
+    A monitor thread compares each replica's replay position with the primary's
+    WAL position every interval. choose() only considers replicas within
+    max_lag, picks the least busy and rotates between equally busy ones, and
+    returns None (use the primary) when none qualifies.
+    """
+
+    def __init__(self, replicas, primary_dsn, max_lag=MAX_REPLICA_LAG, interval=REPLICA_CHECK_INTERVAL):
+        self.replicas = replicas
+        self.primary_dsn = primary_dsn
+        self.max_lag = max_lag
+        self.interval = interval
+        self._next = 0
+        self._primary = None
+        self._thread = None
+
+    def choose(self, busy=lambda replica: replica.pool.busy()):
+        eligible = [r for r in self.replicas if r.lag is not None and r.lag <= self.max_lag]
+        if not eligible:
+            return None
+        self._next += 1
+        start = self._next % len(eligible)
+        return min(eligible[start:] + eligible[:start], key=busy)
+
+    def measure(self):
+        try:
+            if self._primary is None or self._primary.closed:
+                self._primary = psycopg2.connect(self.primary_dsn, connect_timeout=2)
+                self._primary.autocommit = True
+            with self._primary.cursor() as cur:
+                cur.execute('SELECT pg_current_wal_lsn()')
+                primary_lsn = cur.fetchone()[0]
+        except psycopg2.Error:
+            # without the primary's position lag is unknown; keep the last values
+            logger.exception('replica_check_failed')
+            self._primary = None
+            return
+        for replica in self.replicas:
+            replica.measure(primary_lsn)
+
+    def _monitor(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.measure()
+            except Exception:
+                logger.exception('replica_check_failed')
+
+    def start(self):
+        if self._thread is None:
+            self.measure()
+            self._thread = threading.Thread(target=self._monitor, name='replica-monitor', daemon=True)
+            self._thread.start()
+        return self._thread
+
+def init_pool(minconn=1, maxconn=5, dsn=DATABASE_URL, timeout=ACQUIRE_TIMEOUT, read_dsns=DATABASE_READ_URLS):
+    """Open the primary pool and, for each read_dsn, a replica pool of the same size."""
+    global _pool, _replicas
+    _pool = ConnectionPool(minconn, maxconn, dsn, timeout=timeout)
+    POOLS['db'] = _pool.stats
+    _replicas = None
+    if read_dsns:
+        replicas = []
+        for i, read_dsn in enumerate(read_dsns):
+            replica = Replica(f'replica{i}', read_dsn, ConnectionPool(0, maxconn, read_dsn, timeout=timeout))
+            POOLS[f'db_{replica.name}'] = lambda replica=replica: dict(replica.pool.stats(), lag_seconds=replica.lag)
+            replicas.append(replica)
+        _replicas = ReplicaSet(replicas, dsn)
+        _replicas.start()
+    return _pool
+
+def replica_set():
+    return _replicas
+
+# Read-your-writes: scope -> monotonic time of this process's last write to it.
+# Reads naming a scope written more recently than a replica can be trusted to
+# have caught up stay on the primary.
+_writes = {}
+_writes_lock = threading.Lock()
+
+def mark_written(*scopes):
+    """Record a committed write to scopes ('books', 'member:7', 'loans:7', ...)."""
+    if _replicas is None:
+        return
+    now = monotonic()
+    with _writes_lock:
+        for scope in scopes:
+            _writes[scope] = now
+        if len(_writes) > 10000:
+            cutoff = now - _replicas.max_lag - _replicas.interval
+            for scope in [s for s, at in _writes.items() if at < cutoff]:
+                del _writes[scope]
+
+def choose_replica(scopes=(), busy=None):
+    """The replica a read of scopes should use, or None for the primary."""
+    if _replicas is None:
+        return None
+    if scopes:
+        cutoff = monotonic() - _replicas.max_lag - _replicas.interval
+        if any(_writes.get(scope, 0) >= cutoff for scope in scopes):
+            DB_READS.labels('primary').inc()
+            return None
+    replica = _replicas.choose(busy) if busy else _replicas.choose()
+    DB_READS.labels('replica' if replica else 'primary').inc()
+    return replica
+
+def _acquire(readonly, scopes, timeout=None):
+    replica = choose_replica(scopes) if readonly else None
+    if replica is not None:
+        try:
+            return replica.pool, replica.pool.getconn(timeout)
+        except psycopg2.OperationalError:
+            replica.down()
+            DB_READS.labels('primary').inc()
+    return _pool, _pool.getconn(timeout)
+
+def _apply_statement_timeout(conn, remaining):
+    if not hasattr(conn, 'statement_timeout'):
+        return
+    ms = timeout_to_set(conn.statement_timeout, statement_timeout(remaining))
+    if ms is None:
+        return
+    # set for the session, outside any transaction, so the rollback on return
+    # to the pool does not undo it and the next caller can reuse it
+    autocommit, conn.autocommit = conn.autocommit, True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SET statement_timeout = %s', (ms,))
+    finally:
+        conn.autocommit = autocommit
+    conn.statement_timeout = ms
+
+@contextmanager
+def get_conn(readonly=False, scopes=()):
+    """Borrow a pooled connection, raising PoolTimeout if none frees up in
+    time. The pool rolls back any transaction the caller left open when the
+    connection is returned.
+
+    readonly connections may come from a replica, unless this process wrote
+    to one of scopes (see mark_written) too recently for replicas to have
+    caught up; writes must use the default primary connection.
+
+    Inside an RPC (see server.deadlines) the pool wait and statement_timeout
+    are capped by the time left before its deadline, DeadlineExceeded is
+    raised if none is left, and the running query is cancelled if the RPC
+    ends first."""
+    call = current_call()
+    timeout = None
+    if call is not None:
+        remaining = call.check()
+        if remaining is not None:
+            timeout = min(ACQUIRE_TIMEOUT, remaining)
+    started = perf_counter()
+    pool, conn = _acquire(readonly, scopes, timeout)
+    _POOL_WAIT.observe(perf_counter() - started)
+    try:
+        if call is None:
+            _apply_statement_timeout(conn, None)
+            yield conn
+        else:
+            _apply_statement_timeout(conn, call.check())
+            with call.attached(conn):
+                yield conn
+    finally:
+        pool.putconn(conn)
@@ -0,0 +1,102 @@
+"""Per-RPC deadline and cancellation scope shared by the interceptors and the db layer.
+
+The admission interceptor opens a Call for every RPC: its deadline (from the
+client's gRPC timeout) and the pooled connections it currently holds. get_conn
+reads the current Call to cap its pool wait and the statement_timeout of the
+queries that follow, and attaches the connection so that when the RPC ends
+early (client cancelled, deadline passed) the query still running on it is
+cancelled instead of holding the connection until it finishes.
+"""
+import os
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import monotonic
+
+# Server-side cap for statements whose RPC has no deadline, in ms; 0 is none.
+STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+# the threaded server reports calls without a deadline as due centuries from now
+NO_DEADLINE = 365 * 86400
+
+class DeadlineExceeded(Exception):
+    """The RPC's deadline passed, or its client went away, before the database was reached."""
+
+class Call:
+    def __init__(self, time_remaining=None):
+        if time_remaining is not None and time_remaining >= NO_DEADLINE:
+            time_remaining = None
+        self.deadline = None if time_remaining is None else monotonic() + time_remaining
+        self.ended = False
+        self._conns = []
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        """Seconds left before the deadline, or None without one."""
+        return None if self.deadline is None else self.deadline - monotonic()
+
+    def check(self):
+        if self.ended:
+            raise DeadlineExceeded('call ended before the database was reached')
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded('deadline exceeded before the database was reached')
+        return remaining
+
+    @contextmanager
+    def attached(self, conn):
+        with self._lock:
+            self._conns.append(conn)
+        try:
+            yield conn
+        finally:
+            # detached under the lock, so end() never cancels a connection
+            # that is already back in the pool serving another call
+            with self._lock:
+                self._conns.remove(conn)
+
+    def end(self):
+        """Called when the RPC terminates; cancels whatever it is still running."""
+        with self._lock:
+            self.ended = True
+            for conn in self._conns:
+                try:
+                    conn.cancel()
+                except Exception:
+                    pass  # connection already broken; the pool discards it
+
+_current = ContextVar('rpc_call', default=None)
+
+def current():
+    return _current.get()
+
+@contextmanager
+def scope(call):
+    token = _current.set(call)
+    try:
+        yield call
+    finally:
+        _current.reset(token)
+
+def statement_timeout(remaining):
+    """Statement timeout in ms for a call with `remaining` seconds left (None:
+    no deadline), never looser than DB_STATEMENT_TIMEOUT."""
+    if remaining is None:
+        return STATEMENT_TIMEOUT_MS
+    ms = max(1, int(remaining * 1000))
+    return min(ms, STATEMENT_TIMEOUT_MS) if STATEMENT_TIMEOUT_MS else ms
+
+def timeout_to_set(current_ms, limit_ms):
+    """The statement_timeout a connection needs for limit_ms, or None if its
+    current setting will do.
+
+    A setting at most 10% tighter than the limit is kept, and deadline-derived
+    limits are set 5% tighter than needed, so calls arriving with similar
+    deadlines reuse the connection's setting instead of paying a round trip
+    each."""
+    if current_ms == limit_ms:
+        return None
+    if limit_ms == 0 or limit_ms == STATEMENT_TIMEOUT_MS:
+        return limit_ms
+    if current_ms and 0.9 * limit_ms <= current_ms <= limit_ms:
+        return None
+    return max(1, int(limit_ms * 0.95))
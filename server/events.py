@@ -0,0 +1,278 @@
+"""Borrow/return change feed behind WatchBorrowings.
+
+The borrowings triggers (db/schema.sql) record every status change in
+borrowing_events and NOTIFY it on commit. One listener thread per process owns
+the LISTEN connection and fans each event out to the subscribers whose filters
+match. Subscribers get a bounded queue; one that falls behind is closed rather
+than allowed to grow without limit, and reconnects with after_event_id.
+
+Event ids come from a sequence when the event is inserted, not when it commits,
+so an event can become visible after others with higher ids. Replays therefore
+start REPLAY_OVERLAP ids before after_event_id, and a stream skips live events
+it has already replayed by id rather than by a high-water mark. The listener
+thread also prunes events older than EVENT_RETENTION_HOURS.
+"""
+import asyncio
+import collections
+import json
+import os
+import queue
+import select
+import threading
+import time
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from server.convert import BORROWING_TIMESTAMPS, parse_json_timestamps
+from server.db import get_conn
+from server.logger import get_logger
+from server.metrics import WATCH_DROPPED
+
+logger = get_logger('borrowing_events')
+
+NOTIFY_CHANNEL = 'borrowing_events'
+QUEUE_SIZE = int(os.environ.get('WATCH_QUEUE_SIZE', 1000))
+REPLAY_BATCH_SIZE = 500
+REPLAY_OVERLAP = int(os.environ.get('WATCH_REPLAY_OVERLAP', 500))
+EVENT_RETENTION_HOURS = int(os.environ.get('WATCH_EVENT_RETENTION_HOURS', 168))
+PRUNE_INTERVAL = 3600
+PRUNE_BATCH_SIZE = 1000
+
+# close reasons
+OVERFLOW = 'OVERFLOW'
+FEED_RESET = 'FEED_RESET'
+
+def parse_event(event):
+    """Turn JSON timestamps (NOTIFY payload / jsonb snapshot) into datetimes."""
+    parse_json_timestamps(event, ('occurred_at',))
+    parse_json_timestamps(event['borrowing'], BORROWING_TIMESTAMPS)
+    return event
+
+class Subscription:
+    """A subscriber's filters and queue. member_id/book_id of 0 match anything.
+
+    deliver() is called on the listener thread; the default hands events to a
+    queue.Queue for a synchronous consumer. close() ends the stream at the
+    consumer's next get(), which then returns None with `closed` set.
+    """
+
+    def __init__(self, member_id=0, book_id=0, maxsize=QUEUE_SIZE):
+        self.member_id = member_id
+        self.book_id = book_id
+        self.closed = None
+        self._queue = queue.Queue(maxsize)
+
+    def matches(self, event):
+        borrowing = event['borrowing']
+        return ((not self.member_id or borrowing['member_id'] == self.member_id) and
+                (not self.book_id or borrowing['book_id'] == self.book_id))
+
+    def deliver(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.close(OVERFLOW)
+
+    def close(self, reason):
+        if self.closed is None:
+            self.closed = reason
+            WATCH_DROPPED.labels(reason).inc()
+            self._wake()
+
+    def _wake(self):
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass  # the consumer is already behind and will reach `closed`
+
+    def get(self, timeout=None):
+        """Next event, None on timeout or once closed (check `closed`)."""
+        if self.closed:
+            return None
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+class AsyncSubscription(Subscription):
+    """Subscription consumed from an asyncio event loop."""
+
+    def __init__(self, loop, member_id=0, book_id=0, maxsize=QUEUE_SIZE):
+        super().__init__(member_id, book_id, maxsize)
+        self._loop = loop
+        self._aqueue = asyncio.Queue(maxsize)
+
+    def deliver(self, event):
+        self._loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        try:
+            self._aqueue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.close(OVERFLOW)
+
+    def _wake(self):
+        self._loop.call_soon_threadsafe(self._put_wakeup)
+
+    def _put_wakeup(self):
+        if self._aqueue.empty():
+            self._aqueue.put_nowait(None)
+
+    async def aget(self):
+        if self.closed:
+            return None
+        return await self._aqueue.get()
+
+class ReplayedIds:
+    """Ids a stream has replayed, so the same events arriving live are skipped.
+
+    Only events committed after the subscription can arrive both ways. At most
+    QUEUE_SIZE of them fit in the subscription's queue, and at most
+    REPLAY_OVERLAP replayed events can sort after one of them, so the most
+    recent maxlen ids are all that need keeping.
+    """
+
+    def __init__(self, maxlen=QUEUE_SIZE + REPLAY_OVERLAP):
+        self._order = collections.deque()
+        self._ids = set()
+        self._maxlen = maxlen
+
+    def add(self, event_id):
+        self._order.append(event_id)
+        self._ids.add(event_id)
+        if len(self._order) > self._maxlen:
+            self._ids.discard(self._order.popleft())
+
+    def __contains__(self, event_id):
+        return event_id in self._ids
+
+class BorrowingFeed:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._thread = None
+        self._pruned_at = None
+
+    def subscribe(self, subscription, limit=0):
+        """Register subscription; None if limit subscribers are already active."""
+        with self._lock:
+            if limit and len(self._subscribers) >= limit:
+                return None
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            if sub.closed is None and sub.matches(event):
+                sub.deliver(event)
+
+    def _reset(self):
+        # notifications sent while we were not listening are lost; subscribers
+        # reconnect and replay from their last event id instead
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            sub.close(FEED_RESET)
+
+    def _listen(self, dsn):
+        backoff = 1
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(dsn)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f'LISTEN {NOTIFY_CHANNEL}')
+                self._reset()
+                logger.info('borrowing_feed_started')
+                backoff = 1
+                while True:
+                    self._maybe_prune(conn)
+                    if select.select([conn], [], [], 30) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        payload = conn.notifies.pop(0).payload
+                        try:
+                            event = parse_event(json.loads(payload))
+                        except (ValueError, KeyError):
+                            logger.warning('borrowing_feed_bad_payload', extra={'payload': payload})
+                            continue
+                        self.publish(event)
+            except Exception:
+                logger.exception('borrowing_feed_failed')
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def _maybe_prune(self, conn):
+        # every process prunes; the deletes are idempotent and batched so the
+        # listener is not kept from its notifications for long
+        if not EVENT_RETENTION_HOURS:
+            return
+        now = time.monotonic()
+        if self._pruned_at is not None and now - self._pruned_at < PRUNE_INTERVAL:
+            return
+        self._pruned_at = now
+        try:
+            pruned = prune_events(conn)
+        except psycopg2.Error:
+            logger.warning('borrowing_feed_prune_failed', exc_info=True)
+            return
+        if pruned:
+            logger.info('borrowing_feed_pruned', extra={'events': pruned})
+
+    def start(self, dsn):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._listen, args=(dsn,), name='borrowing-feed', daemon=True)
+            self._thread.start()
+        return self._thread
+
+feed = BorrowingFeed()
+
+REPLAY_SQL = """
+    SELECT id, type, occurred_at, borrowing FROM borrowing_events
+    WHERE id > %(after)s AND (%(member_id)s = 0 OR member_id = %(member_id)s) AND (%(book_id)s = 0 OR book_id = %(book_id)s)
+    ORDER BY id LIMIT %(limit)s
+"""
+
+PRUNE_SQL = """
+    DELETE FROM borrowing_events WHERE id IN (
+        SELECT id FROM borrowing_events WHERE occurred_at < now() - make_interval(hours => %(hours)s)
+        ORDER BY occurred_at LIMIT %(limit)s)
+"""
+
+def prune_events(conn, hours=EVENT_RETENTION_HOURS, batch_size=PRUNE_BATCH_SIZE):
+    """Delete events older than hours in batches on an autocommit conn; returns the count."""
+    pruned = 0
+    with conn.cursor() as cur:
+        while True:
+            cur.execute(PRUNE_SQL, {'hours': hours, 'limit': batch_size})
+            pruned += cur.rowcount
+            if cur.rowcount < batch_size:
+                return pruned
+
+def replay_start(after_event_id):
+    """The id a resume from after_event_id replays after, REPLAY_OVERLAP ids back."""
+    return max(after_event_id - REPLAY_OVERLAP, 0)
+
+def replay_params(after_id, member_id, book_id, limit=REPLAY_BATCH_SIZE):
+    return {'after': after_id, 'member_id': member_id, 'book_id': book_id, 'limit': limit}
+
+def events_after(after_id, member_id=0, book_id=0, limit=REPLAY_BATCH_SIZE):
+    """Recorded events with id > after_id, oldest first, at most limit."""
+    with get_conn() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(REPLAY_SQL, replay_params(after_id, member_id, book_id, limit))
+            return [parse_event(dict(row)) for row in cur.fetchall()]
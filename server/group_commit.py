@@ -0,0 +1,118 @@
+"""Group commit for small, high-rate writes.
+
+Concurrent calls to the same WriteBatcher that arrive within `window` seconds
+of each other share one transaction: the first caller becomes the leader,
+waits out the window (or until max_batch callers have joined), then runs every
+item on one connection, each inside its own savepoint, and commits once. A
+failing item (an ISBN conflict, say) is rolled back to its savepoint and its
+error is raised in that caller only; if the commit itself fails every caller
+gets that error. Callers block until their batch has committed, so a result
+is never returned for a write that is not durable.
+
+Items are run in `key` order so two batches touching the same rows take
+their locks in the same order instead of deadlocking.
+
+Batching is configured per service call with GROUP_COMMIT, e.g.
+GROUP_COMMIT=create_book=2,create_member=2,borrow_book=1 (window in ms);
+calls not listed commit individually, exactly as before.
+"""
+import os
+import threading
+from time import monotonic
+from psycopg2.extras import RealDictCursor
+import server.deadlines as deadlines
+from server.db import get_conn
+from server.metrics import GROUP_COMMIT_BATCH
+
+MAX_BATCH = int(os.environ.get('GROUP_COMMIT_MAX_BATCH', 64))
+
+def _parse_windows(spec):
+    windows = {}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, ms = entry.partition('=')
+        windows[name.strip()] = float(ms) / 1000
+    return windows
+
+WINDOWS = _parse_windows(os.environ.get('GROUP_COMMIT', ''))
+
+class _Item:
+    __slots__ = ('work', 'args', 'key', 'result', 'error', 'done')
+
+    def __init__(self, work, args, key):
+        self.work = work
+        self.args = args
+        self.key = key
+        self.result = self.error = None
+        self.done = threading.Event()
+
+class WriteBatcher:
+    def __init__(self, name, window=None, max_batch=MAX_BATCH):
+        self.name = name
+        self.window = WINDOWS.get(name, 0) if window is None else window
+        self.max_batch = max_batch
+        self._cond = threading.Condition()
+        self._pending = []
+        self._batch_size = GROUP_COMMIT_BATCH.labels(name)
+
+    def run(self, work, *args, key=None):
+        """Run work(cur, *args) in a committed transaction and return its result.
+        cur is a RealDictCursor; work must not commit or roll back."""
+        if self.window <= 0:
+            return self._run_alone(work, args)
+        item = _Item(work, args, key)
+        with self._cond:
+            self._pending.append(item)
+            leader = len(self._pending) == 1
+            if len(self._pending) >= self.max_batch:
+                self._cond.notify()
+        if leader:
+            deadline = monotonic() + self.window
+            with self._cond:
+                while len(self._pending) < self.max_batch:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._pending = self._pending, []
+            self._flush(batch)
+        item.done.wait()
+        if item.error is not None:
+            raise item.error
+        return item.result
+
+    def _run_alone(self, work, args):
+        with get_conn() as conn:
+            try:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    result = work(cur, *args)
+                conn.commit()
+                return result
+            except Exception:
+                conn.rollback()
+                raise
+
+    def _flush(self, batch):
+        self._batch_size.observe(len(batch))
+        try:
+            # the batch runs outside the leader's RPC scope: its deadline or
+            # disconnect must not cancel the other callers' writes
+            with deadlines.scope(None), get_conn() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    for item in sorted(batch, key=lambda item: (item.key is None, item.key)):
+                        cur.execute('SAVEPOINT group_commit')
+                        try:
+                            item.result = item.work(cur, *item.args)
+                        except Exception as e:
+                            cur.execute('ROLLBACK TO SAVEPOINT group_commit')
+                            item.error = e
+                        else:
+                            cur.execute('RELEASE SAVEPOINT group_commit')
+                conn.commit()
+        except Exception as e:
+            # connection lost or commit failed: nothing in the batch was written
+            for item in batch:
+                if item.error is None:
+                    item.result, item.error = None, e
+        finally:
+            for item in batch:
+                item.done.set()
@@ -0,0 +1,161 @@
+"""Cached liveness and readiness for /health and grpc.health.v1.
+
+A monitor thread probes the database every HEALTH_CHECK_INTERVAL seconds on
+its own connection, so probes never take a pooled connection from traffic,
+and samples pool and executor saturation. /health and the gRPC health service
+answer from the last result instead of touching the database per probe.
+
+The server is ready (SERVING) when the last probe succeeded and it is not
+saturated: no more than HEALTH_MAX_POOL_WAITING callers queued for a pooled
+connection (default: the pool's size) and no more than HEALTH_MAX_QUEUED_RPCS
+RPCs waiting for an executor thread (default: half the admission queue, so
+readiness drops before the server starts shedding).
+"""
+import os
+import threading
+from concurrent import futures
+from time import perf_counter, time
+import psycopg2
+from server.logger import get_logger
+from server.metrics import pool_stats
+
+logger = get_logger('health')
+
+CHECK_INTERVAL = float(os.environ.get('HEALTH_CHECK_INTERVAL', 2))
+PROBE_TIMEOUT = float(os.environ.get('HEALTH_PROBE_TIMEOUT', 2))
+MAX_POOL_WAITING = os.environ.get('HEALTH_MAX_POOL_WAITING')
+MAX_QUEUED_RPCS = os.environ.get('HEALTH_MAX_QUEUED_RPCS')
+
+class QueueCountingExecutor(futures.ThreadPoolExecutor):
+    """ThreadPoolExecutor whose queued() is the number of submitted calls no
+    worker has started yet, for HealthMonitor(queued=executor.queued)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._queued = 0
+        self._queued_lock = threading.Lock()
+
+    def _dequeue(self):
+        with self._queued_lock:
+            self._queued -= 1
+
+    def submit(self, fn, /, *args, **kwargs):
+        def started(*args, **kwargs):
+            self._dequeue()
+            return fn(*args, **kwargs)
+
+        with self._queued_lock:
+            self._queued += 1
+        try:
+            future = super().submit(started, *args, **kwargs)
+        except BaseException:
+            self._dequeue()
+            raise
+        # a call cancelled before it started never reaches started()
+        future.add_done_callback(lambda f: f.cancelled() and self._dequeue())
+        return future
+
+    def queued(self):
+        return self._queued
+
+class HealthMonitor:
+    def __init__(self, dsn, pools=('db',), queued=None, max_queued=None, interval=CHECK_INTERVAL, on_change=None,
+                 publish=None):
+        """pools names the POOLS entries whose wait queue counts towards
+        saturation; queued() returns the number of RPCs waiting for an executor
+        thread, more than max_queued of them is saturation (leave both None
+        when there is no executor, as in asyncio mode). on_change(ready) is called from the monitor thread
+        whenever readiness flips, publish(state) after every check."""
+        self.dsn = dsn
+        self.pools = pools
+        self.queued = queued
+        self.max_queued = int(MAX_QUEUED_RPCS) if MAX_QUEUED_RPCS else max_queued
+        self.max_pool_waiting = int(MAX_POOL_WAITING) if MAX_POOL_WAITING else None
+        self.interval = interval
+        self.on_change = on_change
+        self.publish = publish
+        self.ready = False
+        self.state = {'status': 'starting', 'ready': False, 'database': {'ok': False}, 'saturated': [], 'checked_at': None}
+        self._conn = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _probe(self):
+        started = perf_counter()
+        try:
+            if self._conn is None or self._conn.closed:
+                self._conn = psycopg2.connect(self.dsn, connect_timeout=max(1, round(PROBE_TIMEOUT)),
+                                              options=f'-c statement_timeout={int(PROBE_TIMEOUT * 1000)}')
+                self._conn.autocommit = True
+            with self._conn.cursor() as cur:
+                cur.execute('SELECT 1')
+                cur.fetchone()
+            return {'ok': True, 'latency_ms': round((perf_counter() - started) * 1000, 3)}
+        except psycopg2.Error as e:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            return {'ok': False, 'error': str(e).strip()}
+
+    def _saturation(self, pools, queued):
+        saturated = []
+        for name in self.pools:
+            stats = pools.get(name)
+            if stats is None:
+                continue
+            limit = stats['maxconn'] if self.max_pool_waiting is None else self.max_pool_waiting
+            if stats['waiting'] > limit:
+                saturated.append(f'pool:{name}')
+        if queued is not None and self.max_queued is not None and queued > self.max_queued:
+            saturated.append('executor')
+        return saturated
+
+    def check(self):
+        database = self._probe()
+        pools = pool_stats()
+        queued = self.queued() if self.queued is not None else None
+        saturated = self._saturation(pools, queued)
+        ready = database['ok'] and not saturated
+        state = {'status': 'ok' if database['ok'] else 'down', 'ready': ready, 'database': database,
+                 'saturated': saturated, 'checked_at': time(), 'pools': pools}
+        if queued is not None:
+            state['queued_rpcs'] = queued
+        self.state = state
+        if ready != self.ready:
+            self.ready = ready
+            log = logger.info if ready else logger.warning
+            log('readiness_changed', extra={'ready': ready, 'database_ok': database['ok'], 'saturated': saturated})
+            if self.on_change is not None:
+                self.on_change(ready)
+        if self.publish is not None:
+            self.publish(state)
+        return state
+
+    def _monitor(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception('health_check_failed')
+
+    def start(self):
+        if self._thread is None:
+            self.check()
+            self._thread = threading.Thread(target=self._monitor, name='health-monitor', daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
+
+_monitor = None
+
+def start(dsn, **kwargs):
+    """Start the process-wide monitor that /health reports from."""
+    global _monitor
+    _monitor = HealthMonitor(dsn, **kwargs)
+    _monitor.start()
+    return _monitor
+
+def monitor():
+    return _monitor
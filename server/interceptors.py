@@ -0,0 +1,206 @@
+import os
+import threading
+import time
+import grpc
+import server.deadlines as deadlines
+from server.metrics import RPC_IN_FLIGHT, RPC_LATENCY, RPC_TOTAL
+
+# Calls that read or write many rows; by default they share one concurrency
+# limit so a burst of them cannot take every worker from point reads and writes.
+BULK_METHODS = ('ListBooks', 'ListMembers', 'SearchBooks', 'ListBorrowedByMember', 'StreamBooks',
+                'StreamMembers', 'ListOverdue', 'ImportBooks', 'ImportMembers')
+METHOD_CONCURRENCY = os.environ.get('METHOD_CONCURRENCY')
+# Responses compressed by default: the lists, which can run to megabytes
+COMPRESSED_METHODS = ('ListBooks', 'ListMembers', 'SearchBooks', 'ListBorrowedByMember', 'StreamBooks',
+                      'StreamMembers', 'ListOverdue')
+GRPC_COMPRESSION = os.environ.get('GRPC_COMPRESSION')
+COMPRESSION_ALGORITHM = os.environ.get('GRPC_COMPRESSION_ALGORITHM', 'gzip').lower()
+# responses (stream messages) smaller than this are sent uncompressed
+COMPRESSION_MIN_BYTES = int(os.environ.get('GRPC_COMPRESSION_MIN_BYTES', 4096))
+# grpc core maps a compression level to the algorithms both sides accept,
+# ranked gzip then deflate: low takes the first, high the last
+COMPRESSION_LEVELS = {'gzip': 1, 'deflate': 3}
+
+def _status(context, failed):
+    code = context.code() if hasattr(context, 'code') else None
+    if code is None:
+        code = grpc.StatusCode.UNKNOWN if failed else grpc.StatusCode.OK
+    return code.name
+
+def wrap_handler(handler, wrap):
+    """Rebuild a method handler with its behaviour replaced by
+    wrap(behaviour, response_streaming)."""
+    if handler.unary_unary:
+        return grpc.unary_unary_rpc_method_handler(wrap(handler.unary_unary, False), handler.request_deserializer, handler.response_serializer)
+    if handler.unary_stream:
+        return grpc.unary_stream_rpc_method_handler(wrap(handler.unary_stream, True), handler.request_deserializer, handler.response_serializer)
+    if handler.stream_unary:
+        return grpc.stream_unary_rpc_method_handler(wrap(handler.stream_unary, False), handler.request_deserializer, handler.response_serializer)
+    return grpc.stream_stream_rpc_method_handler(wrap(handler.stream_stream, True), handler.request_deserializer, handler.response_serializer)
+
+class MetricsInterceptor(grpc.ServerInterceptor):
+    """Per-method latency histogram, status-code counter and in-flight gauge.
+    Streaming calls are measured until the last response is sent."""
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None:
+            return None
+        method = handler_call_details.method.rsplit('/', 1)[-1]
+        return wrap_handler(handler, lambda behavior, streaming: self._wrap(method, behavior, streaming))
+
+    @staticmethod
+    def _observers(method):
+        """(start, finish) for one call of method: start() returns the start
+        time, finish(context, started, failed) records the outcome."""
+        latency, in_flight = RPC_LATENCY.labels(method), RPC_IN_FLIGHT.labels(method)
+
+        def start():
+            in_flight.inc()
+            return time.perf_counter()
+
+        def finish(context, started, failed):
+            latency.observe(time.perf_counter() - started)
+            in_flight.dec()
+            RPC_TOTAL.labels(method, _status(context, failed)).inc()
+        return start, finish
+
+    def _wrap(self, method, behavior, response_streaming):
+        start, finish = self._observers(method)
+        if response_streaming:
+            def observed(request, context):
+                started, failed = start(), True
+                try:
+                    yield from behavior(request, context)
+                    failed = False
+                finally:
+                    finish(context, started, failed)
+        else:
+            def observed(request, context):
+                started, failed = start(), True
+                try:
+                    response = behavior(request, context)
+                    failed = False
+                    return response
+                finally:
+                    finish(context, started, failed)
+        return observed
+
+def method_limits(bulk_limit, spec=METHOD_CONCURRENCY):
+    """Concurrency limits as [(methods, limit)]; methods in one entry share
+    the limit. spec is METHOD_CONCURRENCY, e.g.
+    'ListBooks+SearchBooks=4,GetMemberDetail=8' ('' for no limits); without it
+    BULK_METHODS share bulk_limit."""
+    if spec is None:
+        return [(BULK_METHODS, bulk_limit)]
+    return [(methods, int(limit)) for methods, limit in _method_settings(spec)]
+
+def compressed_methods(spec=GRPC_COMPRESSION):
+    """Methods whose large responses are compressed: GRPC_COMPRESSION, e.g.
+    'ListBooks,StreamBooks' ('' for none), or COMPRESSED_METHODS."""
+    if spec is None:
+        return frozenset(COMPRESSED_METHODS)
+    return frozenset(filter(None, (method.strip() for method in spec.split(','))))
+
+def compression_options(algorithm=COMPRESSION_ALGORITHM):
+    """Server options that turn on response compression negotiated per call:
+    grpc picks the preferred algorithm if the client accepts it, the other
+    one if not, and sends uncompressed to clients that accept neither."""
+    if algorithm not in COMPRESSION_LEVELS:
+        raise ValueError(f'unknown GRPC_COMPRESSION_ALGORITHM {algorithm!r}; use gzip or deflate')
+    return [('grpc.default_compression_level', COMPRESSION_LEVELS[algorithm])]
+
+def _method_settings(spec):
+    """'A+B=x,C=y' -> [(('A', 'B'), 'x'), (('C',), 'y')]"""
+    settings = []
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        methods, value = entry.split('=')
+        settings.append((tuple(method.strip() for method in methods.split('+')), value.strip()))
+    return settings
+
+class AdmissionInterceptor(grpc.ServerInterceptor):
+    """Per-method concurrency limits and the deadline scope of every call.
+
+    A call whose method is at its limit fails at once with RESOURCE_EXHAUSTED
+    instead of waiting for a slot. Admitted calls run inside a
+    server.deadlines.Call that ends, cancelling its queries, when the RPC
+    terminates."""
+
+    def __init__(self, limits=()):
+        self._slots = {}
+        for methods, limit in limits:
+            slots = threading.BoundedSemaphore(limit)
+            for method in methods:
+                self._slots[method] = slots
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None:
+            return None
+        method = handler_call_details.method.rsplit('/', 1)[-1]
+        return wrap_handler(handler, lambda behavior, streaming: self._wrap(method, behavior, streaming))
+
+    def _wrap(self, method, behavior, response_streaming):
+        slots = self._slots.get(method)
+
+        def admit(context):
+            if slots is not None and not slots.acquire(blocking=False):
+                context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, f'too many concurrent {method} calls')
+            call = deadlines.Call(context.time_remaining())
+            context.add_callback(call.end)
+            return call
+
+        def release():
+            if slots is not None:
+                slots.release()
+
+        if response_streaming:
+            def admitted(request, context):
+                call = admit(context)
+                try:
+                    with deadlines.scope(call):
+                        yield from behavior(request, context)
+                finally:
+                    release()
+        else:
+            def admitted(request, context):
+                call = admit(context)
+                try:
+                    with deadlines.scope(call):
+                        return behavior(request, context)
+                finally:
+                    release()
+        return admitted
+
+class CompressionInterceptor(grpc.ServerInterceptor):
+    """Limits the compression set up by compression_options() to large
+    responses of the given methods: every other response, and every stream
+    message under min_bytes, is sent uncompressed. Compressed requests are
+    accepted whatever the setting."""
+
+    def __init__(self, methods, min_bytes=COMPRESSION_MIN_BYTES):
+        self.methods = methods
+        self.min_bytes = min_bytes
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None:
+            return None
+        compress = handler_call_details.method.rsplit('/', 1)[-1] in self.methods
+        return wrap_handler(handler, lambda behavior, streaming: self._wrap(compress, behavior, streaming))
+
+    def _wrap(self, compress, behavior, response_streaming):
+        min_bytes = self.min_bytes
+        if response_streaming:
+            def compressed(request, context):
+                for response in behavior(request, context):
+                    if not compress or response.ByteSize() < min_bytes:
+                        context.disable_next_message_compression()
+                    yield response
+        else:
+            def compressed(request, context):
+                response = behavior(request, context)
+                if not compress or response.ByteSize() < min_bytes:
+                    context.disable_next_message_compression()
+                return response
+        return compressed
@@ -0,0 +1,148 @@
+"""Structured JSON logging that stays off the request path.
+
+get_logger(name).info('book_borrowed', extra={...}) only decides whether to
+keep the record and puts it on a bounded queue; a background thread formats
+it as one JSON line and writes it to stdout. When the queue is full the record
+is dropped and counted instead of blocking the caller.
+
+High-volume INFO events can be thinned per event name (the log message):
+  LOG_SAMPLE=book_borrowed=0.1        keep roughly 10% (lines carry sample_rate)
+  LOG_RATE_LIMIT=book_borrowed=100    keep at most 100 per second; the next
+                                      kept line carries how many were suppressed
+Warnings and errors are never sampled or rate limited. Drops by reason are
+exported as library_log_dropped_total.
+
+Extras and %-args are formatted on the writer thread, so pass values rather
+than objects the caller goes on to mutate.
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+from time import monotonic
+from pythonjsonlogger.json import JsonFormatter
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+def _parse_rates(spec):
+    rates = {}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, value = entry.partition('=')
+        rates[name.strip()] = float(value)
+    return rates
+
+SAMPLE = _parse_rates(os.environ.get('LOG_SAMPLE', ''))
+RATE_LIMIT = _parse_rates(os.environ.get('LOG_RATE_LIMIT', 'book_borrowed=100,book_returned=100'))
+
+def json_formatter():
+    return JsonFormatter('%(levelname)s %(name)s %(message)s', timestamp='ts',
+                         rename_fields={'levelname': 'level', 'name': 'logger', 'message': 'event'})
+
+class _Window:
+    __slots__ = ('start', 'kept', 'suppressed')
+
+    def __init__(self, start):
+        self.start = start
+        self.kept = self.suppressed = 0
+
+class QueueingHandler(logging.handlers.QueueHandler):
+    """QueueHandler that samples, rate limits and never blocks."""
+
+    def __init__(self, q, sample=None, rate_limit=None):
+        super().__init__(q)
+        self.sample = SAMPLE if sample is None else sample
+        self.rate_limit = RATE_LIMIT if rate_limit is None else rate_limit
+        self.dropped = {'sampled': 0, 'rate_limited': 0, 'overflow': 0}
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def _drop(self, reason):
+        # += on a dict entry is not atomic; emit runs on every logging thread
+        with self._lock:
+            self.dropped[reason] += 1
+
+    def dropped_counts(self):
+        with self._lock:
+            return dict(self.dropped)
+
+    def _admit(self, record):
+        if record.levelno > logging.INFO:
+            return True
+        event = record.msg
+        rate = self.sample.get(event)
+        if rate is not None:
+            if random.random() >= rate:
+                self._drop('sampled')
+                return False
+            record.sample_rate = rate
+        limit = self.rate_limit.get(event)
+        if limit is not None:
+            now = monotonic()
+            with self._lock:
+                window = self._windows.get(event)
+                if window is None or now - window.start >= 1:
+                    suppressed = window.suppressed if window else 0
+                    window = self._windows[event] = _Window(now)
+                    if suppressed:
+                        record.suppressed = suppressed
+                if window.kept >= limit:
+                    window.suppressed += 1
+                    self.dropped['rate_limited'] += 1
+                    return False
+                window.kept += 1
+        return True
+
+    def prepare(self, record):
+        # Unlike QueueHandler.prepare, leave formatting to the writer thread.
+        # Tracebacks are rendered here so frames are not kept alive in the queue.
+        if record.exc_info:
+            record.exc_text = _formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            if not self._admit(record):
+                return
+            self.queue.put_nowait(self.prepare(record))
+        except queue.Full:
+            self._drop('overflow')
+        except Exception:
+            self.handleError(record)
+
+_formatter = json_formatter()
+_stream = logging.StreamHandler(sys.stdout)
+_stream.setFormatter(_formatter)
+_handler = QueueingHandler(queue.Queue(QUEUE_SIZE))
+_listener = logging.handlers.QueueListener(_handler.queue, _stream)
+
+def _stop():
+    _listener.stop()  # drains what is still queued
+
+def _restart_after_fork():
+    # the writer thread does not survive fork and the queue's or handler's
+    # lock may have been held when it happened, so a forked worker gets fresh ones
+    global _listener
+    _handler.queue = queue.Queue(QUEUE_SIZE)
+    _handler._lock = threading.Lock()
+    _listener = logging.handlers.QueueListener(_handler.queue, _stream)
+    _listener.start()
+
+def stats():
+    return {'queued': _handler.queue.qsize(), 'capacity': QUEUE_SIZE, 'dropped': _handler.dropped_counts()}
+
+if not logging.root.handlers:
+    logging.root.addHandler(_handler)
+    logging.root.setLevel(LOG_LEVEL)
+    _listener.start()
+    atexit.register(_stop)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=_restart_after_fork)
+
+def get_logger(name):
+    return logging.getLogger(name)
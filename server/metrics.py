@@ -0,0 +1,118 @@
+import glob
+import json
+import os
+import time
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, REGISTRY
+import server.cache as entity_cache
+import server.logger as log
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+RPC_LATENCY = Histogram('library_rpc_duration_seconds', 'gRPC handler latency', ['method'], buckets=LATENCY_BUCKETS)
+RPC_TOTAL = Counter('library_rpc_total', 'Completed gRPC calls by status code', ['method', 'code'])
+# multiprocess_mode only applies under the prefork supervisor (PROMETHEUS_MULTIPROC_DIR)
+RPC_IN_FLIGHT = Gauge('library_rpc_in_flight', 'gRPC calls currently being handled', ['method'], multiprocess_mode='livesum')
+# phase: pool_wait (getconn), query (cursor execute), commit
+DB_TIME = Histogram('library_db_seconds', 'Time spent in the database layer', ['phase'], buckets=LATENCY_BUCKETS)
+DB_READS = Counter('library_db_reads_total', 'Read-only connections by where they were served', ['target'])
+REPLICA_LAG = Gauge('library_db_replica_lag_seconds', 'Replay lag of each read replica (NaN while unreachable)', ['replica'],
+                    multiprocess_mode='livemax')
+GROUP_COMMIT_BATCH = Histogram('library_group_commit_batch_size', 'Writes committed together per group commit', ['call'],
+                               buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+WATCH_DROPPED = Counter('library_watch_dropped_total', 'WatchBorrowings subscribers closed by the feed', ['reason'])
+
+# pool name -> callable returning its stats(); filled in by the db modules' init_pool
+POOLS = {}
+
+def pool_stats():
+    return {name: stats() for name, stats in POOLS.items()}
+
+def local_stats():
+    """Scrape-time statistics of this process's entity caches, pools and log queue."""
+    return {'cache': entity_cache.stats(), 'pools': pool_stats(), 'log': log.stats()}
+
+class StatsCollector:
+    """Entity cache, connection pool and log queue statistics, which live in
+    process memory rather than in prometheus_client metrics.
+
+    sources() returns (worker, stats) pairs in the shape of local_stats(). worker
+    is None for this process; the prefork supervisor passes each worker's last
+    snapshot instead, and every family then gains a worker label."""
+
+    def __init__(self, sources):
+        self.sources = sources
+
+    def collect(self):
+        sources = self.sources()
+        by_worker = ['worker'] if any(worker is not None for worker, _ in sources) else []
+
+        def family(kind, name, documentation, labels=()):
+            return kind(name, documentation, labels=[*labels, *by_worker])
+
+        cache_size = family(GaugeMetricFamily, 'library_entity_cache_size', 'Entries in the entity cache', ['cache'])
+        cache_counters = {name: family(CounterMetricFamily, f'library_entity_cache_{name}', f'Entity cache {name}', ['cache'])
+                          for name in ('hits', 'misses', 'evictions', 'invalidations')}
+        connections = family(GaugeMetricFamily, 'library_db_pool_connections', 'Pooled connections by state', ['pool', 'state'])
+        waiting = family(GaugeMetricFamily, 'library_db_pool_waiting', 'Callers queued for a connection', ['pool'])
+        pool_counters = {name: family(CounterMetricFamily, f'library_db_pool_{name}', f'Connection pool {name}', ['pool'])
+                         for name in ('acquired', 'timeouts')}
+        dropped = family(CounterMetricFamily, 'library_log_dropped', 'Log records not written', ['reason'])
+        queue_depth = family(GaugeMetricFamily, 'library_log_queue_depth', 'Log records waiting for the writer thread')
+        for worker, stats in sources:
+            labels = [str(worker)] if by_worker else []
+            for cache, s in stats['cache'].items():
+                cache_size.add_metric([cache, *labels], s['size'])
+                for name, f in cache_counters.items():
+                    f.add_metric([cache, *labels], s[name])
+            for pool, s in stats['pools'].items():
+                connections.add_metric([pool, 'in_use', *labels], s['in_use'])
+                connections.add_metric([pool, 'idle', *labels], s['idle'])
+                waiting.add_metric([pool, *labels], s['waiting'])
+                for name, f in pool_counters.items():
+                    f.add_metric([pool, *labels], s[name])
+            for reason, count in stats['log']['dropped'].items():
+                dropped.add_metric([reason, *labels], count)
+            queue_depth.add_metric(labels, stats['log']['queued'])
+        yield cache_size
+        yield from cache_counters.values()
+        yield connections
+        yield waiting
+        yield from pool_counters.values()
+        yield dropped
+        yield queue_depth
+
+REGISTRY.register(StatsCollector(lambda: [(None, local_stats())]))
+
+def write_snapshot(directory, worker, health):
+    """Publish this worker's local_stats() and health state for the prefork
+    supervisor, next to the prometheus_client multiprocess files."""
+    path = os.path.join(directory, f'worker-{worker}.json')
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(dict(local_stats(), health=health, pid=os.getpid(), written_at=time.time()), f, default=str)
+    os.replace(tmp, path)
+
+def worker_snapshots(directory):
+    snapshots = {}
+    for path in glob.glob(os.path.join(directory, 'worker-*.json')):
+        try:
+            with open(path) as f:
+                snapshots[os.path.basename(path)[len('worker-'):-len('.json')]] = json.load(f)
+        except (OSError, ValueError):
+            continue  # replaced while reading; the next scrape sees it
+    return snapshots
+
+_registry = REGISTRY
+
+def aggregate_workers(directory):
+    """Make render() report every prefork worker: their prometheus_client
+    multiprocess files plus their last stats snapshots."""
+    global _registry
+    _registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(_registry, path=directory)
+    _registry.register(StatsCollector(lambda: sorted(worker_snapshots(directory).items())))
+
+def render():
+    """Prometheus text exposition of every registered metric."""
+    return generate_latest(_registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,72 @@
+import base64
+from datetime import datetime, timedelta, timezone
+
+MAX_PAGE_SIZE = 1000
+
+def clamp_page_size(page_size):
+    if page_size < 0:
+        raise ValueError('page_size must not be negative')
+    return min(page_size, MAX_PAGE_SIZE)
+
+def _encode(kind, value):
+    return base64.urlsafe_b64encode(f'{kind}:{value}'.encode()).decode().rstrip('=')
+
+def _decode(kind, token, parse=int, empty=0):
+    if not token:
+        return empty
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        prefix, _, value = raw.partition(':')
+        if prefix != kind:
+            raise ValueError(raw)
+        return parse(value)
+    except Exception:
+        raise ValueError('INVALID_PAGE_TOKEN')
+
+def encode_page_token(last_id):
+    return _encode('id', last_id)
+
+def decode_page_token(token):
+    """Return the last id seen by the previous page, or 0 for the first page."""
+    return _decode('id', token)
+
+def next_page_token(columns, rows, page_size):
+    """Keyset token after the last row of a full page of tuple rows, else ''."""
+    if not page_size or len(rows) < page_size:
+        return ''
+    return encode_page_token(rows[-1][columns.index('id')])
+
+def encode_rank_token(rank, last_id):
+    """Keyset token for results ordered by (rank DESC, id), e.g. search."""
+    return _encode('rank', f'{rank!r}/{last_id}')
+
+def _parse_rank(value):
+    rank, last_id = value.split('/')
+    return float(rank), int(last_id)
+
+def decode_rank_token(token):
+    """Return (rank, last_id) of the previous page, or None for the first page."""
+    return _decode('rank', token, _parse_rank, None)
+
+def next_rank_token(columns, rows, page_size):
+    """Keyset token after the last row of a full page with a rank column, else ''."""
+    if not page_size or len(rows) < page_size:
+        return ''
+    last = rows[-1]
+    return encode_rank_token(last[columns.index('rank')], last[columns.index('id')])
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def encode_due_token(due_at, last_id):
+    """Keyset token for results ordered by (due_at, id)."""
+    delta = due_at - _EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return _encode('due', f'{micros}/{last_id}')
+
+def _parse_due(value):
+    micros, last_id = value.split('/')
+    return _EPOCH + timedelta(microseconds=int(micros)), int(last_id)
+
+def decode_due_token(token):
+    """Return (due_at, last_id) of the previous page, or None for the first page."""
+    return _decode('due', token, _parse_due, None)
@@ -0,0 +1,234 @@
+"""Pre-fork mode: SERVER_WORKERS=N runs N server processes on one gRPC port.
+
+`python -m server.app` becomes a supervisor that starts N copies of the server
+(threaded, or asyncio with GRPC_ASYNC=1) as child processes. Each binds the
+gRPC port with SO_REUSEPORT, so the kernel spreads incoming connections across
+them and protobuf conversion, validation and framing run on N cores instead of
+under one GIL. Balancing is per connection: a client holding one channel
+talks to one worker.
+
+Connections: every worker gets DB_MAXCONN = (budget / N) - its fixed overhead
+(health probe, change-feed and cache listeners, replica monitor, the asyncio
+mode's psycopg2 pool), capped at the worker's own default. The budget is
+DB_CONNECTION_BUDGET, or Postgres max_connections less the superuser reserve
+and DB_CONNECTION_HEADROOM (default 10). An explicit DB_MAXCONN is kept and
+only warned about when N workers would exceed the budget.
+
+The supervisor restarts workers that exit, backing off up to 30s while they
+keep dying young, and serves /health, /ready and /metrics on port 8081 for all
+of them: workers drop their stats and health state next to the
+prometheus_client multiprocess files after every health check. Workers always
+run with ENTITY_CACHE_NOTIFY=1 so a write in one invalidates the others'
+entity caches. Read-your-writes pinning to the primary (server.db.mark_written)
+is still per worker.
+"""
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+from time import monotonic, time
+import psycopg2
+from flask import Flask, Response, jsonify
+from prometheus_client import multiprocess
+from server.config import ASYNC_MODE, DATABASE_URL, GRPC_MAX_WORKERS, SERVER_WORKERS
+from server.db import DATABASE_READ_URLS
+from server.health import CHECK_INTERVAL
+from server.logger import get_logger
+import server.metrics as metrics
+
+logger = get_logger('prefork')
+
+CONNECTION_BUDGET = os.environ.get('DB_CONNECTION_BUDGET')
+CONNECTION_HEADROOM = int(os.environ.get('DB_CONNECTION_HEADROOM', 10))
+# default pool size of a single server: one connection per executor thread,
+# or the asyncio pool's default
+DEFAULT_MAXCONN = 20 if ASYNC_MODE else GRPC_MAX_WORKERS
+RESTART_BACKOFF_MAX = 30
+# a worker that ran at least this long before exiting is restarted right away
+HEALTHY_RUN = 10
+SHUTDOWN_GRACE = 10
+
+def connection_budget(dsn=DATABASE_URL):
+    if CONNECTION_BUDGET:
+        return int(CONNECTION_BUDGET)
+    conn = psycopg2.connect(dsn, connect_timeout=5)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT current_setting('max_connections')::int - current_setting('superuser_reserved_connections')::int")
+            return cur.fetchone()[0] - CONNECTION_HEADROOM
+    finally:
+        conn.close()
+
+def worker_overhead(async_mode=ASYNC_MODE, replicas=bool(DATABASE_READ_URLS)):
+    """Primary connections a worker holds outside its main pool."""
+    overhead = 3  # health probe, borrowing feed listener, cache invalidation listener
+    if replicas:
+        overhead += 1  # replica monitor's connection to the primary
+    if async_mode:
+        overhead += int(os.environ.get('DB_SYNC_MAXCONN', 2))
+    return overhead
+
+def pool_slice(budget, workers, overhead):
+    size = budget // workers - overhead
+    if size < 1:
+        raise ValueError(f'a budget of {budget} connections cannot fit {workers} workers '
+                         f'needing {overhead + 1} each; lower SERVER_WORKERS or raise DB_CONNECTION_BUDGET')
+    return size
+
+class Worker:
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.started = 0
+        self.restarts = 0
+        self.backoff = 1
+        # set while the worker is down and waiting to be restarted
+        self.restart_at = None
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process else None
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+class Supervisor:
+    def __init__(self, workers, env, directory):
+        self.workers = workers
+        self.env = env
+        self.directory = directory
+        self._stopping = threading.Event()
+
+    def _spawn(self, worker):
+        env = dict(self.env, SERVER_WORKER_ID=str(worker.index))
+        worker.process = subprocess.Popen([sys.executable, '-m', 'server.app'], env=env)
+        worker.started = monotonic()
+        logger.info('worker_started', extra={'worker': worker.index, 'pid': worker.pid})
+
+    def _reap(self, worker):
+        # drop the dead process's live gauges (in-flight RPCs, replica lag)
+        multiprocess.mark_process_dead(worker.pid, self.directory)
+        if monotonic() - worker.started >= HEALTHY_RUN:
+            worker.backoff = 1
+        else:
+            worker.backoff = min(worker.backoff * 2, RESTART_BACKOFF_MAX)
+        worker.restart_at = monotonic() + worker.backoff
+        logger.error('worker_exited', extra={'worker': worker.index, 'pid': worker.pid,
+                                             'returncode': worker.process.returncode, 'restart_in': worker.backoff})
+
+    def check(self):
+        for worker in self.workers:
+            if worker.restart_at is None:
+                if not worker.alive():
+                    self._reap(worker)
+            elif monotonic() >= worker.restart_at:
+                worker.restart_at = None
+                worker.restarts += 1
+                self._spawn(worker)
+
+    def run(self):
+        for worker in self.workers:
+            self._spawn(worker)
+        while not self._stopping.wait(0.5):
+            self.check()
+        self._shutdown()
+
+    def stop(self, *_):
+        self._stopping.set()
+
+    def _shutdown(self):
+        running = [worker for worker in self.workers if worker.alive()]
+        for worker in running:
+            worker.process.send_signal(signal.SIGINT)  # KeyboardInterrupt: graceful server stop
+        deadline = monotonic() + SHUTDOWN_GRACE
+        for worker in running:
+            try:
+                worker.process.wait(max(0, deadline - monotonic()))
+            except subprocess.TimeoutExpired:
+                worker.process.kill()
+                worker.process.wait()
+
+    @property
+    def state(self):
+        """Combined health: live while any worker's database probe succeeds,
+        ready only while every worker is (a saturated worker still receives
+        its share of new connections)."""
+        snapshots = metrics.worker_snapshots(self.directory)
+        stale = time() - 3 * CHECK_INTERVAL - 1
+        workers = {}
+        for worker in self.workers:
+            snapshot = snapshots.get(str(worker.index))
+            health = None
+            if snapshot and snapshot['pid'] == worker.pid and snapshot['written_at'] >= stale and worker.alive():
+                health = snapshot['health']
+            workers[worker.index] = {
+                'pid': worker.pid, 'alive': worker.alive(), 'restarts': worker.restarts,
+                'status': health['status'] if health else ('starting' if worker.alive() else 'down'),
+                'ready': bool(health and health['ready']),
+                'saturated': health['saturated'] if health else [],
+                'database': health['database'] if health else None,
+                'pools': snapshot['pools'] if health else {},
+            }
+        return {'status': 'ok' if any(w['status'] == 'ok' for w in workers.values()) else 'down',
+                'ready': all(w['ready'] for w in workers.values()),
+                'workers': workers}
+
+supervisor_app = Flask(__name__)
+_supervisor = None
+
+@supervisor_app.route('/health')
+def health():
+    state = _supervisor.state
+    return jsonify(state), 200 if state['status'] == 'ok' else 503
+
+@supervisor_app.route('/ready')
+def ready():
+    state = _supervisor.state
+    return jsonify(state), 200 if state['ready'] else 503
+
+@supervisor_app.route('/cache')
+def cache_stats():
+    return jsonify({worker: snapshot['cache'] for worker, snapshot in metrics.worker_snapshots(_supervisor.directory).items()})
+
+@supervisor_app.route('/metrics')
+def prometheus_metrics():
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+def _clear(directory):
+    # multiprocess files from an earlier run would be summed into this one
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+
+def main():
+    global _supervisor
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        _clear(directory)
+    else:
+        directory = tempfile.mkdtemp(prefix='library-metrics-')
+    budget, overhead = connection_budget(), worker_overhead()
+    if 'DB_MAXCONN' in os.environ:
+        maxconn = int(os.environ['DB_MAXCONN'])
+        if SERVER_WORKERS * (maxconn + overhead) > budget:
+            logger.warning('connection_budget_exceeded', extra={'workers': SERVER_WORKERS, 'db_maxconn': maxconn,
+                                                                'overhead': overhead, 'budget': budget})
+    else:
+        maxconn = min(pool_slice(budget, SERVER_WORKERS, overhead), DEFAULT_MAXCONN)
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=directory, DB_MAXCONN=str(maxconn), ENTITY_CACHE_NOTIFY='1')
+    metrics.aggregate_workers(directory)
+    _supervisor = Supervisor([Worker(i) for i in range(SERVER_WORKERS)], env, directory)
+    signal.signal(signal.SIGTERM, _supervisor.stop)
+    signal.signal(signal.SIGINT, _supervisor.stop)
+    threading.Thread(target=lambda: supervisor_app.run(host='0.0.0.0', port=8081), daemon=True).start()
+    logger.info('prefork_started', extra={'workers': SERVER_WORKERS, 'db_maxconn': maxconn, 'budget': budget,
+                                          'metrics_dir': directory})
+    try:
+        _supervisor.run()
+    finally:
+        if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+            shutil.rmtree(directory, ignore_errors=True)
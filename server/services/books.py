@@ -1,42 +1,115 @@
-from server.db import get_conn
+import re
+from server.db import get_conn, column_names, mark_written
+from server.statements import projection, statement, execute
 from psycopg2.extras import RealDictCursor
 from psycopg2 import IntegrityError
 from server.logger import get_logger
+from server.bulk import copy_buffer, split_duplicates
+import server.cache as cache
+from server.group_commit import WriteBatcher
+from server.services.catalog import AVAILABILITY_VERSIONS, read_version
 
 logger = get_logger('books_service')
 
+STREAM_BATCH_SIZE = 1000
+# Explicit column list keeps the search_vector column out of result rows.
+BOOK_COLUMNS = 'id, isbn, title, author, publisher, published_date, available, created_at, updated_at'
+
+CREATE = statement('create_book', f"""
+    INSERT INTO books(isbn, title, author, publisher, published_date, created_at, updated_at)
+    VALUES (%s,%s,%s,%s,%s, now(), now()) RETURNING {BOOK_COLUMNS}
+""")
+UPDATE = statement('update_book', f"""
+    UPDATE books SET isbn=%s, title=%s, author=%s, publisher=%s, published_date=%s, updated_at=now()
+    WHERE id=%s RETURNING {BOOK_COLUMNS}
+""")
+# FOR UPDATE blocks borrows of the book (their foreign key check) until the
+# delete commits, so a loan cannot slip in between the check and the delete.
+AVAILABLE = statement('book_available', 'SELECT available FROM books WHERE id=%s FOR UPDATE')
+DELETE = statement('delete_book', 'DELETE FROM books WHERE id=%s RETURNING id')
+BY_ID = statement('book_by_id', f'SELECT {BOOK_COLUMNS} FROM books WHERE id=%s')
+PAGE_SQL = 'SELECT {columns} FROM books WHERE id > %s ORDER BY id LIMIT %s'
+ALL_SQL = 'SELECT {columns} FROM books ORDER BY id'
+# available_only: range scans of the idx_books_available partial index, which
+# holds only books without an active loan
+AVAILABLE_PAGE_SQL = 'SELECT {columns} FROM books WHERE available AND id > %s ORDER BY id LIMIT %s'
+AVAILABLE_ALL_SQL = 'SELECT {columns} FROM books WHERE available ORDER BY id'
+# (paged, available_only) -> (statement name, template)
+LIST_SQL = {
+    (True, False): ('books_page', PAGE_SQL),
+    (False, False): ('books_all', ALL_SQL),
+    (True, True): ('available_books_page', AVAILABLE_PAGE_SQL),
+    (False, True): ('available_books_all', AVAILABLE_ALL_SQL),
+}
+LISTS = {key: statement(name, sql.format(columns=BOOK_COLUMNS)) for key, (name, sql) in LIST_SQL.items()}
+STREAM_SQL = ALL_SQL.format(columns=BOOK_COLUMNS)
+
+CREATE_BATCHER = WriteBatcher('create_book')
+
+def _insert_book(cur, data):
+    execute(cur, CREATE, (data.get('isbn'), data['title'], data.get('author'), data.get('publisher'), data.get('published_date')))
+    return cur.fetchone()
+
 def create_book(data):
+    try:
+        row = CREATE_BATCHER.run(_insert_book, data, key=data.get('isbn') or '')
+    except IntegrityError:
+        logger.warning('create_book_duplicate', extra={'isbn': data.get('isbn')})
+        raise ValueError('ALREADY_EXISTS')
+    except Exception:
+        logger.exception('create_book_failed')
+        raise
+    mark_written('books')
+    logger.info('book_created', extra={'book_id': row['id']})
+    return row
+
+def import_books(batch):
+    """Load a batch of validated (index, data) pairs in one transaction using COPY.
+
+    Returns (imported, conflicts) where conflicts is a list of (index, isbn) for
+    rows skipped because the ISBN already exists in the table or earlier in the batch.
+    """
+    rows, duplicates = split_duplicates(batch, 'isbn')
     with get_conn() as conn:
         try:
-            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    CREATE TEMP TABLE IF NOT EXISTS import_books (
+                        idx INTEGER, isbn VARCHAR(32), title TEXT, author TEXT, publisher TEXT, published_date DATE
+                    ) ON COMMIT DELETE ROWS
+                """)
+                cur.copy_expert('COPY import_books (idx, isbn, title, author, publisher, published_date) FROM STDIN',
+                                copy_buffer((i, d.get('isbn'), d['title'], d.get('author'), d.get('publisher'), d.get('published_date')) for i, d in rows))
                 cur.execute("""
                     INSERT INTO books(isbn, title, author, publisher, published_date, created_at, updated_at)
-                    VALUES (%s,%s,%s,%s,%s, now(), now()) RETURNING *
-                """, (data.get('isbn'), data['title'], data.get('author'), data.get('publisher'), data.get('published_date')))
-                row = cur.fetchone()
+                    SELECT isbn, title, author, publisher, published_date, now(), now() FROM import_books ORDER BY idx
+                    ON CONFLICT (isbn) DO NOTHING RETURNING isbn
+                """)
+                inserted = {r[0] for r in cur.fetchall() if r[0]}
             conn.commit()
-            logger.info('book_created', extra={'book_id': row['id']})
-            return row
-        except IntegrityError:
-            conn.rollback()
-            logger.warning('create_book_duplicate', extra={'isbn': data.get('isbn')})
-            raise ValueError('ALREADY_EXISTS')
+            mark_written('books')
         except Exception:
             conn.rollback()
-            logger.exception('create_book_failed')
+            logger.exception('import_books_failed')
             raise
+    existing = [(i, d['isbn']) for i, d in rows if d.get('isbn') and d['isbn'] not in inserted]
+    imported = len(rows) - len(existing)
+    conflicts = sorted(duplicates + existing)
+    logger.info('books_imported', extra={'imported': imported, 'conflicts': len(conflicts)})
+    return imported, conflicts
 
 def update_book(data):
     with get_conn() as conn:
         try:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute("""
-                    UPDATE books SET isbn=%s, title=%s, author=%s, publisher=%s, published_date=%s, updated_at=now()
-                    WHERE id=%s RETURNING *
-                """, (data.get('isbn'), data['title'], data.get('author'), data.get('publisher'), data.get('published_date'), data['id']))
+                execute(cur, UPDATE, (data.get('isbn'), data['title'], data.get('author'), data.get('publisher'), data.get('published_date'), data['id']))
                 row = cur.fetchone()
+                if row:
+                    cache.notify_invalidation(cur, 'books', row['id'])
             if row:
                 conn.commit()
+                mark_written('books', f"book:{row['id']}")
+                cache.books.invalidate(row['id'])
                 logger.info('book_updated', extra={'book_id': row['id']})
                 return row
             conn.rollback()
@@ -54,15 +127,18 @@ def delete_book(book_id):
     with get_conn() as conn:
         try:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                # Check if book is currently borrowed
-                cur.execute("SELECT id FROM borrowings WHERE book_id=%s AND status='BORROWED'", (book_id,))
-                if cur.fetchone():
+                execute(cur, AVAILABLE, (book_id,))
+                book = cur.fetchone()
+                if book and not book['available']:
                     raise ValueError('CANNOT_DELETE_BORROWED')
-                
-                cur.execute("DELETE FROM books WHERE id=%s RETURNING id", (book_id,))
+                execute(cur, DELETE, (book_id,))
                 row = cur.fetchone()
+                if row:
+                    cache.notify_invalidation(cur, 'books', book_id)
             if row:
                 conn.commit()
+                mark_written('books', f'book:{book_id}')
+                cache.books.invalidate(book_id)
                 logger.info('book_deleted', extra={'book_id': book_id})
                 return True
             conn.rollback()
@@ -75,14 +151,103 @@ def delete_book(book_id):
             logger.exception('delete_book_failed')
             raise
 
-def get_book(book_id):
-    with get_conn() as conn:
+def _fetch_book(book_id):
+    with get_conn(readonly=True, scopes=(f'book:{book_id}',)) as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute('SELECT * FROM books WHERE id=%s', (book_id,))
+            execute(cur, BY_ID, (book_id,))
             return cur.fetchone()
 
-def list_books():
-    with get_conn() as conn:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute('SELECT * FROM books ORDER BY id')
-            return cur.fetchall()
+def get_book(book_id):
+    # read-through: rows are shared with other callers, do not mutate the result
+    return cache.books.load(book_id, lambda: _fetch_book(book_id))
+
+def version_tables(fields, available_only):
+    """catalog_versions counters a ListBooks response depends on: availability
+    only when it filters on or returns books.available."""
+    if available_only or fields is None or 'available' in fields:
+        return ('books',) + AVAILABILITY_VERSIONS
+    return ('books',)
+
+def list_books(page_size=0, after_id=0, if_version=0, fields=None, available_only=False):
+    """Return (version, columns, tuple rows) ordered by id. When if_version is
+    the current table version the rows are not read and columns/rows are None.
+    fields (convert.BOOK.fields) limits the columns read; available_only skips
+    books on loan."""
+    with get_conn(readonly=True, scopes=('books',)) as conn:
+        with conn.cursor() as cur:
+            # Read the version first: the rows below are then at least that new,
+            # so a client can never pair stale rows with a newer version.
+            version = read_version(cur, *version_tables(fields, available_only))
+            if if_version and if_version == version:
+                return version, None, None
+            key = (bool(page_size), available_only)
+            stmt = LISTS[key] if fields is None else projection(*LIST_SQL[key], fields)
+            execute(cur, stmt, (after_id, page_size) if page_size else None)
+            return version, column_names(cur), cur.fetchall()
+
+def stream_books(batch_size=STREAM_BATCH_SIZE):
+    # Named (server-side) cursor: yields (columns, rows) batches of batch_size so
+    # memory stays flat regardless of table size. The pooled connection is held until
+    # the caller finishes iterating or closes the generator.
+    with get_conn(readonly=True, scopes=('books',)) as conn:
+        try:
+            with conn.cursor(name='stream_books') as cur:
+                cur.execute(STREAM_SQL)
+                while True:
+                    rows = cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield column_names(cur), rows
+        finally:
+            conn.rollback()
+
+# Rows each index arm may contribute before ranking, so a short or common term
+# ranks at most a few thousand candidates however many books match it
+SEARCH_CANDIDATES = 1000
+# words shorter than this match whole words only; a one- or two-letter prefix
+# would expand to a large part of the index
+SEARCH_MIN_PREFIX = 3
+
+SEARCH_SQL = f"""
+    WITH q AS (SELECT to_tsquery('simple', %(tsquery)s) AS tsq),
+    candidates AS (
+        (SELECT b.id FROM books b, q WHERE b.search_vector @@ q.tsq LIMIT %(candidates)s)
+        UNION (SELECT id FROM books WHERE title %% %(text)s LIMIT %(candidates)s)
+        UNION (SELECT id FROM books WHERE author %% %(text)s LIMIT %(candidates)s)
+        UNION (SELECT id FROM books WHERE publisher %% %(text)s LIMIT %(candidates)s)
+        UNION (SELECT id FROM books WHERE isbn LIKE %(isbn_prefix)s ORDER BY isbn LIMIT %(candidates)s)
+    )
+    SELECT {BOOK_COLUMNS}, rank FROM (
+        SELECT b.*, ts_rank_cd(b.search_vector, q.tsq) + similarity(b.title, %(text)s) AS rank
+        FROM candidates c JOIN books b USING (id), q
+    ) ranked
+    WHERE %(after_id)s = 0 OR rank < %(after_rank)s::real OR (rank = %(after_rank)s::real AND id > %(after_id)s)
+    ORDER BY rank DESC, id
+    LIMIT %(limit)s
+"""
+SEARCH = statement('search_books', SEARCH_SQL)
+
+def _search_terms(query):
+    """Build a tsquery ('harry:* & pot:* & of') matching words of at least
+    SEARCH_MIN_PREFIX characters by prefix and, for digit-only input, an ISBN
+    prefix pattern. Raises ValueError when the query has no usable terms."""
+    words = re.findall(r'\w+', query.lower())
+    if not words:
+        raise ValueError('query must contain at least one word')
+    digits = re.sub(r'[\s-]', '', query)
+    isbn_prefix = digits + '%' if digits.isdigit() else None
+    return ' & '.join(f'{w}:*' if len(w) >= SEARCH_MIN_PREFIX else w for w in words), isbn_prefix
+
+def _search_params(query, limit, after):
+    tsquery, isbn_prefix = _search_terms(query)
+    after_rank, after_id = after or (0, 0)
+    return {'text': query, 'tsquery': tsquery, 'isbn_prefix': isbn_prefix, 'candidates': SEARCH_CANDIDATES,
+            'after_rank': after_rank, 'after_id': after_id, 'limit': limit}
+
+def search_books(query, limit, after=None):
+    """Best matches first, as (columns, tuple rows) with a trailing rank
+    column. after is the (rank, id) of the previous page's last row."""
+    with get_conn(readonly=True, scopes=('books',)) as conn:
+        with conn.cursor() as cur:
+            execute(cur, SEARCH, _search_params(query, limit, after))
+            return column_names(cur), cur.fetchall()
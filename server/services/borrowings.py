@@ -1,45 +1,107 @@
-from server.db import get_conn
+from server.db import get_conn, column_names, mark_written
+from server.statements import projection, statement, execute
 from psycopg2.extras import RealDictCursor
+from psycopg2.errors import ForeignKeyViolation
 from server.logger import get_logger
+from server.group_commit import WriteBatcher
+import server.cache as cache
 
 logger = get_logger('borrowings_service')
 
+BORROW_SQL = """
+    WITH b AS (SELECT id FROM books WHERE id=%(book_id)s),
+         m AS (SELECT id FROM members WHERE id=%(member_id)s),
+         ins AS (
+             INSERT INTO borrowings(book_id, member_id, borrowed_at, due_at, status)
+             SELECT b.id, m.id, now(), %(due_at)s, 'BORROWED' FROM b, m
+             ON CONFLICT (book_id) WHERE status = 'BORROWED' DO NOTHING
+             RETURNING *
+         )
+    SELECT EXISTS (SELECT 1 FROM b) AS book_found, EXISTS (SELECT 1 FROM m) AS member_found, ins.*
+    FROM (SELECT 1) AS one LEFT JOIN ins ON true
+"""
+BORROW = statement('borrow_book', BORROW_SQL)
+BORROWING_BY_ID = statement('borrowing_by_id', 'SELECT * FROM borrowings WHERE id=%s')
+# the status guard makes one of two concurrent returns of a loan find nothing to update
+RETURN_SQL = "UPDATE borrowings SET returned_at=now(), status='RETURNED' WHERE id=%s AND status='BORROWED' RETURNING *"
+RETURN = statement('return_book', RETURN_SQL)
+# borrowings' foreign keys (default names from db/schema.sql)
+MEMBER_FKEY = 'borrowings_member_id_fkey'
+
+def _missing(e):
+    """The error for a ForeignKeyViolation raised by a borrow: the book or
+    member was deleted between the existence check and the insert."""
+    return 'MEMBER_NOT_FOUND' if e.diag.constraint_name == MEMBER_FKEY else 'BOOK_NOT_FOUND'
+
+
+def _borrow_result(row):
+    """Map the single row returned by BORROW_SQL to (borrowing, error)."""
+    if not row['book_found']:
+        return None, 'BOOK_NOT_FOUND'
+    if not row['member_found']:
+        return None, 'MEMBER_NOT_FOUND'
+    if row['id'] is None:
+        return None, 'ALREADY_BORROWED'
+    del row['book_found'], row['member_found']
+    return row, None
+
+def _availability_changed(book_ids):
+    """After a committed borrow or return: the borrowings trigger flipped
+    books.available for book_ids, so their cached and replica copies are stale."""
+    if not book_ids:
+        return
+    mark_written('books', *(f'book:{book_id}' for book_id in book_ids))
+    for book_id in book_ids:
+        cache.books.invalidate(book_id)
+
+BORROW_BATCHER = WriteBatcher('borrow_book')
+
+def _borrow(cur, book_id, member_id, due_at):
+    execute(cur, BORROW, {'book_id': book_id, 'member_id': member_id, 'due_at': due_at})
+    row, err = _borrow_result(cur.fetchone())
+    if row:
+        cache.notify_invalidation(cur, 'books', book_id)
+    return row, err
+
 def borrow_book(book_id, member_id, due_at=None):
-    with get_conn() as conn:
-        try:
-            with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute('SELECT id FROM books WHERE id=%s', (book_id,))
-                if not cur.fetchone():
-                    return None, 'BOOK_NOT_FOUND'
-                cur.execute('SELECT id FROM members WHERE id=%s', (member_id,))
-                if not cur.fetchone():
-                    return None, 'MEMBER_NOT_FOUND'
-                cur.execute("SELECT * FROM borrowings WHERE book_id=%s AND status='BORROWED'", (book_id,))
-                if cur.fetchone():
-                    return None, 'ALREADY_BORROWED'
-                cur.execute('INSERT INTO borrowings(book_id, member_id, borrowed_at, due_at, status) VALUES (%s,%s,now(),%s,%s) RETURNING *', (book_id, member_id, due_at, 'BORROWED'))
-                row = cur.fetchone()
-            conn.commit()
-            logger.info('book_borrowed', extra={'book_id': book_id, 'member_id': member_id})
-            return row, None
-        except Exception:
-            conn.rollback()
-            logger.exception('borrow_book_failed')
-            raise
+    # One round trip: existence checks and the insert run in a single statement,
+    # and the partial unique index on active loans makes concurrent borrows of the
+    # same book resolve to exactly one winner. A failed check inserts nothing,
+    # so committing it (alone or with a group) is harmless.
+    try:
+        row, err = BORROW_BATCHER.run(_borrow, book_id, member_id, due_at, key=book_id)
+    except ForeignKeyViolation as e:
+        return None, _missing(e)
+    except Exception:
+        logger.exception('borrow_book_failed')
+        raise
+    if err:
+        return None, err
+    mark_written(f'loans:{member_id}')
+    _availability_changed([book_id])
+    logger.info('book_borrowed', extra={'book_id': book_id, 'member_id': member_id})
+    return row, None
 
 def return_book(borrowing_id):
     with get_conn() as conn:
         try:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute('SELECT * FROM borrowings WHERE id=%s', (borrowing_id,))
+                execute(cur, BORROWING_BY_ID, (borrowing_id,))
                 row = cur.fetchone()
                 if not row:
                     return None, 'NOT_FOUND'
                 if row['status'] != 'BORROWED':
                     return None, 'ALREADY_RETURNED'
-                cur.execute("UPDATE borrowings SET returned_at=now(), status='RETURNED' WHERE id=%s RETURNING *", (borrowing_id,))
+                execute(cur, RETURN, (borrowing_id,))
                 updated = cur.fetchone()
+                if not updated:
+                    # returned by a concurrent call since the SELECT above
+                    conn.rollback()
+                    return None, 'ALREADY_RETURNED'
+                cache.notify_invalidation(cur, 'books', updated['book_id'])
             conn.commit()
+            mark_written(f"loans:{updated['member_id']}")
+            _availability_changed([updated['book_id']])
             logger.info('book_returned', extra={'borrowing_id': borrowing_id})
             return updated, None
         except Exception:
@@ -47,8 +109,152 @@ def return_book(borrowing_id):
             logger.exception('return_book_failed')
             raise
 
-def list_borrowed_by_member(member_id):
+MAX_BATCH_ITEMS = 500
+
+BORROW_BATCH_SQL = """
+    WITH req AS (SELECT book_id, ord FROM unnest(%(book_ids)s::int[]) WITH ORDINALITY AS r(book_id, ord)),
+         m AS (SELECT id FROM members WHERE id=%(member_id)s),
+         b AS (SELECT id FROM books WHERE id IN (SELECT book_id FROM req)),
+         ins AS (
+             INSERT INTO borrowings(book_id, member_id, borrowed_at, due_at, status)
+             SELECT b.id, m.id, now(), %(due_at)s, 'BORROWED' FROM b, m
+             ON CONFLICT (book_id) WHERE status = 'BORROWED' DO NOTHING
+             RETURNING *
+         )
+    SELECT req.book_id AS requested_id, mf.member_found, b.id IS NOT NULL AS found, ins.*
+    FROM (SELECT EXISTS (SELECT 1 FROM m) AS member_found) AS mf
+    LEFT JOIN req ON true LEFT JOIN b ON b.id = req.book_id LEFT JOIN ins ON ins.book_id = req.book_id
+    ORDER BY req.ord
+"""
+BORROW_BATCH = statement('borrow_books', BORROW_BATCH_SQL)
+
+RETURN_BATCH_SQL = """
+    WITH req AS (SELECT id, ord FROM unnest(%(borrowing_ids)s::int[]) WITH ORDINALITY AS r(id, ord)),
+         upd AS (
+             UPDATE borrowings SET returned_at=now(), status='RETURNED'
+             WHERE id IN (SELECT id FROM req) AND status = 'BORROWED'
+             RETURNING *
+         )
+    SELECT req.id AS requested_id, cur.id IS NOT NULL AS found, upd.*
+    FROM req LEFT JOIN borrowings cur ON cur.id = req.id LEFT JOIN upd ON upd.id = req.id
+    ORDER BY req.ord
+"""
+RETURN_BATCH = statement('return_books', RETURN_BATCH_SQL)
+
+def _batch_results(rows, conflict):
+    """Map BORROW_BATCH_SQL / RETURN_BATCH_SQL rows, in request order, to
+    (requested_id, status, borrowing or None). A repeated id only succeeds once."""
+    results, done = [], set()
+    for row in rows:
+        requested_id, found = row.pop('requested_id'), row.pop('found')
+        row.pop('member_found', None)
+        if not found:
+            results.append((requested_id, 'NOT_FOUND', None))
+        elif row['id'] is None or requested_id in done:
+            results.append((requested_id, conflict, None))
+        else:
+            done.add(requested_id)
+            results.append((requested_id, 'OK', row))
+    return results
+
+def borrow_books(member_id, book_ids, due_at=None):
+    """Borrow several books for one member in one statement. Returns
+    (results, error); error is MEMBER_NOT_FOUND when nothing was attempted,
+    including for an empty batch."""
     with get_conn() as conn:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT * FROM borrowings WHERE member_id=%s ORDER BY borrowed_at DESC", (member_id,))
-            return cur.fetchall()
+        for attempt in (1, 2):
+            try:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    execute(cur, BORROW_BATCH, {'member_id': member_id, 'book_ids': list(book_ids), 'due_at': due_at})
+                    rows = cur.fetchall()
+                    # always at least one row, carrying member_found
+                    if not rows[0]['member_found']:
+                        conn.rollback()
+                        return None, 'MEMBER_NOT_FOUND'
+                    results = _batch_results(rows if book_ids else [], 'ALREADY_BORROWED')
+                    borrowed = [row['book_id'] for _, _, row in results if row]
+                    cache.notify_invalidation(cur, 'books', *borrowed)
+                conn.commit()
+                mark_written(f'loans:{member_id}')
+                _availability_changed(borrowed)
+                logger.info('books_borrowed', extra={'member_id': member_id, 'requested': len(book_ids),
+                                                     'borrowed': sum(1 for _, status, _ in results if status == 'OK')})
+                return results, None
+            except ForeignKeyViolation:
+                # a book or the member was deleted mid-statement; rerunning sees it gone
+                conn.rollback()
+                if attempt == 2:
+                    raise
+            except Exception:
+                conn.rollback()
+                logger.exception('borrow_books_failed')
+                raise
+
+def return_books(borrowing_ids):
+    """Return several loans in one statement; results are in request order."""
+    with get_conn() as conn:
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                execute(cur, RETURN_BATCH, {'borrowing_ids': list(borrowing_ids)})
+                results = _batch_results(cur.fetchall(), 'ALREADY_RETURNED')
+                returned = [row['book_id'] for _, _, row in results if row]
+                cache.notify_invalidation(cur, 'books', *returned)
+            conn.commit()
+            mark_written(*{f"loans:{row['member_id']}" for _, _, row in results if row})
+            _availability_changed(returned)
+            logger.info('books_returned', extra={'requested': len(borrowing_ids),
+                                                 'returned': sum(1 for _, status, _ in results if status == 'OK')})
+            return results
+        except Exception:
+            conn.rollback()
+            logger.exception('return_books_failed')
+            raise
+
+BORROWED_BY_MEMBER_SQL = 'SELECT {columns} FROM borrowings WHERE member_id=%s ORDER BY borrowed_at DESC'
+BORROWED_BY_MEMBER = statement('borrowed_by_member', BORROWED_BY_MEMBER_SQL.format(columns='*'))
+
+def list_borrowed_by_member(member_id, fields=None):
+    """Return (columns, tuple rows), most recent first; fields
+    (convert.BORROWING.fields) limits the columns read."""
+    stmt = BORROWED_BY_MEMBER if fields is None else projection('borrowed_by_member', BORROWED_BY_MEMBER_SQL, fields)
+    with get_conn(readonly=True, scopes=(f'loans:{member_id}',)) as conn:
+        with conn.cursor() as cur:
+            execute(cur, stmt, (member_id,))
+            return column_names(cur), cur.fetchall()
+
+OVERDUE_BATCH_SIZE = 500
+
+def _overdue_query(member_id, after, limit):
+    # Every variant is status='BORROWED' AND due_at < as_of ORDER BY due_at, id,
+    # a range scan on the idx_borrowings_overdue (or, filtered by member,
+    # idx_borrowings_member_overdue) partial index that covers active loans only,
+    # however much history the table holds.
+    clauses = ["status = 'BORROWED'", 'due_at < %(as_of)s']
+    if member_id:
+        clauses.append('member_id = %(member_id)s')
+    if after:
+        clauses.append('(due_at, id) > (%(after_due)s, %(after_id)s)')
+    sql = f"SELECT * FROM borrowings WHERE {' AND '.join(clauses)} ORDER BY due_at, id"
+    if limit:
+        sql += ' LIMIT %(limit)s'
+    return sql
+
+def list_overdue(as_of, member_id=0, after=None, limit=0, batch_size=OVERDUE_BATCH_SIZE):
+    """Yield (columns, tuple rows) batches of active loans due before as_of,
+    most overdue first. after is the (due_at, id) of the last row already seen;
+    limit 0 means no limit."""
+    params = {'as_of': as_of, 'member_id': member_id, 'limit': limit}
+    if after:
+        params['after_due'], params['after_id'] = after
+    # a report: it may trail the primary by up to DB_MAX_REPLICA_LAG
+    with get_conn(readonly=True) as conn:
+        try:
+            with conn.cursor(name='list_overdue') as cur:
+                cur.execute(_overdue_query(member_id, after, limit), params)
+                while True:
+                    rows = cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield column_names(cur), rows
+        finally:
+            conn.rollback()
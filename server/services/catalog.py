@@ -0,0 +1,13 @@
+from server.statements import statement, execute
+
+# Change counters maintained by the catalog_versions triggers (db/schema.sql).
+# Every bump adds one, so the sum of several counters changes whenever any does.
+VERSION_SQL = 'SELECT sum(version)::bigint FROM catalog_versions WHERE table_name = ANY(%s)'
+VERSION = statement('catalog_version', VERSION_SQL)
+# books.available changes, counted in 16 rows by book id % 16
+AVAILABILITY_SHARDS = 16
+AVAILABILITY_VERSIONS = tuple(f'books_availability_{n}' for n in range(AVAILABILITY_SHARDS))
+
+def read_version(cur, *tables):
+    execute(cur, VERSION, (list(tables),))
+    return cur.fetchone()[0] or 0
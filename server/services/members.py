@@ -1,38 +1,95 @@
-from server.db import get_conn
+from server.db import get_conn, column_names, mark_written
+from server.statements import projection, statement, execute
 from psycopg2.extras import RealDictCursor
 from psycopg2 import IntegrityError
 from server.logger import get_logger
+from server.bulk import copy_buffer, split_duplicates
+import server.cache as cache
+from server.group_commit import WriteBatcher
+from server.services.catalog import read_version
 
 logger = get_logger('members_service')
 
+STREAM_BATCH_SIZE = 1000
+
+CREATE = statement('create_member', 'INSERT INTO members(name,email,phone,address,created_at,updated_at) VALUES (%s,%s,%s,%s,now(),now()) RETURNING *')
+UPDATE = statement('update_member', 'UPDATE members SET name=%s,email=%s,phone=%s,address=%s,updated_at=now() WHERE id=%s RETURNING *')
+ACTIVE_LOAN = statement('member_active_loan', "SELECT id FROM borrowings WHERE member_id=%s AND status='BORROWED'")
+DELETE = statement('delete_member', 'DELETE FROM members WHERE id=%s RETURNING id')
+BY_ID_SQL = 'SELECT {columns} FROM members WHERE id=%s'
+PAGE_SQL = 'SELECT {columns} FROM members WHERE id > %s ORDER BY id LIMIT %s'
+ALL_SQL = 'SELECT {columns} FROM members ORDER BY id'
+BY_ID = statement('member_by_id', BY_ID_SQL.format(columns='*'))
+PAGE = statement('members_page', PAGE_SQL.format(columns='*'))
+ALL = statement('members_all', ALL_SQL.format(columns='*'))
+STREAM_SQL = ALL_SQL.format(columns='*')
+
+CREATE_BATCHER = WriteBatcher('create_member')
+
+def _insert_member(cur, data):
+    execute(cur, CREATE, (data['name'], data.get('email'), data.get('phone'), data.get('address')))
+    return cur.fetchone()
+
 def create_member(data):
+    try:
+        row = CREATE_BATCHER.run(_insert_member, data, key=data.get('email') or '')
+    except IntegrityError:
+        logger.warning('create_member_duplicate', extra={'email': data.get('email')})
+        raise ValueError('ALREADY_EXISTS')
+    except Exception:
+        logger.exception('create_member_failed')
+        raise
+    mark_written('members')
+    logger.info('member_created', extra={'member_id': row['id']})
+    return row
+
+def import_members(batch):
+    """Load a batch of validated (index, data) pairs in one transaction using COPY.
+
+    Returns (imported, conflicts) where conflicts is a list of (index, email) for
+    rows skipped because the email already exists in the table or earlier in the batch.
+    """
+    rows, duplicates = split_duplicates(batch, 'email')
     with get_conn() as conn:
         try:
-            with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute('INSERT INTO members(name,email,phone,address,created_at,updated_at) VALUES (%s,%s,%s,%s,now(),now()) RETURNING *',
-                            (data['name'], data.get('email'), data.get('phone'), data.get('address')))
-                row = cur.fetchone()
+            with conn.cursor() as cur:
+                cur.execute("""
+                    CREATE TEMP TABLE IF NOT EXISTS import_members (
+                        idx INTEGER, name TEXT, email TEXT, phone TEXT, address TEXT
+                    ) ON COMMIT DELETE ROWS
+                """)
+                cur.copy_expert('COPY import_members (idx, name, email, phone, address) FROM STDIN',
+                                copy_buffer((i, d['name'], d.get('email'), d.get('phone'), d.get('address')) for i, d in rows))
+                cur.execute("""
+                    INSERT INTO members(name, email, phone, address, created_at, updated_at)
+                    SELECT name, email, phone, address, now(), now() FROM import_members ORDER BY idx
+                    ON CONFLICT (email) DO NOTHING RETURNING email
+                """)
+                inserted = {r[0] for r in cur.fetchall() if r[0]}
             conn.commit()
-            logger.info('member_created', extra={'member_id': row['id']})
-            return row
-        except IntegrityError:
-            conn.rollback()
-            logger.warning('create_member_duplicate', extra={'email': data.get('email')})
-            raise ValueError('ALREADY_EXISTS')
+            mark_written('members')
         except Exception:
             conn.rollback()
-            logger.exception('create_member_failed')
+            logger.exception('import_members_failed')
             raise
+    existing = [(i, d['email']) for i, d in rows if d.get('email') and d['email'] not in inserted]
+    imported = len(rows) - len(existing)
+    conflicts = sorted(duplicates + existing)
+    logger.info('members_imported', extra={'imported': imported, 'conflicts': len(conflicts)})
+    return imported, conflicts
 
 def update_member(data):
     with get_conn() as conn:
         try:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute('UPDATE members SET name=%s,email=%s,phone=%s,address=%s,updated_at=now() WHERE id=%s RETURNING *',
-                            (data['name'], data.get('email'), data.get('phone'), data.get('address'), data['id']))
+                execute(cur, UPDATE, (data['name'], data.get('email'), data.get('phone'), data.get('address'), data['id']))
                 row = cur.fetchone()
+                if row:
+                    cache.notify_invalidation(cur, 'members', row['id'])
             if row:
                 conn.commit()
+                mark_written('members', f"member:{row['id']}")
+                cache.members.invalidate(row['id'])
                 logger.info('member_updated', extra={'member_id': row['id']})
                 return row
             conn.rollback()
@@ -51,14 +108,18 @@ def delete_member(member_id):
         try:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
                 # Check for active borrowings
-                cur.execute("SELECT id FROM borrowings WHERE member_id=%s AND status='BORROWED'", (member_id,))
+                execute(cur, ACTIVE_LOAN, (member_id,))
                 if cur.fetchone():
                     raise ValueError('CANNOT_DELETE_MEMBER_WITH_BORROWINGS')
 
-                cur.execute('DELETE FROM members WHERE id=%s RETURNING id', (member_id,))
+                execute(cur, DELETE, (member_id,))
                 row = cur.fetchone()
+                if row:
+                    cache.notify_invalidation(cur, 'members', member_id)
             if row:
                 conn.commit()
+                mark_written('members', f'member:{member_id}')
+                cache.members.invalidate(member_id)
                 logger.info('member_deleted', extra={'member_id': member_id})
                 return True
             conn.rollback()
@@ -71,14 +132,80 @@ def delete_member(member_id):
             logger.exception('delete_member_failed')
             raise
 
-def get_member(member_id):
-    with get_conn() as conn:
+def _fetch_member(member_id, fields=None):
+    with get_conn(readonly=True, scopes=(f'member:{member_id}',)) as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute('SELECT * FROM members WHERE id=%s', (member_id,))
+            execute(cur, BY_ID if fields is None else projection('member_by_id', BY_ID_SQL, fields), (member_id,))
             return cur.fetchone()
 
-def list_members():
-    with get_conn() as conn:
+def get_member(member_id, fields=None):
+    # read-through: rows are shared with other callers, do not mutate the result.
+    # The cache holds whole rows, so fields only prunes the query when caching is off.
+    if fields is None or cache.members.maxsize:
+        return cache.members.load(member_id, lambda: _fetch_member(member_id))
+    return _fetch_member(member_id, fields)
+
+MEMBER_DETAIL_SQL = """
+    WITH loans AS (
+        SELECT b.id, b.book_id, b.member_id, b.borrowed_at, b.due_at, b.returned_at, b.status,
+               bk.title, bk.author, bk.isbn
+        FROM borrowings b LEFT JOIN books bk ON bk.id = b.book_id
+        WHERE b.member_id = %(member_id)s
+    )
+    SELECT m.id, m.name, m.email, m.phone, m.address,
+           (SELECT count(*) FROM loans WHERE status = 'BORROWED') AS active_count,
+           (SELECT count(*) FROM loans WHERE status = 'BORROWED' AND due_at < now()) AS overdue_count,
+           (SELECT count(*) FROM loans) AS lifetime_count,
+           (SELECT coalesce(json_agg(a ORDER BY a.due_at NULLS LAST, a.id), '[]')
+            FROM (SELECT * FROM loans WHERE status = 'BORROWED') a) AS active,
+           (SELECT coalesce(json_agg(h ORDER BY h.id DESC), '[]')
+            FROM (SELECT * FROM loans WHERE status <> 'BORROWED' AND (%(before_id)s = 0 OR id < %(before_id)s)
+                  ORDER BY id DESC LIMIT %(limit)s) h) AS history
+    FROM members m WHERE m.id = %(member_id)s
+"""
+MEMBER_DETAIL = statement('member_detail', MEMBER_DETAIL_SQL)
+
+def member_detail_params(member_id, history_limit, before_id):
+    return {'member_id': member_id, 'limit': history_limit, 'before_id': before_id}
+
+def get_member_detail(member_id, history_limit, before_id=0):
+    """Member row with active_count/overdue_count/lifetime_count and the
+    active/history loan lists (dicts carrying title/author/isbn), or None.
+    History holds returned loans with id < before_id (0: newest first)."""
+    with get_conn(readonly=True, scopes=(f'member:{member_id}', f'loans:{member_id}')) as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute('SELECT * FROM members ORDER BY id')
-            return cur.fetchall()
+            execute(cur, MEMBER_DETAIL, member_detail_params(member_id, history_limit, before_id))
+            return cur.fetchone()
+
+def list_members(page_size=0, after_id=0, if_version=0, fields=None):
+    """Return (version, columns, tuple rows) ordered by id. When if_version is
+    the current table version the rows are not read and columns/rows are None.
+    fields (convert.MEMBER.fields) limits the columns read."""
+    with get_conn(readonly=True, scopes=('members',)) as conn:
+        with conn.cursor() as cur:
+            # Read the version first: the rows below are then at least that new,
+            # so a client can never pair stale rows with a newer version.
+            version = read_version(cur, 'members')
+            if if_version and if_version == version:
+                return version, None, None
+            if page_size:
+                execute(cur, PAGE if fields is None else projection('members_page', PAGE_SQL, fields), (after_id, page_size))
+            else:
+                execute(cur, ALL if fields is None else projection('members_all', ALL_SQL, fields))
+            return version, column_names(cur), cur.fetchall()
+
+def stream_members(batch_size=STREAM_BATCH_SIZE):
+    # Named (server-side) cursor: yields (columns, rows) batches of batch_size so
+    # memory stays flat regardless of table size. The pooled connection is held until
+    # the caller finishes iterating or closes the generator.
+    with get_conn(readonly=True, scopes=('members',)) as conn:
+        try:
+            with conn.cursor(name='stream_members') as cur:
+                cur.execute(STREAM_SQL)
+                while True:
+                    rows = cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield column_names(cur), rows
+        finally:
+            conn.rollback()
@@ -0,0 +1,72 @@
+"""Named server-side prepared statements for the service SQL.
+
+Each service query is registered once at import time with statement(name,
+sql). execute() PREPAREs it the first time a pooled connection runs it and
+sends `EXECUTE name (...)` from then on, so Postgres parses and plans the
+text once per connection instead of on every call. Prepared statements live as
+long as the session (they survive ROLLBACK) and go away with the connection
+when the pool closes or recycles it.
+
+psycopg2 has no protocol-level prepare, so parameters still travel as quoted
+literals inside EXECUTE. Set DB_PREPARE=0 to send plain SQL instead, e.g.
+behind a transaction-pooling pgbouncer where the session is not ours.
+"""
+import os
+import re
+import zlib
+
+ENABLED = os.environ.get('DB_PREPARE', '1').lower() not in ('0', 'false', 'no')
+
+_PLACEHOLDER = re.compile(r'%\((\w+)\)s|%s|%%')
+_registry = {}
+
+class Statement:
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        names, positional = [], 0
+
+        def number(match):
+            nonlocal positional
+            if match.group(0) == '%%':
+                return '%'
+            if match.group(1) is None:
+                positional += 1
+                return f'${positional}'
+            if match.group(1) not in names:
+                names.append(match.group(1))
+            return f'${names.index(match.group(1)) + 1}'
+
+        body = _PLACEHOLDER.sub(number, sql)
+        if names and positional:
+            raise ValueError(f'statement {name} mixes named and positional parameters')
+        self.prepare_sql = f'PREPARE {name} AS {body}'
+        args = ', '.join(f'%({n})s' for n in names) or ', '.join(['%s'] * positional)
+        self.execute_sql = f'EXECUTE {name} ({args})' if args else f'EXECUTE {name}'
+
+def statement(name, sql):
+    """Register sql under name (a valid SQL identifier, unique per process)."""
+    existing = _registry.get(name)
+    if existing is not None and existing.sql != sql:
+        raise ValueError(f'statement {name} is already registered with different SQL')
+    _registry[name] = stmt = existing or Statement(name, sql)
+    return stmt
+
+def projection(name, template, columns):
+    """The statement for template (SQL with a {columns} select list) reading
+    only columns. Each distinct column list is registered on its own, under
+    name plus a digest of the list, and is prepared like any other."""
+    select = ', '.join(columns)
+    return statement(f'{name}_{zlib.crc32(select.encode()):08x}', template.format(columns=select))
+
+def execute(cur, stmt, params=None):
+    """Run a registered statement on cur, preparing it on the connection first
+    if needed. Connections that do not track prepared statements (anything but
+    server.db.InstrumentedConnection) get the plain SQL."""
+    prepared = getattr(cur.connection, 'prepared_statements', None)
+    if not ENABLED or prepared is None:
+        return cur.execute(stmt.sql, params)
+    if stmt.name not in prepared:
+        cur.execute(stmt.prepare_sql)
+        prepared.add(stmt.name)
+    return cur.execute(stmt.execute_sql, params)
@@ -0,0 +1,17 @@
+import unittest
+
+from server.bulk import copy_buffer, split_duplicates
+
+class BulkTests(unittest.TestCase):
+    def test_copy_buffer_escapes_and_nulls(self):
+        buf = copy_buffer([(1, 'a\tb', None, 'line\nbreak', 'back\\slash', '')])
+        self.assertEqual(buf.read(), '1\ta\\tb\t\\N\tline\\nbreak\tback\\\\slash\t\n')
+
+    def test_split_duplicates(self):
+        batch = [(0, {'isbn': 'x'}), (1, {'isbn': None}), (2, {'isbn': 'x'}), (3, {'isbn': None})]
+        keep, dups = split_duplicates(batch, 'isbn')
+        self.assertEqual([i for i, _ in keep], [0, 1, 3])
+        self.assertEqual(dups, [(2, 'x')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+from unittest import mock
+
+import server.cache as cache
+from server.cache import EntityCache
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+class EntityCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = EntityCache('test', maxsize=2, ttl=10, clock=self.clock)
+
+    def test_read_through_counts_hits_and_misses(self):
+        loads = []
+        loader = lambda: loads.append(1) or {'id': 1}
+        self.assertEqual(self.cache.load(1, loader), {'id': 1})
+        self.assertEqual(self.cache.load(1, loader), {'id': 1})
+        self.assertEqual(len(loads), 1)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_lru_eviction(self):
+        self.cache.put(1, 'a'); self.cache.put(2, 'b')
+        self.cache.get(1)
+        self.cache.put(3, 'c')
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual(self.cache.get(1), 'a')
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_ttl_expiry(self):
+        self.cache.put(1, 'a')
+        self.clock.now = 11
+        self.assertIsNone(self.cache.get(1))
+
+    def test_invalidation_during_load_is_not_cached(self):
+        def loader():
+            self.cache.invalidate(1)
+            return 'stale'
+        self.assertEqual(self.cache.load(1, loader), 'stale')
+        self.assertIsNone(self.cache.get(1))
+
+    def test_missing_rows_are_not_cached(self):
+        self.cache.load(1, lambda: None)
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+class NotifyInvalidationTests(unittest.TestCase):
+    def test_one_statement_for_many_keys(self):
+        cur = mock.Mock()
+        with mock.patch.object(cache, 'SHARED_INVALIDATION', True):
+            cache.notify_invalidation(cur, 'books')
+            cur.execute.assert_not_called()
+            cache.notify_invalidation(cur, 'books', 3, 5)
+        sql, params = cur.execute.call_args.args
+        self.assertEqual(params, (cache.NOTIFY_CHANNEL, 'books:', ['3', '5']))
+
+if __name__ == '__main__':
+    unittest.main()
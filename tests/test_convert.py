@@ -0,0 +1,56 @@
+import unittest
+from datetime import date, datetime, timedelta, timezone
+
+from google.protobuf.field_mask_pb2 import FieldMask
+from google.protobuf.timestamp_pb2 import Timestamp
+
+import server.convert as convert
+import library_pb2
+
+class ConvertTests(unittest.TestCase):
+    def test_set_timestamp_matches_from_datetime(self):
+        for value in (datetime(2024, 2, 29, 12, 30, 5, 123456, tzinfo=timezone.utc),
+                      datetime(1960, 1, 1, 0, 0, 0, 500000, tzinfo=timezone(timedelta(hours=-5))),
+                      datetime(2001, 9, 9, 1, 46, 40)):
+            expected = Timestamp(); expected.FromDatetime(value)
+            ts = Timestamp(); convert.set_timestamp(ts, value)
+            self.assertEqual(ts, expected)
+
+    def test_set_timestamp_date(self):
+        ts = Timestamp(); convert.set_timestamp(ts, date(1970, 1, 2))
+        self.assertEqual((ts.seconds, ts.nanos), (86400, 0))
+
+    def test_extend_skips_nulls_and_unknown_columns(self):
+        columns = ('id', 'isbn', 'title', 'author', 'publisher', 'published_date', 'created_at')
+        rows = [(1, None, 'A', 'X', None, date(2000, 1, 1), datetime.now(timezone.utc)),
+                (2, '978', 'B', None, 'P', None, None)]
+        resp = library_pb2.ListBooksResponse()
+        convert.BOOK.extend(resp.books, columns, rows)
+        self.assertEqual([b.id for b in resp.books], [1, 2])
+        self.assertEqual(resp.books[0].isbn, '')
+        self.assertTrue(resp.books[0].HasField('published_date'))
+        self.assertFalse(resp.books[1].HasField('published_date'))
+        self.assertEqual(resp.books[1].publisher, 'P')
+
+    def test_from_dict_matches_tuple_path(self):
+        columns = ('id', 'book_id', 'member_id', 'borrowed_at', 'due_at', 'returned_at', 'status')
+        row = (7, 3, 4, datetime(2024, 1, 1, tzinfo=timezone.utc), None, None, 'BORROWED')
+        [from_tuple] = convert.BORROWING.messages(columns, [row])
+        self.assertEqual(convert.BORROWING.from_dict(dict(zip(columns, row))), from_tuple)
+
+    def test_read_mask_fields(self):
+        self.assertIsNone(convert.MEMBER.fields(FieldMask()))
+        self.assertEqual(convert.MEMBER.fields(FieldMask(paths=['email', 'name'])), ('id', 'name', 'email'))
+        with self.assertRaisesRegex(ValueError, 'created_at'):
+            convert.MEMBER.fields(FieldMask(paths=['name', 'created_at']))
+        member = convert.MEMBER.from_dict({'id': 1, 'name': 'N', 'address': 'A'}, ('id', 'name'))
+        self.assertEqual((member.name, member.address), ('N', ''))
+
+    def test_book_availability(self):
+        self.assertEqual(convert.BOOK.fields(FieldMask(paths=['available'])), ('id', 'available'))
+        resp = library_pb2.ListBooksResponse()
+        convert.BOOK.extend(resp.books, ('id', 'available'), [(1, True), (2, False)])
+        self.assertEqual([b.available for b in resp.books], [True, False])
+
+if __name__ == '__main__':
+    unittest.main()
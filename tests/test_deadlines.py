@@ -0,0 +1,46 @@
+import unittest
+from unittest import mock
+
+import server.deadlines as deadlines
+from server.deadlines import Call, DeadlineExceeded, timeout_to_set
+
+class FakeConn:
+    cancelled = 0
+
+    def cancel(self):
+        self.cancelled += 1
+
+class CallTests(unittest.TestCase):
+    def test_end_cancels_attached_connections_only(self):
+        call, held, returned = Call(5), FakeConn(), FakeConn()
+        with call.attached(returned):
+            pass
+        with call.attached(held):
+            call.end()
+            self.assertEqual((held.cancelled, returned.cancelled), (1, 0))
+        with self.assertRaises(DeadlineExceeded):
+            call.check()
+
+    def test_deadline(self):
+        self.assertIsNone(Call(9.2e18).remaining())
+        with self.assertRaises(DeadlineExceeded):
+            Call(0).check()
+
+class TimeoutToSetTests(unittest.TestCase):
+    def test_close_setting_is_reused(self):
+        self.assertEqual(timeout_to_set(None, 1000), 950)
+        self.assertIsNone(timeout_to_set(950, 1000))
+        self.assertIsNone(timeout_to_set(950, 1050))
+        self.assertEqual(timeout_to_set(950, 2000), 1900)
+        self.assertEqual(timeout_to_set(950, 900), 855)
+
+    def test_default_is_set_exactly(self):
+        self.assertEqual(timeout_to_set(950, 0), 0)
+        self.assertIsNone(timeout_to_set(0, 0))
+        with mock.patch.object(deadlines, 'STATEMENT_TIMEOUT_MS', 30000):
+            self.assertEqual(deadlines.statement_timeout(None), 30000)
+            self.assertEqual(deadlines.statement_timeout(60), 30000)
+            self.assertEqual(timeout_to_set(28000, 30000), 30000)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+
+from server.events import (BorrowingFeed, ReplayedIds, Subscription, OVERFLOW, FEED_RESET, REPLAY_OVERLAP, parse_event,
+                           replay_start)
+
+def _event(event_id, member_id=1, book_id=1):
+    return {'id': event_id, 'type': 'BORROWED', 'occurred_at': '2024-05-01T10:00:00.5+00:00',
+            'borrowing': {'id': event_id, 'book_id': book_id, 'member_id': member_id, 'status': 'BORROWED',
+                          'borrowed_at': '2024-05-01T10:00:00.5+00:00', 'due_at': None, 'returned_at': None}}
+
+class BorrowingFeedTests(unittest.TestCase):
+    def test_filters(self):
+        feed = BorrowingFeed()
+        mine = feed.subscribe(Subscription(member_id=1))
+        other = feed.subscribe(Subscription(book_id=2))
+        feed.publish(_event(1, member_id=1, book_id=1))
+        feed.publish(_event(2, member_id=3, book_id=2))
+        self.assertEqual(mine.get(timeout=0)['id'], 1)
+        self.assertIsNone(mine.get(timeout=0))
+        self.assertEqual(other.get(timeout=0)['id'], 2)
+
+    def test_slow_consumer_is_closed(self):
+        feed = BorrowingFeed()
+        sub = feed.subscribe(Subscription(maxsize=2))
+        for i in range(3):
+            feed.publish(_event(i))
+        self.assertEqual(sub.closed, OVERFLOW)
+        self.assertIsNone(sub.get(timeout=0))
+
+    def test_reset_closes_subscribers(self):
+        feed = BorrowingFeed()
+        sub = feed.subscribe(Subscription())
+        feed._reset()
+        self.assertEqual(sub.closed, FEED_RESET)
+
+    def test_subscriber_limit(self):
+        feed = BorrowingFeed()
+        first = feed.subscribe(Subscription(), limit=1)
+        self.assertIsNone(feed.subscribe(Subscription(), limit=1))
+        feed.unsubscribe(first)
+        self.assertIsNotNone(feed.subscribe(Subscription(), limit=1))
+
+    def test_parse_event_timestamps(self):
+        event = parse_event(_event(1))
+        self.assertEqual(event['occurred_at'].microsecond, 500000)
+        self.assertEqual(event['borrowing']['borrowed_at'].year, 2024)
+        self.assertIsNone(event['borrowing']['due_at'])
+
+class ReplayTests(unittest.TestCase):
+    def test_replay_starts_before_resume_id(self):
+        self.assertEqual(replay_start(REPLAY_OVERLAP + 10), 10)
+        self.assertEqual(replay_start(1), 0)
+
+    def test_replayed_ids_out_of_order(self):
+        replayed = ReplayedIds(maxlen=3)
+        for event_id in (5, 9, 7):
+            replayed.add(event_id)
+        self.assertIn(5, replayed)
+        self.assertNotIn(6, replayed)
+        # a late event with a lower id than one already replayed is still new
+        self.assertNotIn(4, replayed)
+
+    def test_replayed_ids_bounded(self):
+        replayed = ReplayedIds(maxlen=2)
+        for event_id in (1, 2, 3):
+            replayed.add(event_id)
+        self.assertNotIn(1, replayed)
+        self.assertIn(3, replayed)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+import asyncio
+import threading
+import unittest
+from contextlib import asynccontextmanager, contextmanager
+
+import server.aio.group_commit as aio_group_commit
+import server.group_commit as group_commit
+from server.aio.group_commit import AsyncWriteBatcher
+from server.group_commit import WriteBatcher, _parse_windows
+
+class FakeCursor:
+    def __init__(self, log):
+        self.log = log
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        self.log.append(sql)
+
+class FakeConnection:
+    def __init__(self):
+        self.log = []
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self.log)
+
+    def commit(self):
+        self.log.append('COMMIT')
+
+    def rollback(self):
+        self.log.append('ROLLBACK')
+
+class Conflict(Exception):
+    pass
+
+def insert(cur, value):
+    if value == 'dup':
+        raise Conflict(value)
+    cur.execute(f'INSERT {value}')
+    return value.upper()
+
+class WriteBatcherTests(unittest.TestCase):
+    def setUp(self):
+        self.connections = []
+
+        @contextmanager
+        def get_conn():
+            conn = FakeConnection()
+            self.connections.append(conn)
+            yield conn
+
+        self.saved, group_commit.get_conn = group_commit.get_conn, get_conn
+
+    def tearDown(self):
+        group_commit.get_conn = self.saved
+
+    def test_parse_windows(self):
+        self.assertEqual(_parse_windows('create_book=2, borrow_book=0.5'), {'create_book': 0.002, 'borrow_book': 0.0005})
+        self.assertEqual(_parse_windows(''), {})
+
+    def test_unbatched_commits_each_call(self):
+        batcher = WriteBatcher('t', window=0)
+        self.assertEqual(batcher.run(insert, 'a'), 'A')
+        with self.assertRaises(Conflict):
+            batcher.run(insert, 'dup')
+        self.assertEqual([c.log for c in self.connections], [['INSERT a', 'COMMIT'], ['ROLLBACK']])
+
+    def test_batch_shares_one_commit_and_isolates_errors(self):
+        batcher = WriteBatcher('t', window=5, max_batch=3)
+        results = {}
+
+        def call(value):
+            try:
+                results[value] = batcher.run(insert, value, key=value)
+            except Conflict as e:
+                results[value] = e
+
+        threads = [threading.Thread(target=call, args=(v,)) for v in ('c', 'dup', 'a')]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results['a'], 'A')
+        self.assertEqual(results['c'], 'C')
+        self.assertIsInstance(results['dup'], Conflict)
+        [conn] = self.connections
+        self.assertEqual(conn.log, ['SAVEPOINT group_commit', 'INSERT a', 'RELEASE SAVEPOINT group_commit',
+                                    'SAVEPOINT group_commit', 'INSERT c', 'RELEASE SAVEPOINT group_commit',
+                                    'SAVEPOINT group_commit', 'ROLLBACK TO SAVEPOINT group_commit',
+                                    'COMMIT'])
+
+class AsyncFakeCursor(FakeCursor):
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, sql, params=None):
+        self.log.append(sql)
+
+class AsyncFakeConnection(FakeConnection):
+    def __init__(self, commit_started=None, release=None):
+        super().__init__()
+        self.commit_started, self.release = commit_started, release
+
+    def cursor(self, row_factory=None):
+        return AsyncFakeCursor(self.log)
+
+    async def commit(self):
+        if self.release is not None:
+            self.commit_started.set()
+            await self.release.wait()
+        self.log.append('COMMIT')
+
+async def async_insert(cur, value):
+    await cur.execute(f'INSERT {value}')
+    return value.upper()
+
+class AsyncWriteBatcherTests(unittest.TestCase):
+    def setUp(self):
+        self.commit_started = self.release = None
+
+        @asynccontextmanager
+        async def get_conn():
+            yield AsyncFakeConnection(self.commit_started, self.release)
+
+        self.saved, aio_group_commit.get_conn = aio_group_commit.get_conn, get_conn
+
+    def tearDown(self):
+        aio_group_commit.get_conn = self.saved
+
+    def test_collector_is_kept_until_done(self):
+        batcher = AsyncWriteBatcher('t', window=5, max_batch=2)
+
+        async def call():
+            first = asyncio.ensure_future(batcher.run(async_insert, 'a'))
+            await asyncio.sleep(0)
+            self.assertEqual(len(batcher._collectors), 1)
+            return await asyncio.gather(first, batcher.run(async_insert, 'b'))
+
+        self.assertEqual(asyncio.run(call()), ['A', 'B'])
+        self.assertEqual(batcher._collectors, set())
+
+    def test_cancelled_flush_releases_callers(self):
+        batcher = AsyncWriteBatcher('t', window=5, max_batch=2)
+
+        async def call():
+            self.commit_started, self.release = asyncio.Event(), asyncio.Event()
+            callers = [asyncio.ensure_future(batcher.run(async_insert, v)) for v in ('a', 'b')]
+            await self.commit_started.wait()
+            [collector] = batcher._collectors
+            collector.cancel()
+            return await asyncio.gather(*callers, return_exceptions=True)
+
+        results = asyncio.run(asyncio.wait_for(call(), 5))
+        self.assertTrue(all(isinstance(r, asyncio.CancelledError) for r in results))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import threading
+import unittest
+from unittest import mock
+
+from server.health import HealthMonitor, QueueCountingExecutor
+
+class FakeMonitor(HealthMonitor):
+    database = {'ok': True}
+
+    def _probe(self):
+        return self.database
+
+def _pool(waiting, maxconn=4):
+    return {'maxconn': maxconn, 'waiting': waiting}
+
+class HealthMonitorTests(unittest.TestCase):
+    def setUp(self):
+        self.pools = {'db': _pool(0)}
+        patcher = mock.patch('server.health.pool_stats', lambda: self.pools)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.queued = 0
+        self.changes = []
+        self.monitor = FakeMonitor('dsn', queued=lambda: self.queued, max_queued=10, on_change=self.changes.append)
+
+    def test_saturated_pool_or_executor_is_not_ready(self):
+        self.assertTrue(self.monitor.check()['ready'])
+        self.pools['db'] = _pool(5)
+        self.assertEqual(self.monitor.check()['saturated'], ['pool:db'])
+        self.pools['db'] = _pool(4)
+        self.queued = 11
+        self.assertEqual(self.monitor.check()['saturated'], ['executor'])
+        self.queued = 10
+        self.assertTrue(self.monitor.check()['ready'])
+        self.assertEqual(self.changes, [True, False, True])
+
+    def test_database_down_is_not_live(self):
+        self.monitor.database = {'ok': False, 'error': 'connection refused'}
+        state = self.monitor.check()
+        self.assertEqual((state['status'], state['ready']), ('down', False))
+        self.assertEqual(self.changes, [])
+
+class QueueCountingExecutorTests(unittest.TestCase):
+    def test_counts_calls_not_yet_started(self):
+        started, release = threading.Event(), threading.Event()
+        executor = QueueCountingExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        self.addCleanup(release.set)
+        busy = executor.submit(lambda: started.set() or release.wait())
+        started.wait(5)
+        waiting = [executor.submit(lambda i=i: i) for i in range(3)]
+        waiting[0].cancel()
+        self.assertEqual(executor.queued(), 2)
+        release.set()
+        self.assertEqual([f.result() for f in waiting[1:]], [1, 2])
+        self.assertTrue(busy.result())
+        self.assertEqual(executor.queued(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+import grpc
+
+import server.deadlines as deadlines
+from server.interceptors import (AdmissionInterceptor, CompressionInterceptor, MetricsInterceptor, compressed_methods,
+                                 compression_options, method_limits)
+import library_pb2
+from server.aio.interceptors import AsyncMetricsInterceptor
+from server.metrics import RPC_TOTAL, RPC_IN_FLIGHT
+
+class FakeContext:
+    def __init__(self):
+        self._code = None
+        self.uncompressed = 0
+    def set_code(self, code):
+        self._code = code
+    def code(self):
+        return self._code
+    def abort(self, code, details):
+        self._code = code
+        raise Exception(details)
+    def time_remaining(self):
+        return 5
+    def add_callback(self, callback):
+        self.callback = callback
+        return True
+    def disable_next_message_compression(self):
+        self.uncompressed += 1
+
+def sample(metric, *labels):
+    return metric.labels(*labels)._value.get()
+
+class MetricsInterceptorTests(unittest.TestCase):
+    def intercept(self, method, handler):
+        details = SimpleNamespace(method=f'/library.LibraryService/{method}', invocation_metadata=())
+        return MetricsInterceptor().intercept_service(lambda d: handler, details)
+
+    def test_unary_status_is_counted(self):
+        def behavior(request, context):
+            context.set_code(grpc.StatusCode.NOT_FOUND)
+            return 'response'
+        before = sample(RPC_TOTAL, 'TestUnary', 'NOT_FOUND')
+        handler = self.intercept('TestUnary', grpc.unary_unary_rpc_method_handler(behavior))
+        self.assertEqual(handler.unary_unary('request', FakeContext()), 'response')
+        self.assertEqual(sample(RPC_TOTAL, 'TestUnary', 'NOT_FOUND'), before + 1)
+        self.assertEqual(sample(RPC_IN_FLIGHT, 'TestUnary'), 0)
+
+    def test_stream_in_flight_until_exhausted(self):
+        handler = self.intercept('TestStream', grpc.unary_stream_rpc_method_handler(lambda request, context: iter([1, 2])))
+        responses = handler.unary_stream('request', FakeContext())
+        self.assertEqual(next(responses), 1)
+        self.assertEqual(sample(RPC_IN_FLIGHT, 'TestStream'), 1)
+        self.assertEqual(list(responses), [2])
+        self.assertEqual(sample(RPC_IN_FLIGHT, 'TestStream'), 0)
+        self.assertEqual(sample(RPC_TOTAL, 'TestStream', 'OK'), 1)
+
+    def test_async_status_is_counted(self):
+        async def behavior(request, context):
+            context.set_code(grpc.StatusCode.NOT_FOUND)
+            return 'response'
+
+        async def call():
+            details = SimpleNamespace(method='/library.LibraryService/TestAsync', invocation_metadata=())
+            async def continuation(d):
+                return grpc.unary_unary_rpc_method_handler(behavior)
+            handler = await AsyncMetricsInterceptor().intercept_service(continuation, details)
+            return await handler.unary_unary('request', FakeContext())
+        before = sample(RPC_TOTAL, 'TestAsync', 'NOT_FOUND')
+        self.assertEqual(asyncio.run(call()), 'response')
+        self.assertEqual(sample(RPC_TOTAL, 'TestAsync', 'NOT_FOUND'), before + 1)
+        self.assertEqual(sample(RPC_IN_FLIGHT, 'TestAsync'), 0)
+
+class AdmissionInterceptorTests(unittest.TestCase):
+    def intercept(self, interceptor, method, handler):
+        details = SimpleNamespace(method=f'/library.LibraryService/{method}', invocation_metadata=())
+        return interceptor.intercept_service(lambda d: handler, details)
+
+    def test_method_limits(self):
+        self.assertEqual(method_limits(3, 'ListBooks+SearchBooks=4, GetMember=8'),
+                         [(('ListBooks', 'SearchBooks'), 4), (('GetMember',), 8)])
+        self.assertEqual(method_limits(3, ''), [])
+        self.assertEqual(method_limits(3, None)[0][1], 3)
+
+    def test_group_at_limit_is_rejected(self):
+        interceptor = AdmissionInterceptor([(('ListBooks', 'StreamBooks'), 1)])
+        stream = self.intercept(interceptor, 'StreamBooks', grpc.unary_stream_rpc_method_handler(lambda request, context: iter([1, 2])))
+        responses = stream.unary_stream('request', FakeContext())
+        self.assertEqual(next(responses), 1)
+        context = FakeContext()
+        unary = self.intercept(interceptor, 'ListBooks', grpc.unary_unary_rpc_method_handler(lambda request, context: deadlines.current()))
+        with self.assertRaises(Exception):
+            unary.unary_unary('request', context)
+        self.assertEqual(context.code(), grpc.StatusCode.RESOURCE_EXHAUSTED)
+        self.assertEqual(list(responses), [2])
+        call = unary.unary_unary('request', context)
+        self.assertAlmostEqual(call.remaining(), 5, delta=1)
+        self.assertIsNone(deadlines.current())
+        context.callback()
+        self.assertTrue(call.ended)
+
+class CompressionInterceptorTests(unittest.TestCase):
+    def test_settings(self):
+        self.assertEqual(compressed_methods(' ListBooks, StreamBooks'), {'ListBooks', 'StreamBooks'})
+        self.assertEqual(compressed_methods(''), frozenset())
+        self.assertEqual(compression_options('deflate'), [('grpc.default_compression_level', 3)])
+        with self.assertRaises(ValueError):
+            compression_options('br')
+
+    def test_only_large_responses_of_listed_methods_are_compressed(self):
+        small, large = library_pb2.Book(id=1), library_pb2.Book(id=2, title='x' * 100)
+        interceptor = CompressionInterceptor({'StreamBooks'}, min_bytes=50)
+        details = SimpleNamespace(method='/library.LibraryService/StreamBooks', invocation_metadata=())
+        handler = interceptor.intercept_service(lambda d: grpc.unary_stream_rpc_method_handler(lambda r, c: iter([small, large])), details)
+        context = FakeContext()
+        self.assertEqual(list(handler.unary_stream('request', context)), [small, large])
+        self.assertEqual(context.uncompressed, 1)
+        details = SimpleNamespace(method='/library.LibraryService/GetMember', invocation_metadata=())
+        handler = interceptor.intercept_service(lambda d: grpc.unary_unary_rpc_method_handler(lambda r, c: large), details)
+        context = FakeContext()
+        handler.unary_unary('request', context)
+        self.assertEqual(context.uncompressed, 1)
+
+if __name__ == '__main__':
+    unittest.main()
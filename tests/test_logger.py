@@ -0,0 +1,64 @@
+import json
+import logging
+import queue
+import threading
+import unittest
+from unittest import mock
+
+from server.logger import QueueingHandler, json_formatter
+
+def _record(msg, level=logging.INFO, **extra):
+    record = logging.LogRecord('t', level, __file__, 1, msg, (), None)
+    record.__dict__.update(extra)
+    return record
+
+class QueueingHandlerTests(unittest.TestCase):
+    def test_rate_limit_counts_suppressed(self):
+        handler = QueueingHandler(queue.Queue(), sample={}, rate_limit={'book_borrowed': 2})
+        with mock.patch('server.logger.monotonic', return_value=100.0):
+            for _ in range(5):
+                handler.emit(_record('book_borrowed'))
+            handler.emit(_record('book_borrowed', level=logging.WARNING))
+        with mock.patch('server.logger.monotonic', return_value=101.0):
+            handler.emit(_record('book_borrowed'))
+        queued = [handler.queue.get_nowait() for _ in range(handler.queue.qsize())]
+        self.assertEqual([r.levelno for r in queued], [logging.INFO] * 2 + [logging.WARNING, logging.INFO])
+        self.assertEqual(queued[-1].suppressed, 3)
+        self.assertEqual(handler.dropped['rate_limited'], 3)
+
+    def test_sampling_marks_kept_records(self):
+        handler = QueueingHandler(queue.Queue(), sample={'book_returned': 0.5}, rate_limit={})
+        with mock.patch('server.logger.random.random', side_effect=[0.9, 0.1]):
+            handler.emit(_record('book_returned'))
+            handler.emit(_record('book_returned'))
+        self.assertEqual(handler.queue.get_nowait().sample_rate, 0.5)
+        self.assertEqual(handler.dropped['sampled'], 1)
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        handler = QueueingHandler(queue.Queue(1), sample={}, rate_limit={})
+        handler.emit(_record('a'))
+        handler.emit(_record('b'))
+        self.assertEqual(handler.dropped['overflow'], 1)
+
+    def test_drops_from_many_threads_are_all_counted(self):
+        handler = QueueingHandler(queue.Queue(1), sample={}, rate_limit={})
+        handler.emit(_record('a'))
+
+        def emit():
+            for _ in range(5000):
+                handler.emit(_record('b'))
+
+        threads = [threading.Thread(target=emit) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(handler.dropped_counts()['overflow'], 40000)
+
+class JsonFormatterTests(unittest.TestCase):
+    def test_extras_become_fields(self):
+        line = json.loads(json_formatter().format(_record('book_created', book_id=7)))
+        self.assertEqual((line['event'], line['level'], line['book_id']), ('book_created', 'INFO', 7))
+
+if __name__ == '__main__':
+    unittest.main()
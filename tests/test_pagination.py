@@ -0,0 +1,40 @@
+import unittest
+from datetime import datetime, timezone
+
+from server.pagination import (MAX_PAGE_SIZE, clamp_page_size, decode_due_token, decode_page_token, decode_rank_token, encode_due_token,
+                               encode_page_token, next_rank_token)
+
+class PaginationTests(unittest.TestCase):
+    def test_token_round_trip(self):
+        self.assertEqual(decode_page_token(encode_page_token(12345)), 12345)
+
+    def test_empty_token_is_first_page(self):
+        self.assertEqual(decode_page_token(''), 0)
+
+    def test_invalid_token(self):
+        with self.assertRaises(ValueError):
+            decode_page_token('not-a-token')
+
+    def test_due_token_round_trip(self):
+        due_at = datetime(2024, 3, 1, 9, 30, 15, 250, tzinfo=timezone.utc)
+        self.assertEqual(decode_due_token(encode_due_token(due_at, 42)), (due_at, 42))
+        self.assertIsNone(decode_due_token(''))
+        with self.assertRaises(ValueError):
+            decode_due_token(encode_page_token(42))
+
+    def test_rank_token_round_trip(self):
+        # ranks are float4 values read back as doubles; repr keeps them exact
+        rank = float.fromhex('0x1.3333340000000p-2')
+        token = next_rank_token(('id', 'title', 'rank'), [(7, 'a', 0.5), (9, 'b', rank)], 2)
+        self.assertEqual(decode_rank_token(token), (rank, 9))
+        self.assertEqual(next_rank_token(('id', 'rank'), [(7, 0.5)], 2), '')
+        self.assertIsNone(decode_rank_token(''))
+
+    def test_page_size_is_clamped(self):
+        self.assertEqual(clamp_page_size(MAX_PAGE_SIZE * 10), MAX_PAGE_SIZE)
+        self.assertEqual(clamp_page_size(0), 0)
+        with self.assertRaises(ValueError):
+            clamp_page_size(-1)
+
+if __name__ == '__main__':
+    unittest.main()
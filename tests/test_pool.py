@@ -0,0 +1,82 @@
+import threading
+import time
+import unittest
+
+import psycopg2.extensions
+
+from server.db import ConnectionPool, PoolTimeout
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        self.rollbacks = 0
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+def _pool(maxconn=1, **kwargs):
+    kwargs.setdefault('check_idle', 3600)
+    return ConnectionPool(0, maxconn, 'dsn', connect=lambda dsn, connection_factory: FakeConnection(), **kwargs)
+
+class ConnectionPoolTests(unittest.TestCase):
+    def test_reuses_and_rolls_back(self):
+        pool = _pool()
+        conn = pool.getconn()
+        conn.status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        pool.putconn(conn)
+        self.assertEqual(conn.rollbacks, 1)
+        self.assertIs(pool.getconn(), conn)
+        self.assertEqual(pool.stats()['created'], 1)
+
+    def test_timeout(self):
+        pool = _pool(timeout=0.01)
+        pool.getconn()
+        with self.assertRaises(PoolTimeout):
+            pool.getconn()
+        stats = pool.stats()
+        self.assertEqual((stats['in_use'], stats['waiting'], stats['timeouts']), (1, 0, 1))
+
+    def test_waiters_served_in_order(self):
+        pool = _pool(timeout=5)
+        held = pool.getconn()
+        served = []
+
+        def worker(name):
+            conn = pool.getconn()
+            served.append(name)
+            pool.putconn(conn)
+
+        threads = []
+        for name in range(3):
+            t = threading.Thread(target=worker, args=(name,))
+            t.start()
+            threads.append(t)
+            while pool.stats()['waiting'] <= name:
+                time.sleep(0.001)
+        pool.putconn(held)
+        for t in threads:
+            t.join()
+        self.assertEqual(served, [0, 1, 2])
+
+    def test_broken_and_expired_connections_are_replaced(self):
+        pool = _pool(max_lifetime=0)
+        first = pool.getconn()
+        pool.putconn(first)
+        self.assertTrue(first.closed)
+        second = pool.getconn()
+        second.closed = 1
+        pool.putconn(second)
+        self.assertIsNot(pool.getconn(), second)
+        stats = pool.stats()
+        self.assertEqual((stats['size'], stats['created'], stats['recycled']), (1, 3, 1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+from unittest import mock
+
+from prometheus_client import CollectorRegistry
+import server.prefork as prefork
+from server.metrics import StatsCollector
+from server.prefork import Supervisor, Worker, pool_slice
+
+class FakeProcess:
+    def __init__(self, pid, returncode=None):
+        self.pid = pid
+        self.returncode = returncode
+
+    def poll(self):
+        return self.returncode
+
+class PoolSliceTests(unittest.TestCase):
+    def test_budget_is_split_after_overhead(self):
+        self.assertEqual(pool_slice(87, 4, 3), 18)
+        with self.assertRaises(ValueError):
+            pool_slice(20, 8, 3)
+
+class SupervisorTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = 100.0
+        for name, value in (('monotonic', lambda: self.clock), ('multiprocess', mock.Mock())):
+            patcher = mock.patch.object(prefork, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.worker = Worker(0)
+        self.supervisor = Supervisor([self.worker], {}, '/tmp')
+        self.pids = iter(range(1000, 2000))
+        self.supervisor._spawn = self._spawn
+
+    def _spawn(self, worker):
+        worker.process = FakeProcess(next(self.pids))
+        worker.started = self.clock
+
+    def test_restarts_with_backoff_while_crashing(self):
+        self.supervisor._spawn(self.worker)
+        self.worker.process.returncode = 1
+        self.supervisor.check()
+        self.assertEqual((self.worker.backoff, self.worker.restart_at), (2, 102.0))
+        self.supervisor.check()
+        self.assertEqual(self.worker.pid, 1000)
+        self.clock = 102.0
+        self.supervisor.check()
+        self.assertEqual((self.worker.pid, self.worker.restarts), (1001, 1))
+        self.clock = 200.0
+        self.worker.process.returncode = 1
+        self.supervisor.check()
+        self.assertEqual(self.worker.backoff, 1)
+
+class StatsCollectorTests(unittest.TestCase):
+    def test_worker_label_only_for_snapshots(self):
+        stats = {'cache': {}, 'pools': {'db': {'in_use': 1, 'idle': 2, 'waiting': 0, 'acquired': 5, 'timeouts': 0}},
+                 'log': {'queued': 0, 'dropped': {'overflow': 0}}}
+        registry = CollectorRegistry()
+        registry.register(StatsCollector(lambda: [('0', stats), ('1', stats)]))
+        self.assertEqual(registry.get_sample_value('library_db_pool_waiting', {'pool': 'db', 'worker': '1'}), 0)
+        registry = CollectorRegistry()
+        registry.register(StatsCollector(lambda: [(None, stats)]))
+        self.assertEqual(registry.get_sample_value('library_db_pool_acquired_total', {'pool': 'db'}), 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+import server.db as db
+from server.db import Replica, ReplicaSet
+
+class FakePool:
+    def __init__(self, busy):
+        self._busy = busy
+
+    def busy(self):
+        return self._busy
+
+def _replica(name, lag, busy=0):
+    replica = Replica(name, 'dsn', FakePool(busy))
+    replica.lag = lag
+    return replica
+
+class ReplicaSetTests(unittest.TestCase):
+    def test_skips_lagging_and_unreachable(self):
+        replicas = ReplicaSet([_replica('a', None), _replica('b', 5.0), _replica('c', 0.2)], 'dsn', max_lag=1)
+        self.assertEqual({replicas.choose().name for _ in range(4)}, {'c'})
+        replicas.replicas[2].lag = 3.0
+        self.assertIsNone(replicas.choose())
+
+    def test_least_busy_then_round_robin(self):
+        replicas = ReplicaSet([_replica('a', 0, busy=3), _replica('b', 0, busy=1)], 'dsn', max_lag=1)
+        self.assertEqual({replicas.choose().name for _ in range(4)}, {'b'})
+        replicas.replicas[0].pool._busy = 1
+        self.assertEqual({replicas.choose().name for _ in range(4)}, {'a', 'b'})
+
+class ReadYourWritesTests(unittest.TestCase):
+    def setUp(self):
+        self.saved = db._replicas
+        db._replicas = ReplicaSet([_replica('a', 0)], 'dsn', max_lag=1, interval=1)
+
+    def tearDown(self):
+        db._replicas = self.saved
+        db._writes.clear()
+
+    def test_recent_write_pins_scope_to_primary(self):
+        db.mark_written('member:7')
+        self.assertIsNone(db.choose_replica(('member:7',)))
+        self.assertEqual(db.choose_replica(('member:8',)).name, 'a')
+        db._writes['member:7'] -= 10
+        self.assertEqual(db.choose_replica(('member:7',)).name, 'a')
+
+if __name__ == '__main__':
+    unittest.main()
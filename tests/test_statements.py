@@ -0,0 +1,49 @@
+import unittest
+
+from server.statements import Statement, execute, projection
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.executed = []
+
+    def execute(self, sql, params=None):
+        self.executed.append((sql, params))
+
+class Connection:
+    def __init__(self):
+        self.prepared_statements = set()
+
+class StatementTests(unittest.TestCase):
+    def test_named_parameters_are_numbered_once(self):
+        stmt = Statement('s', "SELECT * FROM t WHERE a = %(a)s AND (%(b)s = 0 OR id < %(b)s) AND c LIKE 'x%%'")
+        self.assertEqual(stmt.prepare_sql, "PREPARE s AS SELECT * FROM t WHERE a = $1 AND ($2 = 0 OR id < $2) AND c LIKE 'x%'")
+        self.assertEqual(stmt.execute_sql, 'EXECUTE s (%(a)s, %(b)s)')
+
+    def test_positional_and_no_parameters(self):
+        self.assertEqual(Statement('p', 'SELECT %s, %s').execute_sql, 'EXECUTE p (%s, %s)')
+        self.assertEqual(Statement('n', 'SELECT 1').execute_sql, 'EXECUTE n')
+        with self.assertRaises(ValueError):
+            Statement('m', 'SELECT %s, %(a)s')
+
+    def test_prepared_once_per_connection(self):
+        stmt = Statement('s', 'SELECT * FROM t WHERE id=%s')
+        cur = FakeCursor(Connection())
+        execute(cur, stmt, (1,))
+        execute(cur, stmt, (2,))
+        self.assertEqual(cur.executed, [('PREPARE s AS SELECT * FROM t WHERE id=$1', None),
+                                        ('EXECUTE s (%s)', (1,)), ('EXECUTE s (%s)', (2,))])
+        other = FakeCursor(object())
+        execute(other, stmt, (3,))
+        self.assertEqual(other.executed, [('SELECT * FROM t WHERE id=%s', (3,))])
+
+    def test_projection_per_column_list(self):
+        template = 'SELECT {columns} FROM t WHERE id=%s'
+        narrow, again = projection('t_by_id', template, ('id', 'a')), projection('t_by_id', template, ['id', 'a'])
+        wide = projection('t_by_id', template, ('id', 'a', 'b'))
+        self.assertIs(narrow, again)
+        self.assertNotEqual(narrow.name, wide.name)
+        self.assertEqual(wide.sql, 'SELECT id, a, b FROM t WHERE id=%s')
+
+if __name__ == '__main__':
+    unittest.main()